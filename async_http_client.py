@@ -0,0 +1,284 @@
+import asyncio
+import contextlib
+import json
+import aiohttp
+import requests
+from requests.structures import CaseInsensitiveDict
+from application.core.utils.circuit_breaker import CircuitOpenError, get_breaker, is_failure
+from application.core.utils.coalesce import AsyncSingleFlight, coalescable, request_key
+from application.core.utils import deadline
+from application.core.utils.deadline import DeadlineExceeded
+from application.core.utils.hedging import HEDGE_METHODS, get_hedger
+from application.core.utils.http_client import DEFAULT_TIMEOUT, retries, resolve_upstream
+from application.core.utils.http_cache import get_cache, prepare_request
+from application.core.utils.rate_limit import get_host_limiter
+from application.core.utils.stats import record_request
+import time
+from urllib.parse import urlsplit, urlunsplit
+
+
+# The async client uses the same default timeout and retry strategy as the regular one in http_client.py
+
+# Set the maximum number of connections the async client can have open at once, across all hosts
+CONNECTION_LIMIT = 100
+
+
+# A read-only response that looks like a requests response, so that the same parsing code works on both
+class AsyncHTTPResponse:
+    def __init__(self, method, url, status_code, reason, headers, content, encoding, cookies):
+        self.method = method
+        self.url = url
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+        self.encoding = encoding or "utf-8"
+        self.cookies = cookies
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def json(self):
+        try:
+            return json.loads(self.text)
+        except ValueError as e:
+            raise requests.exceptions.JSONDecodeError(str(e), self.text, 0)
+
+    # Raises the same HTTPError as requests does if the server responded with an HTTP error code
+    def raise_for_status(self):
+        if 400 <= self.status_code < 600:
+            raise requests.exceptions.HTTPError(str(self.status_code)+" Error: "+str(self.reason)+" for url: "+self.url, response=self)
+
+
+# Call back if the server responds with an HTTP error code
+assert_status_hook = lambda response, *args, **kwargs: response.raise_for_status()
+
+
+# An asyncio HTTP client configured like http_client
+# Errors are raised as the usual requests exceptions, so callers can catch requests.exceptions.RequestException
+# whichever client they use
+class AsyncHTTPClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, retries=retries, limit=CONNECTION_LIMIT):
+        self.timeout = timeout
+        self.retries = retries
+        self.hooks = {"response": [assert_status_hook]}
+        self.flights = AsyncSingleFlight()
+
+        # Cookies aren't shared between requests; callers that need a session cookie pass it along themselves
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=limit),
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=aiohttp.ClientTimeout(total=timeout)
+        )
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, data=None, **kwargs):
+        return await self.request("POST", url, data=data, **kwargs)
+
+    # Makes a request, retrying it the same way the regular client's retry strategy would
+    # Accepts requests-style params, data, headers, timeout and verify arguments
+    # Identical requests made at the same time share one call, just like with http_client (see coalesce.py). The
+    # response is read-only, so they share the response object too.
+    async def request(self, method, url, params=None, data=None, headers=None, timeout=None, verify=True):
+        if not coalescable(method, headers):
+            return await self.request_now(method, url, params, data, headers, timeout, verify)
+        started = time.perf_counter()
+        prepared = prepare_request(method, url, params, data, headers)
+        key = request_key(prepared.method, prepared.url, prepared.body, headers)
+
+        # The coroutine that sends the request records it, so the ones waiting for it only record it if it fails
+        leader = []
+
+        # Send the request, noting that this coroutine sent it rather than waiting for another one
+        async def send():
+            leader.append(True)
+            return await self.request_now(method, url, params, data, headers, timeout, verify)
+
+        try:
+            response, shared = await self.flights.do(key, send)
+        except requests.exceptions.RequestException as e:
+            if not leader:
+                record_request(url, time.perf_counter() - started, 0, failed=True, coalesced=True, short_circuited=isinstance(e, (CircuitOpenError, DeadlineExceeded)))
+            raise
+        if shared:
+            record_request(url, time.perf_counter() - started, len(response.content), coalesced=True)
+        return response
+
+    # Makes a request without waiting for an identical one
+    # Uses the same response cache as http_client when caching is on, and records every call in the stats
+    # The cache is read and written on a worker thread, so its disk I/O doesn't block the event loop
+    # Inside a deadline (see deadline.py), it isn't retried once the deadline has passed
+    async def request_now(self, method, url, params=None, data=None, headers=None, timeout=None, verify=True):
+        started = time.perf_counter()
+        cache = get_cache()
+        if cache is not None:
+            prepared = prepare_request(method, url, params, data, headers)
+            response = await asyncio.to_thread(cache.lookup, prepared)
+            if response is not None:
+                record_request(url, time.perf_counter() - started, len(response.content), from_cache=True)
+                return response
+        attempt = 0
+        while True:
+            try:
+                response = await self.send_hedged(method, url, params, data, headers, timeout, verify)
+            except (CircuitOpenError, DeadlineExceeded):
+                record_request(url, time.perf_counter() - started, 0, retries=attempt, failed=True, short_circuited=True)
+                raise
+            except requests.exceptions.ConnectionError:
+                if attempt >= self.retries.total or not self.is_method_retryable(method) or deadline.passed():
+                    record_request(url, time.perf_counter() - started, 0, retries=attempt, failed=True)
+                    raise
+            except requests.exceptions.RequestException:
+                record_request(url, time.perf_counter() - started, 0, retries=attempt, failed=True)
+                raise
+            else:
+                if attempt >= self.retries.total or not self.retries.is_retry(method, response.status_code) or deadline.passed():
+                    if cache is not None:
+                        await asyncio.to_thread(cache.store, prepared, response)
+                    record_request(url, time.perf_counter() - started, len(response.content), retries=attempt, failed=response.status_code >= 400)
+                    for hook in self.hooks["response"]:
+                        hook(response)
+                    return response
+
+            # Back off before trying again, but not past the deadline
+            attempt = attempt + 1
+            await asyncio.sleep(deadline.limit_timeout(self.backoff_time(attempt)))
+
+    # Returns True if the retry strategy allows retrying this method after a failed connection
+    def is_method_retryable(self, method):
+        return self.retries.allowed_methods is False or method.upper() in self.retries.allowed_methods
+
+    # Returns how long to wait before the given retry attempt, using the same formula as urllib3
+    def backoff_time(self, attempt):
+        if attempt <= 1:
+            return 0
+        return min(self.retries.DEFAULT_BACKOFF_MAX, self.retries.backoff_factor * (2 ** (attempt - 1)))
+
+    # Sends a single request, hedging it if its host is hedged (see hedging.py)
+    async def send_hedged(self, method, url, params, data, headers, timeout, verify):
+        hedger = get_hedger(urlsplit(url).hostname)
+        if hedger is None or method.upper() not in HEDGE_METHODS:
+            return await self.send(method, url, params, data, headers, timeout, verify)
+        return await hedger.send_async(self.send, method, url, params, data, headers, timeout, verify)
+
+    # Sends a single request and reads the whole response, keeping to the host's rate and concurrency limits
+    # Fails straight away with a CircuitOpenError if the host's circuit breaker is open (see circuit_breaker.py), and
+    # with DeadlineExceeded if the deadline has passed or does while it waits for a slot
+    # Unlike http_client, every attempt counts towards the breaker, not just the last one. Requests that are cancelled
+    # (like a hedge that lost) or fail because the deadline passed don't count against the host.
+    async def send(self, method, url, params, data, headers, timeout, verify):
+        deadline.check()
+        breaker = get_breaker(urlsplit(url).hostname)
+        trial = breaker.allow()
+        limiter = get_host_limiter(urlsplit(url).hostname)
+        response = None
+        started = None
+        gave_up = False
+        try:
+            started = await self.acquire(limiter) if limiter is not None else None
+            response = await self.send_now(method, url, params, data, headers, timeout, verify)
+            return response
+        except (asyncio.CancelledError, DeadlineExceeded):
+            gave_up = True
+            raise
+        except requests.exceptions.RequestException:
+            gave_up = deadline.passed()
+            raise
+        finally:
+            if limiter is not None and started is not None:
+                if response is None and gave_up:
+                    limiter.give_back()
+                else:
+                    limiter.release(started, response)
+            breaker.record(None if gave_up else is_failure(response), trial)
+
+    # Waits for a slot from the host's limiter, but not past the deadline, and returns the time acquire returned
+    async def acquire(self, limiter):
+        if deadline.remaining() is None:
+            return await limiter.acquire_async()
+        try:
+            return await asyncio.wait_for(limiter.acquire_async(), deadline.remaining())
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded("The deadline passed while the request waited for a slot")
+
+    # Sends a single request right away and reads the whole response
+    # If the host's requests are being sent somewhere else (see set_upstream in http_client.py), the response still
+    # looks like it came from the host
+    async def send_now(self, method, url, params, data, headers, timeout, verify):
+        if timeout is None:
+            timeout = self.timeout
+        deadline.check()
+        timeout = deadline.limit_timeout(timeout)
+        upstream_url, host = resolve_upstream(url)
+        if host is not None:
+            headers = dict(headers or {}, Host=host)
+        try:
+            async with self.session.request(method, upstream_url, params=params, data=data, headers=headers,
+                                            ssl=None if verify else False,
+                                            timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                content = await response.read()
+                cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+                response_url = str(response.url)
+                if host is not None:
+                    response_url = urlunsplit(urlsplit(url)[:2]+urlsplit(response_url)[2:])
+                return AsyncHTTPResponse(method, response_url, response.status, response.reason,
+                                         response.headers, content, response.get_encoding() if content else None, cookies)
+        except asyncio.TimeoutError as e:
+            raise requests.exceptions.Timeout("Timed out after "+str(timeout)+" seconds: "+method+" "+url) from e
+        except aiohttp.ClientError as e:
+            raise requests.exceptions.ConnectionError(str(e)+": "+method+" "+url) from e
+
+    async def close(self):
+        await self.session.close()
+
+
+# aiohttp sessions belong to the event loop they were created on, so keep one client per loop
+# A session holds on to its loop, so these are only let go of when they're closed, or their loop is
+async_http_clients = {}
+
+# How many callers are holding each loop's client open (see holding_async_http_client)
+async_http_client_holds = {}
+
+
+# Returns the async HTTP client for the running event loop, creating it the first time it's asked for
+# Clients left behind by event loops that have since closed are thrown out, so a program that starts a new loop for
+# every piece of work doesn't keep every loop it's ever had
+def get_async_http_client():
+    loop = asyncio.get_running_loop()
+    client = async_http_clients.get(loop)
+    if client is None or client.session.closed:
+        for old in [old for old in async_http_clients if old.is_closed()]:
+            del async_http_clients[old]
+        client = AsyncHTTPClient()
+        async_http_clients[loop] = client
+    return client
+
+
+# Keeps the async HTTP client for the running event loop open until the with block is done, then closes it unless
+# something else is still holding it, e.g. another property being built on the same loop
+# Wrap top-level async work in this, so the client doesn't outlive it:
+#
+#   async with holding_async_http_client() as client:
+#       ...
+@contextlib.asynccontextmanager
+async def holding_async_http_client():
+    loop = asyncio.get_running_loop()
+    async_http_client_holds[loop] = async_http_client_holds.get(loop, 0) + 1
+    try:
+        yield get_async_http_client()
+    finally:
+        async_http_client_holds[loop] = async_http_client_holds[loop] - 1
+        if not async_http_client_holds[loop]:
+            del async_http_client_holds[loop]
+            await close_async_http_client()
+
+
+# Closes the async HTTP client for the running event loop, if there is one
+# Call this before your event loop shuts down
+async def close_async_http_client():
+    client = async_http_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.close()
@@ -0,0 +1,128 @@
+import threading
+import time
+import requests
+
+
+# Stops sending requests to a host that's down, instead of waiting for every one of them to time out
+# Every host gets a circuit breaker. It starts closed, and lets requests through. Once FAILURE_THRESHOLD requests in a
+# row fail (the connection fails, it times out, or the host answers with a server error), the breaker opens, and every
+# request to the host fails straight away with a CircuitOpenError. After RESET_TIMEOUT seconds it's half open, and lets
+# HALF_OPEN_TRIALS requests through to see whether the host is back. If they work, the breaker closes again; if one of
+# them fails, it opens again for another RESET_TIMEOUT seconds.
+# CircuitOpenError is a requests ConnectionError, so everything that already copes with a failed request copes with it.
+
+# Set how many requests in a row have to fail before a host's breaker opens
+FAILURE_THRESHOLD = 5
+
+# Set how long a breaker stays open before it lets a request through to try the host again
+RESET_TIMEOUT = 30 # seconds
+
+# Set how many requests have to work while a breaker is half open before it closes again
+HALF_OPEN_TRIALS = 1
+
+# Status codes that mean a host is failing
+# 429 isn't one of them: the host is up, it just wants us to slow down (see rate_limit.py)
+FAILURE_STATUSES = (500, 502, 503, 504)
+
+# The states a breaker can be in
+BREAKER_STATES = ("closed", "open", "half_open")
+
+
+# Raised instead of sending a request to a host whose breaker is open
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    pass
+
+
+# The circuit breaker for one host
+# Safe to share between threads and event loops
+class CircuitBreaker:
+    def __init__(self, host, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT, half_open_trials=HALF_OPEN_TRIALS):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_trials = half_open_trials
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0
+        self.trials = 0
+        self.successes = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    # Checks whether a request can go to the host, and raises a CircuitOpenError if it can't
+    # Returns True if the request is one of the trials of a half open breaker
+    def allow(self):
+        with self.lock:
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    raise CircuitOpenError("The circuit breaker for "+self.host+" is open, so the request wasn't sent")
+                self.state = "half_open"
+                self.trials = 0
+                self.successes = 0
+            if self.state == "half_open":
+                if self.trials >= self.half_open_trials:
+                    raise CircuitOpenError("The circuit breaker for "+self.host+" is half open and already trying the host")
+                self.trials = self.trials + 1
+                return True
+            return False
+
+    # Accepts whether a request failed, and whether it was a trial (what allow returned), and updates the breaker
+    # Pass failed=None for a request we gave up on (see deadline.py), which says nothing about the host
+    def record(self, failed, trial=False):
+        with self.lock:
+            if trial:
+                self.trials = self.trials - 1
+                if self.state != "half_open" or failed is None:
+                    return
+                if failed:
+                    self.open()
+                else:
+                    self.successes = self.successes + 1
+                    if self.successes >= self.half_open_trials:
+                        self.state = "closed"
+                        self.failures = 0
+            elif self.state == "closed" and failed is not None:
+                if failed:
+                    self.failures = self.failures + 1
+                    if self.failures >= self.failure_threshold:
+                        self.open()
+                else:
+                    self.failures = 0
+
+    # Opens the breaker
+    # Has to be called with the lock held
+    def open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opened = self.opened + 1
+
+
+# Accepts a response, or None if the request failed without one, and returns True if it means the host is failing
+def is_failure(response):
+    return response is None or response.status_code in FAILURE_STATUSES
+
+
+# The breaker for each host we've sent requests to
+breakers = {}
+breakers_lock = threading.Lock()
+
+
+# Accepts a host name and returns its breaker, creating it the first time it's asked for
+def get_breaker(host):
+    breaker = breakers.get(host)
+    if breaker is None:
+        with breakers_lock:
+            breaker = breakers.setdefault(host, CircuitBreaker(host))
+    return breaker
+
+
+# Returns the state of every host's breaker, e.g. {'eplans.hamilton.ca': 'open'}
+def breaker_states():
+    with breakers_lock:
+        return {host: breaker.state for host, breaker in breakers.items()}
+
+
+# Closes every breaker, e.g. once you know a host is back
+def reset_breakers():
+    with breakers_lock:
+        breakers.clear()
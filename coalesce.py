@@ -0,0 +1,163 @@
+import asyncio
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from urllib.parse import urlsplit, parse_qsl
+from application.core.utils import deadline
+from application.core.utils.deadline import DeadlineExceeded
+
+
+# Shares one call between everyone who asks for the same thing at the same time
+# When lots of properties are built side by side, many of them ask for the same page at the same moment: a roll
+# number shared by several addresses, or a street that's searched for every address on it. The first caller makes the
+# call, and everyone who asks for the same thing while it's still running waits for it and gets the same result (or
+# the same error), instead of asking the server again. Once the call is done, the next caller makes a new one.
+# Everyone waits for the call only until their own deadline (see deadline.py), and if the call fails because the
+# deadline of whoever made it passed, the others don't get that error, they make the call again themselves.
+#
+#   flights = SingleFlight()
+#   page, shared = flights.do(key, http_client.get, url)
+#
+# Coroutines use AsyncSingleFlight the same way, with one per event loop. Both HTTP clients coalesce their requests
+# like this (see CoalescingHTTPAdapter in http_client.py), so you don't need to do it yourself.
+
+# Set which request methods can be coalesced
+# POSTs are included because the city's search forms are POSTs that don't change anything
+COALESCE_METHODS = ("GET", "HEAD", "POST")
+
+
+# Handed to the callers waiting on a call that failed only because the deadline of whoever made it passed, so they
+# make the call again instead of failing with it
+class CallCutShort(Exception):
+    def __init__(self, error):
+        super().__init__(str(error))
+        self.error = error
+
+
+# Coalesces calls made from several threads
+class SingleFlight:
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+        self.shared = 0
+
+    # Accepts a key and a function (plus its arguments), and returns what the function returned and whether it was
+    # shared, i.e. the function was already running for the same key on another thread and this call waited for it
+    # Raises whatever the function raised, or DeadlineExceeded if the deadline passes while it waits for another thread
+    def do(self, key, function, *args, **kwargs):
+        while True:
+            with self.lock:
+                future = self.calls.get(key)
+                leader = future is None
+                if leader:
+                    future = self.calls[key] = Future()
+                else:
+                    self.shared = self.shared + 1
+            if leader:
+                break
+            try:
+                return self.wait(future), True
+            except CallCutShort:
+                continue
+        try:
+            result = function(*args, **kwargs)
+        except BaseException as e:
+            self.forget(key)
+            future.set_exception(CallCutShort(e) if deadline.cut_short(e) else e)
+            raise
+        self.forget(key)
+        future.set_result(result)
+        return result, False
+
+    # Accepts the future of a call another thread is making, and returns its result once it's done
+    def wait(self, future):
+        try:
+            return future.result(deadline.remaining())
+        except FutureTimeoutError:
+            if future.done():
+                raise
+            raise DeadlineExceeded("The deadline passed while the request waited for an identical one")
+
+    # Accepts a key whose call has finished, so the next call for it runs again
+    def forget(self, key):
+        with self.lock:
+            self.calls.pop(key, None)
+
+
+# Coalesces calls made from coroutines on one event loop
+class AsyncSingleFlight:
+    def __init__(self):
+        self.tasks = {}
+        self.shared = 0
+
+    # Accepts a key and a coroutine function (plus its arguments), and returns what it returned and whether it was
+    # shared with a coroutine that was already waiting on it
+    # Raises whatever the coroutine raised, or DeadlineExceeded if the deadline passes while it waits for another
+    # coroutine. If the caller is cancelled, the call carries on for everyone else.
+    async def do(self, key, function, *args, **kwargs):
+        task = self.tasks.get(key)
+        while task is not None and not task.done():
+            self.shared = self.shared + 1
+            try:
+                return await self.wait(task), True
+            except CallCutShort:
+                task = self.tasks.get(key)
+        task = self.tasks[key] = asyncio.ensure_future(self.lead(function, args, kwargs))
+        task.add_done_callback(lambda done: self.forget(key, done))
+        try:
+            return await asyncio.shield(task), False
+        except CallCutShort as e:
+            error = e.error
+        raise error
+
+    # Makes the call, in a task that keeps the context (and the deadline) of the coroutine that started it
+    async def lead(self, function, args, kwargs):
+        try:
+            return await function(*args, **kwargs)
+        except Exception as e:
+            if deadline.cut_short(e):
+                raise CallCutShort(e) from e
+            raise
+
+    # Accepts the task of a call another coroutine is making, and returns its result once it's done
+    async def wait(self, task):
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), deadline.remaining())
+        except asyncio.TimeoutError:
+            if task.done():
+                raise
+            raise DeadlineExceeded("The deadline passed while the request waited for an identical one")
+
+    # Accepts a key and its finished task, so the next call for it runs again
+    def forget(self, key, task):
+        if self.tasks.get(key) is task:
+            del self.tasks[key]
+
+
+# Accepts a dict of request headers and the name of one, and returns its value whatever case it was sent in
+def header(headers, name):
+    name = name.lower()
+    for key, value in (headers or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+# Accepts a request's method and headers and returns True if it can share a call with identical requests
+# Requests sent with a 'Cache-Control: no-cache' or 'no-store' header, like Eplans session requests, always get
+# their own call
+def coalescable(method, headers):
+    control = header(headers, "Cache-Control") or ""
+    return method.upper() in COALESCE_METHODS and "no-cache" not in control and "no-store" not in control
+
+
+# Accepts a request's method, full URL, body and headers and returns the key identical requests share
+# Query and form parameters are sorted, so requests that only differ in the order of their parameters share a key.
+# Requests sent with different cookies never do.
+def request_key(method, url, body, headers):
+    parts = urlsplit(url)
+    if isinstance(body, bytes):
+        body = body.decode("latin-1")
+    return (method.upper(), parts.scheme, parts.netloc.lower(), parts.path,
+            tuple(sorted(parse_qsl(parts.query, keep_blank_values=True))),
+            tuple(sorted(parse_qsl(body or "", keep_blank_values=True))),
+            header(headers, "Cookie") or "")
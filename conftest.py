@@ -0,0 +1,21 @@
+import os
+import sys
+import types
+
+
+# The utils are imported as application.core.utils, the package they live in inside the app. When the tests are run
+# from a checkout of this repository on its own, point that package at the checkout.
+try:
+    import application.core.utils
+except ImportError:
+    parent = None
+    for name, path in (("application", []), ("application.core", []), ("application.core.utils", [os.path.dirname(os.path.abspath(__file__))])):
+        package = types.ModuleType(name)
+        package.__path__ = path
+        sys.modules[name] = package
+        if parent is not None:
+            setattr(parent, name.rsplit(".", 1)[1], package)
+        parent = package
+
+# ls_hamilton_property_test.py looks up a real address on the city's servers, so it isn't one of the tests
+collect_ignore = ["ls_hamilton_property_test.py"]
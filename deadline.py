@@ -0,0 +1,84 @@
+import contextlib
+import contextvars
+import time
+import requests
+
+
+# Gives a whole piece of work, like building a property, a time budget that every HTTP call inside it keeps to
+# Without a deadline, each request gets its own timeout, and a property that makes a few dozen requests to a slow server
+# can take over a minute. Inside a deadline, every request's timeout is cut down to the time that's left, and once it's
+# up, requests fail straight away with DeadlineExceeded instead of being sent.
+#
+#   with within(deadline_in(3)):
+#       ...
+#
+# The deadline lives in a context variable, so it follows the work into coroutines, and into threads started with a
+# copy of the context (see contextvars.copy_context). Nested deadlines never extend the one they're inside.
+# DeadlineExceeded is a requests Timeout, so everything that already copes with a failed request copes with it.
+
+
+# Raised instead of sending a request once the deadline has passed
+class DeadlineExceeded(requests.exceptions.Timeout):
+    pass
+
+
+# When the work running in the current thread or task has to be done by, in time.monotonic() seconds, if ever
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+# Accepts a number of seconds, or None, and returns the deadline that many seconds from now, or None for no deadline
+def deadline_in(seconds):
+    if seconds is None:
+        return None
+    return time.monotonic() + seconds
+
+
+# Accepts a deadline (from deadline_in) and keeps everything run inside the with block to it
+# A deadline of None leaves things as they are
+@contextlib.contextmanager
+def within(deadline):
+    outer = current_deadline.get()
+    if deadline is None or (outer is not None and outer <= deadline):
+        yield outer
+        return
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+# Returns how many seconds are left before the deadline (0 once it's passed), or None if there isn't one
+def remaining():
+    deadline = current_deadline.get()
+    if deadline is None:
+        return None
+    return max(0, deadline - time.monotonic())
+
+
+# Returns True if there's a deadline and it's passed
+def passed():
+    return remaining() == 0
+
+
+# Raises DeadlineExceeded if the deadline has passed
+def check(description="the request"):
+    if passed():
+        raise DeadlineExceeded("The deadline passed before "+description+" was sent")
+
+
+# Accepts a requests timeout (a number of seconds, a (connect, read) tuple, or None) and returns it cut down to the
+# time left before the deadline
+def limit_timeout(timeout):
+    left = remaining()
+    if left is None:
+        return timeout
+    if isinstance(timeout, tuple):
+        return tuple(left if part is None else min(part, left) for part in timeout)
+    return left if timeout is None else min(timeout, left)
+
+
+# Accepts an exception and returns True if it was raised because the deadline passed, rather than because of anything
+# the host did
+def cut_short(error):
+    return isinstance(error, DeadlineExceeded) or (isinstance(error, requests.exceptions.RequestException) and passed())
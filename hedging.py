@@ -0,0 +1,190 @@
+import asyncio
+import collections
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+# Hedges requests to hosts that are usually quick, so one slow response doesn't hold up a whole property
+# A hedged request is sent as usual, and if it hasn't come back by the time most of the host's responses have (the
+# HEDGE_PERCENTILE of its recent response times), the same request is sent again, and whichever good response comes
+# back first is used. Hedges are capped at MAX_HEDGE_RATIO of the host's requests, so a host that slows down across
+# the board doesn't get twice the traffic just when it can least take it.
+#
+# Only hosts whose requests are cheap and safe to send twice should be hedged, like the ArcGIS map services, whose
+# queries don't change anything. Hedging is off until it's turned on:
+#
+#   enable_hedging()
+#
+# Both HTTP clients hedge requests to the hosts it's turned on for (see HedgingHTTPAdapter in http_client.py).
+
+# Set which hosts are hedged when hedging is turned on
+HEDGE_HOSTS = ("spatialsolutions.hamilton.ca",)
+
+# Set which request methods can be hedged
+# POSTs are included because the ArcGIS queries are sometimes sent as POSTs, and don't change anything
+HEDGE_METHODS = ("GET", "POST")
+
+# Set which percentile of the host's recent response times to wait for before sending a hedge
+HEDGE_PERCENTILE = 95
+
+# Set how many recent response times to keep for each host, and how many it needs before its percentile is used
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+# Set how long to wait before sending a hedge until the host has enough response times
+DEFAULT_HEDGE_DELAY = 1 # seconds
+
+# Set the shortest wait before sending a hedge, so a host that answers in a few milliseconds isn't sent every
+# request twice
+MIN_HEDGE_DELAY = 0.05 # seconds
+
+# Set the most hedges to send, as a share of the host's requests
+MAX_HEDGE_RATIO = 0.1
+
+# Set how many hedged requests threads can have in flight at once, across all hosts
+HEDGE_WORKERS = 64
+
+
+# Accepts a finished future or task and returns True if it has a response the host didn't fail on
+def is_good(future):
+    return not future.cancelled() and future.exception() is None and future.result().status_code < 500
+
+
+# Hedges one host's requests, and keeps its recent response times
+# Safe to share between threads and event loops
+class Hedger:
+    def __init__(self, host):
+        self.host = host
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    # Returns how many seconds to wait for a response before sending a hedge
+    def delay(self):
+        with self.lock:
+            if len(self.latencies) < MIN_SAMPLES:
+                return DEFAULT_HEDGE_DELAY
+            latencies = sorted(self.latencies)
+        return max(MIN_HEDGE_DELAY, latencies[min(len(latencies) - 1, len(latencies) * HEDGE_PERCENTILE // 100)])
+
+    # Counts a request, and returns how many seconds to wait for it before sending a hedge
+    def start(self):
+        with self.lock:
+            self.requests = self.requests + 1
+        return self.delay()
+
+    # Returns True and counts a hedge if there's room for one under MAX_HEDGE_RATIO
+    def take_hedge(self):
+        with self.lock:
+            if self.hedges + 1 > self.requests * MAX_HEDGE_RATIO:
+                return False
+            self.hedges = self.hedges + 1
+            return True
+
+    # Accepts the request or hedge that won, and counts it if it was the hedge
+    def finish(self, winner, hedge):
+        if winner is hedge:
+            with self.lock:
+                self.wins = self.wins + 1
+
+    # Accepts how many seconds a good response took
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    # Accepts a function that sends a requests PreparedRequest and returns its response, and a request and its
+    # keyword arguments, and returns the response, hedging it if it's slow
+    # The request and its hedge are sent from the hedging threads, in a copy of the caller's context. If the hedge wins,
+    # the request it beat carries on in the background until it's done.
+    def send(self, send, request, **kwargs):
+        first = hedge_executor.submit(contextvars.copy_context().run, self.timed, send, request, kwargs)
+        done = wait((first,), timeout=self.start())[0]
+        if done or not self.take_hedge():
+            return first.result()
+        hedge = hedge_executor.submit(contextvars.copy_context().run, self.timed, send, request.copy(), kwargs)
+        pending = {first, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if is_good(future):
+                    self.finish(future, hedge)
+                    return future.result()
+        return first.result()
+
+    # Sends a request and records how long it took if the host didn't fail on it
+    def timed(self, send, request, kwargs):
+        started = time.perf_counter()
+        response = send(request, **kwargs)
+        if response.status_code < 500:
+            self.record(time.perf_counter() - started)
+        return response
+
+    # Accepts a coroutine function that sends a request and returns its response, and its arguments, and returns the
+    # response, hedging it if it's slow
+    # Whichever of the request and its hedge loses is cancelled
+    async def send_async(self, send, *args):
+        first = asyncio.ensure_future(self.timed_async(send, *args))
+        hedge = None
+        try:
+            done = (await asyncio.wait((first,), timeout=self.start()))[0]
+            if done or not self.take_hedge():
+                return await first
+            hedge = asyncio.ensure_future(self.timed_async(send, *args))
+            pending = {first, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if is_good(task):
+                        self.finish(task, hedge)
+                        return task.result()
+            return first.result()
+        finally:
+            for task in (first, hedge):
+                if task is not None and not task.done():
+                    task.cancel()
+
+    async def timed_async(self, send, *args):
+        started = time.perf_counter()
+        response = await send(*args)
+        if response.status_code < 500:
+            self.record(time.perf_counter() - started)
+        return response
+
+
+# The hedger for each host that's hedged, once hedging is turned on
+hedgers = {}
+
+# The threads hedged requests are sent from, once hedging is turned on
+hedge_executor = None
+hedging_lock = threading.Lock()
+
+
+# Turns hedging on for the given hosts
+def enable_hedging(hosts=HEDGE_HOSTS):
+    global hedge_executor
+    with hedging_lock:
+        if hedge_executor is None:
+            hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+        for host in hosts:
+            hedgers.setdefault(host, Hedger(host))
+
+
+# Turns hedging off for every host
+def disable_hedging():
+    with hedging_lock:
+        hedgers.clear()
+
+
+# Accepts a host name and returns its hedger, or None if its requests aren't hedged
+def get_hedger(host):
+    return hedgers.get(host)
+
+
+# Returns how many requests each hedged host has had, how many of them were hedged, how many hedges won, and how long
+# it waits before hedging
+def hedging_stats():
+    return {host: {'requests': hedger.requests, 'hedges': hedger.hedges, 'wins': hedger.wins, 'delay': round(hedger.delay(), 3)} for host, hedger in list(hedgers.items())}
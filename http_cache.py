@@ -0,0 +1,241 @@
+import sqlite3
+import hashlib
+import json
+import threading
+import time
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from application.core.utils.logger import logger
+
+
+# Keeps HTTP responses in a SQLite database on disk, so that repeat runs can skip asking the city's servers for
+# things they already answered. The cache is off until you turn it on:
+#
+#   from application.core.utils.http_cache import enable_cache
+#   enable_cache("http_cache.sqlite")
+#
+# Once it's on, every request made through http_client (and the async client) checks it first.
+
+# Set where the cache database lives if you don't say otherwise
+DEFAULT_CACHE_PATH = "http_cache.sqlite"
+
+# Set the most response data the cache can hold before it starts throwing out the least recently used responses
+MAX_CACHE_SIZE = 1024 * 1024 * 1024 # bytes
+
+# Set how far below the maximum size to shrink the cache when it's full, so we aren't evicting on every write
+EVICT_TO = 0.9
+
+# One day, in seconds
+DAY = 24 * 60 * 60
+
+# Set how long responses from each upstream stay fresh, by URL prefix
+# Responses from URLs that don't match one of these prefixes aren't cached
+CACHE_TTLS = [
+
+    # The address search: addresses hardly ever move
+    ("https://spatialsolutions.hamilton.ca/webgis/rest/services/Geocoders/", 90 * DAY),
+
+    # The ward and zoning map layers: by-laws change a few times a year
+    ("https://spatialsolutions.hamilton.ca/webgis/rest/services/General/", 30 * DAY),
+
+    # The property inquiry application: assessments change once a year, levies a few times
+    ("http://oldproperty.hamilton.ca/", 7 * DAY),
+
+    # The Eplans application: permit statuses change all the time
+    ("https://eplans.hamilton.ca/", 1 * DAY)
+]
+
+# Set what a response from each upstream looks like when it isn't the page that was asked for, by URL prefix
+# Responses that contain it are never stored, and never answered from the cache if an old one was
+CACHE_REJECTS = [
+
+    # The Eplans Welcome interview, which Eplans answers with when a session has expired
+    ("https://eplans.hamilton.ca/", b"e_1482930323468")
+]
+
+# The cache modes
+    # use: answer from the cache when we can, and store anything new
+    # refresh: always ask the server, and store what it says
+    # bypass: leave the cache alone completely
+CACHE_MODES = ("use", "refresh", "bypass")
+
+
+# A response cache backed by a SQLite database
+# Safe to share between threads, and between processes pointed at the same file
+class HTTPCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_size=MAX_CACHE_SIZE, ttls=CACHE_TTLS, mode="use"):
+        if mode not in CACHE_MODES:
+            raise ValueError("Unknown cache mode "+repr(mode)+", expected one of "+", ".join(CACHE_MODES))
+        self.path = path
+        self.max_size = max_size
+        self.ttls = ttls
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, reason TEXT, headers TEXT, content BLOB, size INTEGER, stored REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    # Accepts a URL and returns how many seconds a response from it stays fresh, or None if it shouldn't be cached
+    def ttl(self, url):
+        for prefix, ttl in self.ttls:
+            if url.startswith(prefix):
+                return ttl
+        return None
+
+    # Accepts a prepared request and returns the stored response for it as a requests response, or None
+    # Only returns responses that are still fresh
+    def lookup(self, request):
+        ttl = self.ttl(request.url)
+        if ttl is None or self.mode != "use" or not self.readable(request):
+            return None
+        key = request_key(request)
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT url, status, reason, headers, content FROM responses WHERE key = ? AND stored > ?", (key, now - ttl)).fetchone()
+            if row is None:
+                self.misses = self.misses + 1
+                return None
+            if self.rejects(request.url, row[4]):
+                self.misses = self.misses + 1
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits = self.hits + 1
+        logger.debug("Found %s %s in the response cache", request.method, request.url)
+        return cached_response(request, *row)
+
+    # Accepts a prepared request and the response the server gave, and stores the response if it's worth keeping
+    # Only successful responses are kept, and never ArcGIS error objects, which come back with a 200 status, or
+    # anything in CACHE_REJECTS
+    def store(self, request, response):
+        if self.ttl(request.url) is None or self.mode == "bypass" or not self.writable(request):
+            return
+        if response.status_code != 200 or response.content[:9] == b'{"error":' or self.rejects(request.url, response.content):
+            return
+        content = response.content
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (
+                request_key(request), request.url, response.status_code, response.reason,
+                json.dumps(dict(response.headers)), content, len(content), now, now))
+            self.size = self.size + len(content)
+            if self.size > self.max_size:
+                self.evict()
+
+    # Throws out the least recently used responses until the cache is back under EVICT_TO of its maximum size
+    # Has to be called with the lock held
+    def evict(self):
+        self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        target = self.max_size * EVICT_TO
+        if self.size <= target:
+            return
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            keys.append((key,))
+            self.size = self.size - size
+            if self.size <= target:
+                break
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        logger.info("Evicted %s responses from the response cache", len(keys))
+
+    # Accepts a URL and the content of a response from it, and returns True if it's one of the CACHE_REJECTS
+    def rejects(self, url, content):
+        return any(url.startswith(prefix) and marker in content for prefix, marker in CACHE_REJECTS)
+
+    # Returns True if a request is allowed to be answered from the cache
+    # Requests sent with a 'Cache-Control: no-cache' or 'no-store' header always go to the server
+    def readable(self, request):
+        control = request.headers.get("Cache-Control", "")
+        return "no-cache" not in control and "no-store" not in control
+
+    # Returns True if a request's response is allowed to be stored
+    # Requests sent with a 'Cache-Control: no-store' header are never stored
+    def writable(self, request):
+        return "no-store" not in request.headers.get("Cache-Control", "")
+
+    # Deletes every stored response, or just the ones whose URLs start with the given prefix
+    def clear(self, prefix=""):
+        with self.lock:
+            self.connection.execute("DELETE FROM responses WHERE url LIKE ? ESCAPE '\\'", (prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")+"%",))
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# Accepts a prepared request and returns the key its response is stored under
+# Requests with the same method, URL and body share a key, whatever their headers or cookies
+def request_key(request):
+    body = request.body or b""
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return hashlib.sha256(request.method.encode("utf-8")+b" "+request.url.encode("utf-8")+b"\n"+body).hexdigest()
+
+
+# Accepts a prepared request and a stored response row and returns a requests response built from them
+# The response has a from_cache attribute set to True, so callers can tell it apart from a fresh one
+def cached_response(request, url, status, reason, headers, content):
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.headers = CaseInsensitiveDict(json.loads(headers))
+    response._content = content
+    response.encoding = get_encoding_from_headers(response.headers)
+    response.url = url
+    response.request = request
+    response.from_cache = True
+    return response
+
+
+# Accepts the parts of a request the way you'd pass them to http_client and returns a prepared request
+# Use this to look something up in the cache without sending anything
+def prepare_request(method, url, params=None, data=None, headers=None):
+    return requests.Request(method, url, params=params, data=data, headers=headers).prepare()
+
+
+# The response cache shared by http_client and the async client, or None if caching is off
+response_cache = None
+
+
+# Turns the response cache on, using the database at the given path
+# Accepts the same arguments as HTTPCache, and returns the cache
+def enable_cache(path=DEFAULT_CACHE_PATH, max_size=MAX_CACHE_SIZE, ttls=CACHE_TTLS, mode="use"):
+    global response_cache
+    disable_cache()
+    response_cache = HTTPCache(path, max_size, ttls, mode)
+    logger.info("Using the response cache at %s in %s mode", path, mode)
+    return response_cache
+
+
+# Turns the response cache off
+def disable_cache():
+    global response_cache
+    if response_cache is not None:
+        response_cache.close()
+        response_cache = None
+
+
+# Returns the response cache, or None if caching is off
+def get_cache():
+    return response_cache
+
+
+# Accepts the parts of a request the way you'd pass them to http_client and returns the fresh stored response for
+# it, or None if there isn't one or caching is off
+def get_cached(method, url, params=None, data=None):
+    if response_cache is None:
+        return None
+    return response_cache.lookup(prepare_request(method, url, params, data))
+
+
+# Accepts the parts of a request the way you'd pass them to http_client and the response the server gave, and stores
+# it, e.g. for a request that was sent with 'Cache-Control: no-store' and only turned out to be worth keeping afterwards
+def store_cached(method, url, response, params=None, data=None):
+    if response_cache is not None:
+        response_cache.store(prepare_request(method, url, params, data), response)
@@ -3,7 +3,20 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
+import collections
 import http
+import http.cookiejar
+from application.core.utils.circuit_breaker import CircuitOpenError, get_breaker, is_failure
+from application.core.utils.coalesce import SingleFlight, coalescable, request_key
+from application.core.utils import deadline
+from application.core.utils.deadline import DeadlineExceeded
+from application.core.utils.hedging import HEDGE_METHODS, get_hedger
+from application.core.utils.http_cache import get_cache
+from application.core.utils.rate_limit import get_host_limiter
+from application.core.utils.stats import record_request
+import threading
+import time
+from urllib.parse import urlsplit
 
 
 # Set the timeout for HTTP requests
@@ -12,20 +25,57 @@ DEFAULT_TIMEOUT = 5 # seconds
 # Set the level of detail for HTTP debug info in the console
 HTTP_DEBUG_LEVEL = 0
 
+# Set how many hosts each client keeps open connections to
+POOL_HOSTS = 8
+
+# Set how many open connections each client keeps to each host
+# No host is ever sent more requests at once than this (see HOST_LIMITS in rate_limit.py), so a client only gets
+# bigger pools if it's built for a higher concurrency
+DEFAULT_POOL_SIZE = 16
+
+# Extend the retry strategy so that nothing is retried once the deadline has passed (see deadline.py), and the back off
+# before a retry never goes past it
+class DeadlineRetry(Retry):
+    def is_exhausted(self):
+        return deadline.passed() or super().is_exhausted()
+    def get_backoff_time(self):
+        return deadline.limit_timeout(super().get_backoff_time())
+
 # Retry strategy
-retries = Retry(total=1, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+retries = DeadlineRetry(total=1, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+
+# Set the debug level, leaving it alone unless we want debug info, since it's shared with everything else in the process
+if HTTP_DEBUG_LEVEL:
+    http.client.HTTPConnection.debuglevel = HTTP_DEBUG_LEVEL
 
-# Create a custom requests object
-http_client = requests.Session()
+# Send a host's requests somewhere else instead, e.g. to a local replay server (see ls_hamilton_replay.py)
+# Maps a host name to the base URL to send its requests to, e.g. {"eplans.hamilton.ca": "http://127.0.0.1:8080"}
+# Everything else (the cache, rate limits and stats) still sees the original URL
+upstream_overrides = {}
 
-# Set the debug level
-http.client.HTTPConnection.debuglevel = HTTP_DEBUG_LEVEL
+# Accepts a host name and the base URL to send its requests to instead
+def set_upstream(host, base_url):
+    upstream_overrides[host] = base_url.rstrip("/")
+
+# Sends every host's requests to the host itself again
+def clear_upstreams():
+    upstream_overrides.clear()
+
+# Accepts a URL and returns the URL to actually send the request to, and the Host header to send with it
+# The Host header is None if the host's requests aren't being sent anywhere else
+def resolve_upstream(url):
+    parts = urlsplit(url)
+    base_url = upstream_overrides.get(parts.hostname)
+    if base_url is None:
+        return url, None
+    return base_url+parts.path+("?"+parts.query if parts.query else ""), parts.netloc
 
 # Call back if the server responds with an HTTP error code
 assert_status_hook = lambda response, *args, **kwargs: response.raise_for_status()
-http_client.hooks["response"] = [assert_status_hook]
 
 # Extend the HTTP adapter so that it provides a default timeout that you can override when constructing the client
+# Inside a deadline (see deadline.py), the timeout is cut down to the time that's left, and once it's up, requests
+# fail with DeadlineExceeded instead of being sent
 class TimeoutHTTPAdapter(HTTPAdapter):
     def __init__(self, *args, **kwargs):
         self.timeout = DEFAULT_TIMEOUT
@@ -36,9 +86,197 @@ class TimeoutHTTPAdapter(HTTPAdapter):
     def send(self, request, **kwargs):
         timeout = kwargs.get("timeout")
         if timeout is None:
-            kwargs["timeout"] = self.timeout
-        return super().send(request, **kwargs)
+            timeout = self.timeout
+        deadline.check()
+        kwargs["timeout"] = deadline.limit_timeout(timeout)
+        upstream_url, host = resolve_upstream(request.url)
+        if host is None:
+            return super().send(request, **kwargs)
+
+        # Send a copy to wherever the host's requests are going, and make the response look like it came from the host
+        upstream_request = request.copy()
+        upstream_request.url = upstream_url
+        upstream_request.headers["Host"] = host
+        response = super().send(upstream_request, **kwargs)
+        response.url = request.url
+        response.request = request
+        return response
+
+# Extend the timeout adapter so that it keeps to each host's rate and concurrency limits (see rate_limit.py)
+# Retries happen inside the adapter, so a request keeps its slot while it's retried
+# Inside a deadline, a request only waits for a slot until the deadline, and one that fails because the deadline passed
+# doesn't count against the host
+class ThrottledHTTPAdapter(TimeoutHTTPAdapter):
+    def send(self, request, **kwargs):
+        limiter = get_host_limiter(urlsplit(request.url).hostname)
+        if limiter is None:
+            return super().send(request, **kwargs)
+        deadline.check()
+        started = limiter.acquire(deadline.remaining())
+        if started is None:
+            raise DeadlineExceeded("The deadline would pass before the request got a slot")
+        response = None
+        try:
+            response = super().send(request, **kwargs)
+            return response
+        finally:
+            if response is None and deadline.passed():
+                limiter.give_back()
+            else:
+                limiter.release(started, response)
+
+# Extend the throttled adapter so that requests to a host that keeps failing fail straight away, with a
+# CircuitOpenError, instead of waiting for a slot and a timeout (see circuit_breaker.py)
+# A request counts as failed once its retries are used up, unless it failed because of the deadline: it passed, or the
+# request gave up waiting for a slot that wouldn't come before it did
+class CircuitBreakingHTTPAdapter(ThrottledHTTPAdapter):
+    def send(self, request, **kwargs):
+        breaker = get_breaker(urlsplit(request.url).hostname)
+        trial = breaker.allow()
+        response = None
+        gave_up = False
+        try:
+            response = super().send(request, **kwargs)
+            return response
+        except requests.exceptions.RequestException as e:
+            gave_up = deadline.cut_short(e)
+            raise
+        finally:
+            failed = is_failure(response)
+            breaker.record(None if gave_up or (failed and deadline.passed()) else failed, trial)
+
+# Extend the circuit breaking adapter so that slow requests to hosts that are hedged get sent a second time, and the
+# first good response wins (see hedging.py)
+# Each copy of the request keeps to the host's limits and circuit breaker on its own
+# Hedging is off until it's turned on with enable_hedging in hedging.py
+class HedgingHTTPAdapter(CircuitBreakingHTTPAdapter):
+    def send(self, request, **kwargs):
+        hedger = get_hedger(urlsplit(request.url).hostname)
+        if hedger is None or kwargs.get("stream") or request.method not in HEDGE_METHODS:
+            return super().send(request, **kwargs)
+        return hedger.send(super().send, request, **kwargs)
+
+# Extend the hedging adapter so that it answers from the response cache when it can, and stores what the server says
+# Cached responses don't count against a host's limits, and are still served while its circuit breaker is open or
+# after the deadline has passed
+# Caching is off until it's turned on with enable_cache in http_cache.py
+class CachingHTTPAdapter(HedgingHTTPAdapter):
+    def send(self, request, **kwargs):
+        cache = get_cache()
+        if cache is None:
+            return super().send(request, **kwargs)
+        response = cache.lookup(request)
+        if response is not None:
+            response.connection = self
+            return response
+        response = super().send(request, **kwargs)
+        cache.store(request, response)
+        return response
+
+# Extend the caching adapter so that it records every call in the stats (see stats.py): how long it took, how many
+# bytes came back, how many times it was retried, whether it came from the cache and whether it was short circuited,
+# i.e. not sent because the host's circuit breaker was open or the deadline had passed
+class InstrumentedHTTPAdapter(CachingHTTPAdapter):
+    def send(self, request, **kwargs):
+        started = time.perf_counter()
+        response = None
+        short_circuited = False
+        try:
+            response = super().send(request, **kwargs)
+            return response
+        except (CircuitOpenError, DeadlineExceeded):
+            short_circuited = True
+            raise
+        finally:
+            if response is None:
+                record_request(request.url, time.perf_counter() - started, 0, failed=True, short_circuited=short_circuited)
+            else:
+                retries = response.raw.retries if response.raw is not None and getattr(response.raw, "retries", None) else None
+                record_request(request.url, time.perf_counter() - started, len(response.content),
+                               retries=len(retries.history) if retries else 0,
+                               from_cache=getattr(response, "from_cache", False),
+                               failed=response.status_code >= 400)
+
+# Identical requests in flight at the same time from any client, so they can share one call (see coalesce.py)
+flights = SingleFlight()
+
+# Extend the instrumented adapter so that identical requests sent at the same time share one call
+# Only the first of them is sent (and recorded in the stats as usual); the rest wait for its response, and are recorded
+# as coalesced, or as failed if it fails. Each of them gets its own copy of the response object, sharing the content.
+# The rest only wait until their own deadline, and send the request themselves if the first one's deadline cut it short.
+class CoalescingHTTPAdapter(InstrumentedHTTPAdapter):
+    def send(self, request, **kwargs):
+        if kwargs.get("stream") or not coalescable(request.method, request.headers):
+            return super().send(request, **kwargs)
+        started = time.perf_counter()
+        key = request_key(request.method, request.url, request.body, request.headers)
+        leader = []
+
+        # Send the request, noting that this thread sent it rather than waiting for another one
+        def send():
+            leader.append(True)
+            return super(CoalescingHTTPAdapter, self).send(request, **kwargs)
+
+        try:
+            response, shared = flights.do(key, send)
+        except requests.exceptions.RequestException as e:
+            if not leader:
+                record_request(request.url, time.perf_counter() - started, 0, failed=True, coalesced=True, short_circuited=isinstance(e, (CircuitOpenError, DeadlineExceeded)))
+            raise
+        if not shared:
+            return response
+        record_request(request.url, time.perf_counter() - started, len(response.content), coalesced=True)
+        copy = requests.Response()
+        copy.__dict__.update(response.__dict__)
+        copy.request = request
+        return copy
+
+# A cookie policy that refuses every cookie
+class NoCookiesPolicy(http.cookiejar.DefaultCookiePolicy):
+    def set_ok(self, cookie, request):
+        return False
+
+# Accepts a pool size and returns a set of extended adapters with the retry strategy, ready to mount on a session
+# Each adapter keeps up to pool_size connections open to each of POOL_HOSTS hosts, and never drops a connection
+# because its pool is full
+def create_adapters(pool_size=DEFAULT_POOL_SIZE):
+    adapters = collections.OrderedDict()
+    adapters["https://"] = CoalescingHTTPAdapter(max_retries=retries, pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+    adapters["http://"] = CoalescingHTTPAdapter(max_retries=retries, pool_connections=POOL_HOSTS, pool_maxsize=pool_size)
+    return adapters
+
+# The adapters every client with the same pool size shares, keyed by pool size, so their connections stay alive
+# between properties
+shared_adapters = {}
+shared_adapters_lock = threading.Lock()
+
+# Accepts a pool size and returns the shared adapters for it, creating them the first time they're asked for
+def get_adapters(pool_size=DEFAULT_POOL_SIZE):
+    with shared_adapters_lock:
+        if pool_size not in shared_adapters:
+            shared_adapters[pool_size] = create_adapters(pool_size)
+        return shared_adapters[pool_size]
+
+# Creates a custom requests object with the error hook, and the extended adaptors with the retry strategy mounted for
+# all requests
+# Without adapters, the session shares the default shared adapters, just like a client from create_client
+# Pass another session's adapters to share its connection pools, retries and any adapters mounted on it later
+# Pass keep_cookies=False for a session that never stores cookies, so that threads can share it and pass their own
+# cookies along in the request headers
+def create_session(adapters=None, keep_cookies=True):
+    session = requests.Session()
+    session.hooks["response"] = [assert_status_hook]
+    session.adapters = get_adapters() if adapters is None else adapters
+    if not keep_cookies:
+        session.cookies.set_policy(NoCookiesPolicy())
+    return session
+
+# Accepts a concurrency level and returns a new client with its own cookie jar, whose connection pools are big
+# enough for that many requests to each host at once
+# Every client with the same pool size shares the same connections, so creating one is cheap and doesn't mean new
+# TLS handshakes. Never close a client you've created, since that would close the shared connections too.
+def create_client(concurrency=1, keep_cookies=True):
+    return create_session(get_adapters(max(DEFAULT_POOL_SIZE, concurrency)), keep_cookies)
 
-# Mount the extended timeout adaptor with the retry strategy for all requests
-http_client.mount("https://", TimeoutHTTPAdapter(max_retries=retries))
-http_client.mount("http://", TimeoutHTTPAdapter(max_retries=retries))
\ No newline at end of file
+# Create the shared requests object
+http_client = create_client()
\ No newline at end of file
@@ -1,6 +1,10 @@
 import logging
+import logging.handlers
 from pythonjsonlogger import jsonlogger
-import datetime
+import atexit
+import queue
+import threading
+import time
 
 
 # Set the logging level to one of the following:
@@ -12,33 +16,158 @@ import datetime
     # CRITICAL = 50
 LOG_LEVEL = 10
 
+# Set the file to log to
+LOG_FILE = "localsoup.log"
 
-# Configure the format of JSON logs 
+# Set how big the log file can get before it's rotated, and how many rotated files to keep
+# (localsoup.log.1, localsoup.log.2, etc.), so a long crawl can't fill the disk
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# Set the most log records to write in one go before the file is flushed
+LOG_BATCH_SIZE = 500
+
+
+# Configure the format of JSON logs
+# The timestamp comes from the time the record was created, and the part up to the second is only formatted once
+# per second
 class CustomJsonFormatter(jsonlogger.JsonFormatter):
+    def __init__(self, *args, **kwargs):
+        super(CustomJsonFormatter, self).__init__(*args, **kwargs)
+        self.second = None
+        self.second_text = None
+
     def add_fields(self, log_record, record, message_dict):
         super(CustomJsonFormatter, self).add_fields(log_record, record, message_dict)
         if not log_record.get('timestamp'):
-            # this doesn't use record.created, so it is slightly off
-            now = datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
-            log_record['timestamp'] = now
+            log_record['timestamp'] = self.utc_timestamp(record.created)
         if log_record.get('level'
             ):
             log_record['level'] = log_record['level'].upper()
         else:
             log_record['level'] = record.levelname
 
+    # Accepts a time in seconds since the epoch and returns it as e.g. 2019-01-31T12:00:00.000000Z
+    def utc_timestamp(self, created):
+        second = int(created)
+        if second != self.second:
+            self.second_text = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self.second = second
+        return self.second_text+".%06dZ" % int((created - second) * 1000000)
+
+
+# A rotating log file that only flushes once per batch of records, instead of after every record
+class BatchedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+
+    # Keeps track of the size of the file ourselves, because asking the file for its position flushes it
+    def _open(self):
+        stream = super(BatchedRotatingFileHandler, self)._open()
+        self.size = stream.seek(0, 2)
+        return stream
+
+    # Formats the record once, rotates the file if the record would take it past LOG_MAX_BYTES, and writes it
+    # The size counts characters rather than bytes, which is close enough for a size cap
+    def emit(self, record):
+        try:
+            message = self.format(record)+self.terminator
+            if self.stream is None:
+                self.stream = self._open()
+            if self.maxBytes > 0 and self.size + len(message) >= self.maxBytes:
+                self.doRollover()
+                if self.stream is None:
+                    self.stream = self._open()
+            self.stream.write(message)
+            self.size = self.size + len(message)
+        except Exception:
+            self.handleError(record)
+
+    # The writer flushes after each batch instead
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super(BatchedRotatingFileHandler, self).flush()
+
 
-# Log as JSON to a local file
-logHandler = logging.FileHandler("localsoup.log")
+# Puts log records on a queue for the writer thread, without formatting them
+# Records are formatted when they're written, so the logging call itself costs next to nothing. Anything passed
+# as a message argument is formatted later, so don't change it after logging it.
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+# Takes log records off the queue on a background thread and writes them to the log file in batches
+class LogWriter:
+    def __init__(self, log_queue, handler):
+        self.queue = log_queue
+        self.handler = handler
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="localsoup-log-writer", daemon=True)
+                self.thread.start()
+
+    # Waits for a record, then writes it along with everything else that's waiting, up to LOG_BATCH_SIZE records
+    # Stops once it gets None
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is not None:
+                    self.handler.handle(record)
+            self.handler.flush_batch()
+            if None in batch:
+                return
+
+    # Writes out everything that's been logged so far and stops the writer thread
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+
+
+# Log as JSON to a local file, rotating it once it gets too big
+logHandler = BatchedRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
 formatter = CustomJsonFormatter('%(timestamp)s %(level)s %(name)s %(message)s')
 logHandler.setFormatter(formatter)
 
+# Hand records to a background thread, so logging never waits on the disk
+logQueue = queue.SimpleQueue()
+queueHandler = LazyQueueHandler(logQueue)
+logWriter = LogWriter(logQueue, logHandler)
+logWriter.start()
+
+# Write out whatever's still on the queue when the program exits
+atexit.register(logWriter.stop)
+
+# Accepts a file path and writes the log there from now on, rotating it the same way
+# Use it to give each worker process its own log file, since processes can't share one
+def set_log_file(path):
+    global logHandler
+    logWriter.stop()
+    logHandler.close()
+    logHandler = BatchedRotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8")
+    logHandler.setFormatter(formatter)
+    logWriter.handler = logHandler
+    logWriter.start()
+
 # Create a logger for data-related events, e.g. no matching data from website
 logger = logging.getLogger(__name__)
-logger.addHandler(logHandler)
+logger.addHandler(queueHandler)
 logger.setLevel(LOG_LEVEL)
 
 # Create a logger for HTTP events, e.g. 403 or 500 errors
 httpLogger = logging.getLogger('urllib3')
-httpLogger.addHandler(logHandler)
+httpLogger.addHandler(queueHandler)
 httpLogger.setLevel(LOG_LEVEL)
\ No newline at end of file
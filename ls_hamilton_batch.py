@@ -0,0 +1,198 @@
+import ls_hamilton_property_class
+import ls_hamilton_spatial_index
+import ls_hamilton_street_index
+from application.core.utils import http_cache
+from application.core.utils.stats import process_stats
+from application.core.utils.logger import logger
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import argparse
+import csv
+import json
+import os
+
+
+# Builds property records for a whole file of addresses and streams them to an NDJSON file, one record per line
+#
+# Run it from the command line like this:
+#   python ls_hamilton_batch.py addresses.csv properties.ndjson --workers 16
+#
+# The input can be a CSV file with a header row of address attributes (street_number, street_name, etc.), or a
+# JSONL file with one address object per line. Add --geocode-batch to geocode the addresses in batches instead of
+# one at a time, and --spatial-index with a snapshot from ls_hamilton_spatial_index.py to look up ward, zoning and
+# temp use data locally. Add --cache to keep responses in an on-disk cache, so running the batch again only asks the
+# city's servers for what's gone stale. Add --stats or --prometheus to save how long each stage took and how many
+# requests went to each server. Add --street-index with a file path to find roll numbers a whole street at a time (see
+# ls_hamilton_street_index.py), keeping what's found in that file for next time. Progress is checkpointed as records are written, so if a run stops part way through, running the
+# same command again picks up where it left off.
+
+
+# Set how many properties are built at once
+DEFAULT_WORKERS = 8
+
+# Set how many finished records to write between forcing the output and checkpoint files to disk
+SYNC_EVERY = 100
+
+
+# Accepts the path to a CSV or JSONL file of addresses and yields (line index, address object) pairs
+# Reads one line at a time, so the file can be as big as you like
+def read_addresses(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        if path.lower().endswith(".csv"):
+
+            # Leave out empty CSV cells so the address only has the attributes that were filled in
+            for index, row in enumerate(csv.DictReader(f)):
+                yield index, {key: value.strip() for key, value in row.items() if key and value and value.strip()}
+        else:
+            for index, line in enumerate(f):
+                if line.strip():
+                    yield index, json.loads(line)
+
+
+# Accepts the path to a checkpoint file and returns the set of line indexes that have already been written
+def read_checkpoint(path):
+    done = set()
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    done.add(int(line))
+    return done
+
+
+# Accepts an iterable of (line index, address object) pairs and yields lists of up to size pairs at a time
+def read_chunks(addresses, size):
+    chunk = []
+    for item in addresses:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Accepts an address object and returns its property record as a plain dict
+# Optionally accepts the address's location object, if it's already been geocoded, a spatial index, the list of
+# fields to include in the record, and a street index
+def build_record(address, concurrency, location=None, spatial_index=None, fields=None, street_index=None):
+    return ls_hamilton_property_class.ls_hamilton_property(address=address, concurrency=concurrency, location=location, spatial_index=spatial_index, fields=fields, street_index=street_index).to_dict()
+
+
+# Accepts a list of fields, or None for all of them, and returns True if building them means geocoding the address
+def needs_location(fields):
+    if fields is None:
+        return True
+    return any(field == 'location' or 'location' in ls_hamilton_property_class.FIELD_DEPENDENCIES.get(field, ()) for field in fields)
+
+
+# Builds property records for every address in the input file and appends them to the output file
+# Only a bounded number of properties are in flight at once, and each record is written and forgotten as soon as
+# it's done, so memory stays flat no matter how big the input is.
+# The checkpoint file records the input line of every record that's been written. A record is always written to
+# the output before it's checkpointed, so if a run dies at exactly the wrong moment, the last record or two can
+# show up twice in the output after resuming, but none will be missing.
+# If geocode_batch is True, addresses are geocoded LOCATION_BATCH_SIZE at a time before they're built.
+# If a spatial index is given, ward, zoning and temp use are looked up in it instead of the map services.
+# If a list of fields is given, the records only include those fields (and the address), and nothing else is looked up.
+# Unknown fields raise a ValueError before any addresses are read.
+# If a street index is given, roll numbers are found a street at a time, and each chunk's streets are searched before
+# its addresses are built.
+# Returns the number of records written and the number of addresses that failed.
+def run_batch(input_path, output_path, checkpoint_path=None, workers=DEFAULT_WORKERS, concurrency=1, geocode_batch=False, spatial_index=None, fields=None, street_index=None):
+    ls_hamilton_property_class.ls_hamilton_property.check_fields(fields)
+    if checkpoint_path is None:
+        checkpoint_path = output_path+".checkpoint"
+    done = read_checkpoint(checkpoint_path)
+    if done:
+        logger.info("Resuming batch from %s with %s records already written", checkpoint_path, len(done))
+
+    written = 0
+    failed = 0
+
+    with open(output_path, "a", encoding="utf-8") as output, open(checkpoint_path, "a", encoding="utf-8") as checkpoint, ThreadPoolExecutor(max_workers=workers) as executor:
+
+        # Writes out whatever has finished
+        def write_finished(finished):
+            nonlocal written, failed
+            for future in finished:
+                index, address = in_flight.pop(future)
+                try:
+                    record = future.result()
+                except Exception as e:
+                    logger.error("Couldn't build a property record for line %s %s: %r", index, json.dumps(address), e)
+                    failed = failed + 1
+                    continue
+                output.write(json.dumps(record)+"\n")
+                output.flush()
+                checkpoint.write(str(index)+"\n")
+                checkpoint.flush()
+                written = written + 1
+                if written % SYNC_EVERY == 0:
+                    os.fsync(output.fileno())
+                    os.fsync(checkpoint.fileno())
+                    logger.info("Batch has written %s records", written)
+
+        # Keep the pool busy, but don't read further ahead than we have to
+        in_flight = {}
+        addresses = ((index, address) for index, address in read_addresses(input_path) if index not in done)
+        for chunk in read_chunks(addresses, ls_hamilton_property_class.LOCATION_BATCH_SIZE if geocode_batch or street_index is not None else 1):
+
+            # Search the chunk's streets all at once if we're using a street index, and the records need taxes
+            if street_index is not None and (fields is None or 'taxes' in fields):
+                street_index.prefetch([address for index, address in chunk])
+
+            # Geocode the whole chunk in one go if we've been asked to, and the records need locations
+            if geocode_batch and needs_location(fields):
+                locations = ls_hamilton_property_class.ls_hamilton_property.get_locations([address for index, address in chunk])
+            else:
+                locations = [None] * len(chunk)
+
+            for (index, address), location in zip(chunk, locations):
+                if len(in_flight) >= workers * 2:
+                    finished, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+                    write_finished(finished)
+                in_flight[executor.submit(build_record, address, concurrency, location, spatial_index, fields, street_index)] = (index, address)
+
+        # Wait for the stragglers
+        while in_flight:
+            finished, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+            write_finished(finished)
+
+    logger.info("Batch finished with %s records written and %s failed", written, failed)
+    process_stats.log("Batch stats")
+    return written, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build Hamilton property records for a file of addresses")
+    parser.add_argument("input", help="CSV or JSONL file of address objects")
+    parser.add_argument("output", help="NDJSON file to append property records to")
+    parser.add_argument("--checkpoint", help="checkpoint file (defaults to the output file plus .checkpoint)")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="how many properties to build at once")
+    parser.add_argument("--concurrency", type=int, default=ls_hamilton_property_class.DEFAULT_CONCURRENCY, help="how many requests each property can have in flight")
+    parser.add_argument("--geocode-batch", action="store_true", help="geocode addresses in batches instead of one at a time")
+    parser.add_argument("--spatial-index", help="spatial index snapshot to look up ward, zoning and temp use data in")
+    parser.add_argument("--fields", help="comma-separated list of the fields to include, e.g. ward,zoning (defaults to all of them)")
+    parser.add_argument("--cache", help="response cache database to read from and write to")
+    parser.add_argument("--cache-mode", choices=http_cache.CACHE_MODES, default="use", help="use the cache, refresh everything in it, or bypass it")
+    parser.add_argument("--street-index", help="street index file to find roll numbers in a street at a time, created if it doesn't exist yet")
+    parser.add_argument("--stats", help="JSON file to write per-stage and per-host stats to when the batch finishes")
+    parser.add_argument("--prometheus", help="file to write the same stats to in the Prometheus text format")
+    args = parser.parse_args()
+    fields = [field.strip() for field in args.fields.split(",")] if args.fields else None
+    ls_hamilton_property_class.ls_hamilton_property.check_fields(fields)
+    if args.cache:
+        http_cache.enable_cache(args.cache, mode=args.cache_mode)
+    spatial_index = ls_hamilton_spatial_index.load(args.spatial_index) if args.spatial_index else None
+    street_index = ls_hamilton_street_index.load(args.street_index) if args.street_index else None
+    try:
+        written, failed = run_batch(args.input, args.output, args.checkpoint, args.workers, args.concurrency, args.geocode_batch, spatial_index, fields, street_index)
+    finally:
+        if street_index is not None:
+            street_index.save(args.street_index)
+    if args.stats:
+        with open(args.stats, "w", encoding="utf-8") as f:
+            json.dump(process_stats.to_dict(), f, indent=2)
+    if args.prometheus:
+        process_stats.write_prometheus(args.prometheus)
+    print("Wrote "+str(written)+" records, "+str(failed)+" failed")
@@ -0,0 +1,176 @@
+import ls_hamilton_property_class
+import ls_hamilton_replay
+from application.core.utils import rate_limit
+from application.core.utils.async_http_client import close_async_http_client
+from application.core.utils.stats import add_stage_hook, remove_stage_hook, process_stats
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import json
+import threading
+import time
+import numpy
+
+
+# Measures how fast the class builds properties, without touching the network, by playing back a recording of the
+# city's servers from a local replay server (see ls_hamilton_replay.py)
+#
+# Record some addresses once, then benchmark against the recording as often as you like:
+#   python ls_hamilton_replay.py addresses.jsonl recording.jsonl
+#   python ls_hamilton_benchmark.py recording.jsonl --mode workers --workers 8 --latency 0.2 --jitter 0.05
+#
+# It reports properties per second, requests per property, and the 50th, 95th and 99th percentile time of every
+# stage (see stats.py) and of whole properties. Add --json to save the results, to compare runs over time.
+#
+# The modes are:
+#   sequential  one property at a time, one request at a time
+#   concurrent  one property at a time, each built on a thread pool (--concurrency)
+#   workers     --workers properties at a time, each built on a thread pool (--concurrency)
+#   async       --workers properties at a time on one event loop
+
+# The ways the benchmark can build the properties
+MODES = ("sequential", "concurrent", "workers", "async")
+
+# Set how many times to build the recorded addresses
+DEFAULT_REPEAT = 3
+
+# Set how many properties to build at once in the workers and async modes
+DEFAULT_WORKERS = 8
+
+# The percentiles to report for each stage
+PERCENTILES = (50, 95, 99)
+
+
+# Collects how long every run of every stage took, through a stage hook
+class StageTimes:
+    def __init__(self):
+        self.times = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stage, event, seconds):
+        if event == "end":
+            self.add(stage, seconds)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.times.setdefault(stage, []).append(seconds)
+
+    # Returns the number of runs and the PERCENTILES of each stage, in milliseconds
+    def summary(self):
+        with self.lock:
+            summary = {}
+            for stage, times in sorted(self.times.items()):
+                values = numpy.percentile(times, PERCENTILES) * 1000
+                summary[stage] = dict({'calls': len(times)}, **{"p"+str(percentile): round(float(value), 2) for percentile, value in zip(PERCENTILES, values)})
+            return summary
+
+
+# Accepts an address object, the mode and the concurrency, builds the property, and records how long it took
+def build_property(address, mode, concurrency, stage_times):
+    started = time.perf_counter()
+    ls_hamilton_property_class.ls_hamilton_property(address=dict(address), concurrency=1 if mode == "sequential" else concurrency)
+    stage_times.add("property", time.perf_counter() - started)
+
+
+# Builds all of the addresses on one event loop, up to workers at a time
+async def build_async(addresses, workers, stage_times):
+    semaphore = asyncio.Semaphore(workers)
+
+    async def build(address):
+        async with semaphore:
+            started = time.perf_counter()
+            await ls_hamilton_property_class.ls_hamilton_property.create(address=dict(address))
+            stage_times.add("property", time.perf_counter() - started)
+
+    try:
+        await asyncio.gather(*[build(address) for address in addresses])
+    finally:
+        await close_async_http_client()
+
+
+# Accepts a list of address objects and builds them all in the given mode
+def build_all(addresses, mode, concurrency, workers, stage_times):
+    if mode == "async":
+        asyncio.run(build_async(addresses, workers, stage_times))
+    elif mode == "workers":
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for future in [executor.submit(build_property, address, mode, concurrency, stage_times) for address in addresses]:
+                future.result()
+    else:
+        for address in addresses:
+            build_property(address, mode, concurrency, stage_times)
+
+
+# Builds every address in a recording repeat times against a replay server, and returns the results as a dict
+# Accepts the same latency, jitter, error and seed options as the replay server
+# Pass limits=False to take the per-host rate and concurrency limits off, and measure the class on its own
+def run_benchmark(recording_path, mode="sequential", repeat=DEFAULT_REPEAT, concurrency=ls_hamilton_property_class.DEFAULT_CONCURRENCY, workers=DEFAULT_WORKERS,
+                  latency=0, jitter=0, error_rate=0, seed=None, limits=True):
+    if mode not in MODES:
+        raise ValueError("Unknown benchmark mode: "+mode+". Choose from "+", ".join(MODES))
+    recording = ls_hamilton_replay.Recording.load(recording_path)
+    addresses = recording.addresses * repeat
+    if not limits:
+        for host in list(rate_limit.HOST_LIMITS):
+            rate_limit.set_host_limits(host, None)
+
+    stage_times = StageTimes()
+    server = ls_hamilton_replay.start_replay(recording, latency, jitter, error_rate, seed=seed)
+    add_stage_hook(stage_times)
+    requests_before = process_stats.request_count()
+    started = time.perf_counter()
+    try:
+        build_all(addresses, mode, concurrency, workers, stage_times)
+    finally:
+        seconds = time.perf_counter() - started
+        remove_stage_hook(stage_times)
+        ls_hamilton_replay.stop_replay(server)
+
+    return {
+        'mode': mode,
+        'concurrency': concurrency,
+        'workers': workers,
+        'latency': latency,
+        'jitter': jitter,
+        'error_rate': error_rate,
+        'limits': limits,
+        'properties': len(addresses),
+        'seconds': round(seconds, 3),
+        'properties_per_second': round(len(addresses) / seconds, 2),
+        'requests_per_property': round((process_stats.request_count() - requests_before) / max(len(addresses), 1), 2),
+        'replay': dict(server.counts),
+        'stages': stage_times.summary()
+    }
+
+
+# Prints the results of run_benchmark as a table
+def print_results(results):
+    print("Mode: "+results['mode']+", "+str(results['properties'])+" properties in "+str(results['seconds'])+"s")
+    print("Properties per second: "+str(results['properties_per_second']))
+    print("Requests per property: "+str(results['requests_per_property']))
+    print("Replayed "+str(results['replay']['replayed'])+" responses, injected "+str(results['replay']['errors'])+" errors, "+str(results['replay']['unmatched'])+" requests weren't in the recording")
+    print("")
+    print("%-22s %8s %10s %10s %10s" % (("stage", "calls")+tuple("p"+str(percentile)+" ms" for percentile in PERCENTILES)))
+    for stage, summary in results['stages'].items():
+        print("%-22s %8d %10.2f %10.2f %10.2f" % ((stage, summary['calls'])+tuple(summary["p"+str(percentile)] for percentile in PERCENTILES)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark building properties against a recording of the city's servers")
+    parser.add_argument("recording", help="recording made with ls_hamilton_replay.py")
+    parser.add_argument("--mode", choices=MODES, default="sequential", help="how to build the properties")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="how many times to build the recorded addresses")
+    parser.add_argument("--concurrency", type=int, default=ls_hamilton_property_class.DEFAULT_CONCURRENCY, help="how many requests each property can have in flight")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="how many properties to build at once in the workers and async modes")
+    parser.add_argument("--latency", type=float, default=0, help="seconds the replay server holds back each response")
+    parser.add_argument("--jitter", type=float, default=0, help="seconds the latency can be off by, either way")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of responses to replace with an error, from 0 to 1")
+    parser.add_argument("--seed", type=int, help="random seed for the jitter and errors, to make runs repeatable")
+    parser.add_argument("--no-limits", action="store_true", help="take the per-host rate and concurrency limits off")
+    parser.add_argument("--json", help="file to save the results to")
+    args = parser.parse_args()
+    results = run_benchmark(args.recording, args.mode, args.repeat, args.concurrency, args.workers, args.latency, args.jitter, args.error_rate, args.seed, not args.no_limits)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
\ No newline at end of file
@@ -0,0 +1,280 @@
+from ls_hamilton_property_class import COMMUNITIES, ls_hamilton_property
+from ls_hamilton_batch import read_addresses, build_record
+from ls_hamilton_street_index import StreetIndex
+from application.core.utils import http_cache
+from application.core.utils.http_client import upstream_overrides, set_upstream
+from application.core.utils.logger import logger, set_log_file, LOG_FILE
+from application.core.utils.rate_limit import divide_host_limits
+from application.core.utils.stats import process_stats
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import time
+
+
+# Crawls every property in one or more of Hamilton's communities, on several processes at once
+#
+# The property inquiry application lists every property on a street if you search for the street without a street
+# number (see ls_hamilton_street_index.py), so a crawl starts from a file of streets, e.g. from the city's road
+# network open data, as a CSV or JSONL file of address objects without street numbers:
+#   street_name,street_type_short,street_type_long,street_direction_short,street_direction_long,city
+#   Tisdale,St,Street,S,South,Hamilton
+#
+# Each street is a unit of work. The streets go into a work queue (a SQLite database next to the output), and worker
+# processes take them one at a time, search each street for its properties, build them on a few threads, and write
+# the records to their own shard of the output. Reading the city's pages takes a lot of CPU, so separate processes
+# get a lot more done than threads alone. The workers share the response cache on disk, and divide the per-host rate
+# limits between them (see rate_limit.py), so together they don't ask the city's servers for more than one process
+# would. Once every street is done, the shards are merged into one NDJSON file, sorted by street and street number.
+#
+#   python ls_hamilton_crawl.py streets.csv properties.ndjson --community ham010081 --processes 8
+#
+# If a crawl stops part way through, run the same command again. Streets that are done aren't crawled again, and
+# streets that failed or were in progress are.
+
+# Set how many worker processes to crawl with
+DEFAULT_PROCESSES = os.cpu_count() or 4
+
+# Set how many properties each worker process builds at once
+DEFAULT_THREADS = 8
+
+# The states a street can be in, in the work queue
+STREET_STATES = ("pending", "running", "done", "failed")
+
+# Matches the number and the rest of a street number, e.g. 17 and A in 17A
+STREET_NUMBER = re.compile(r"(\d*)(.*)")
+
+
+# A queue of streets to crawl, shared by every worker process through a SQLite database
+# Each process opens its own connection to the same file
+class WorkQueue:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS streets (key TEXT PRIMARY KEY, street TEXT, state TEXT, worker INTEGER, records INTEGER, updated REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS streets_state ON streets (state)")
+
+    # Accepts a dict of street keys and street address objects, and adds the streets that aren't in the queue yet
+    def add(self, streets):
+        now = time.time()
+        self.connection.execute("BEGIN IMMEDIATE")
+        self.connection.executemany("INSERT OR IGNORE INTO streets VALUES (?, ?, 'pending', NULL, 0, ?)", [(key, json.dumps(street), now) for key, street in streets.items()])
+        self.connection.execute("COMMIT")
+
+    # Puts streets that failed, or were taken by a worker that never finished them, back in the queue
+    def reset(self):
+        self.connection.execute("UPDATE streets SET state = 'pending', worker = NULL WHERE state IN ('running', 'failed')")
+
+    # Accepts a worker number and takes the next street for it
+    # Returns the street's key and address object, or None if there are no streets left
+    def claim(self, worker):
+        self.connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.connection.execute("SELECT key, street FROM streets WHERE state = 'pending' ORDER BY key LIMIT 1").fetchone()
+            if row is not None:
+                self.connection.execute("UPDATE streets SET state = 'running', worker = ?, updated = ? WHERE key = ?", (worker, time.time(), row[0]))
+        finally:
+            self.connection.execute("COMMIT")
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    # Accepts a street key and the number of records written for it, and marks the street done
+    def finish(self, key, records):
+        self.connection.execute("UPDATE streets SET state = 'done', records = ?, updated = ? WHERE key = ?", (records, time.time(), key))
+
+    # Accepts a street key and marks the street failed, so the next crawl tries it again
+    def fail(self, key):
+        self.connection.execute("UPDATE streets SET state = 'failed', updated = ? WHERE key = ?", (time.time(), key))
+
+    # Returns the number of streets in each state, and the number of records written
+    def counts(self):
+        counts = dict.fromkeys(STREET_STATES, 0)
+        counts.update(self.connection.execute("SELECT state, COUNT(*) FROM streets GROUP BY state").fetchall())
+        counts['records'] = self.connection.execute("SELECT COALESCE(SUM(records), 0) FROM streets").fetchone()[0]
+        return counts
+
+    def close(self):
+        self.connection.close()
+
+
+# Accepts the path to a crawl's output file and returns the path of its work queue
+def work_path(output_path):
+    return output_path+".work"
+
+
+# Accepts the path to a crawl's output file and a worker number, and returns the path of the worker's shard
+def shard_path(output_path, worker):
+    return output_path+".shard-"+str(worker)
+
+
+# Accepts a street number and returns a key that sorts street numbers in numeric order, e.g. 9 before 17 before 17A
+def street_number_key(street_number):
+    number, rest = STREET_NUMBER.match(str(street_number)).groups()
+    return (int(number) if number else 0, rest)
+
+
+# Accepts the path to a CSV or JSONL file of address objects, and a list of community codes (or None for all of
+# them), and returns a dict of street keys and address objects, one for every street in those communities
+# Any street numbers in the file are left out, so a file of addresses works too
+def read_streets(path, communities=None):
+    prop = ls_hamilton_property(lazy=True)
+    index = StreetIndex()
+    streets = {}
+    for line, address in read_addresses(path):
+        street = {key: value for key, value in address.items() if key != 'street_number'}
+        if communities is None or prop.community(street) in communities:
+            streets.setdefault(index.street_key(prop, street), street)
+    return streets
+
+
+# Accepts a street address object, a street index, a property object and a thread pool, and returns the records of
+# every property on the street, in street number order, or None if the street couldn't be searched
+# The street's addresses are geocoded in batches, and their roll numbers come from the street search
+def crawl_street(street, street_index, prop, executor):
+    numbers = street_index.street_numbers(prop, street)
+    if numbers is None:
+        return None
+    addresses = [dict(street, street_number=number) for number in sorted(numbers, key=street_number_key)]
+    locations = ls_hamilton_property.get_locations(addresses) if addresses else []
+    futures = [executor.submit(build_record, address, 1, location, None, None, street_index) for address, location in zip(addresses, locations)]
+    return [future.result() for future in futures]
+
+
+# Takes streets off the work queue until there are none left, and writes their records to the worker's shard
+# Runs in its own process, so it sets up its own log file, response cache, share of the rate limits and upstreams
+def crawl_worker(worker, output_path, processes, threads, cache, upstreams):
+    set_log_file(os.path.splitext(LOG_FILE)[0]+".crawl-"+str(worker)+".log")
+    if cache is not None:
+        http_cache.enable_cache(cache[0], mode=cache[1])
+    divide_host_limits(processes)
+    for host, base_url in upstreams.items():
+        set_upstream(host, base_url)
+
+    queue = WorkQueue(work_path(output_path))
+    street_index = StreetIndex()
+    prop = ls_hamilton_property(lazy=True)
+    streets = 0
+    with open(shard_path(output_path, worker), "a", encoding="utf-8") as output, ThreadPoolExecutor(max_workers=threads) as executor:
+        while True:
+            claimed = queue.claim(worker)
+            if claimed is None:
+                break
+            key, street = claimed
+            try:
+                records = crawl_street(street, street_index, prop, executor)
+            except Exception as e:
+                logger.error("Crawling %s failed: %s", key, e)
+                records = None
+            finally:
+                street_index.forget(key)
+            if records is None:
+                queue.fail(key)
+                continue
+
+            # Write the whole street before marking it done, so a street is never only half in the output
+            for record in records:
+                output.write(json.dumps(record)+"\n")
+            output.flush()
+            os.fsync(output.fileno())
+            queue.finish(key, len(records))
+            streets = streets + 1
+            logger.info("Crawled %s properties on %s", len(records), key)
+
+    queue.close()
+    logger.info("Crawl worker %s finished %s streets", worker, streets)
+    process_stats.log("Crawl worker stats")
+
+
+# Accepts a record and a property object, and returns the key the record is merged on: its street key and number
+def record_key(record, prop, street_index):
+    return (street_index.street_key(prop, record['address']), street_number_key(record['address']['street_number']))
+
+
+# Merges every shard of a crawl into the output file, sorted by street and street number, and deletes the shards
+# Records already in the output file, from an earlier run of the same crawl, are kept unless a shard has them too.
+# A street that was written more than once (because a worker stopped after writing it, but before marking it done)
+# only shows up once. Only the position of each record is kept in memory, not the record itself.
+# Returns the number of records written
+def merge(output_path):
+    prop = ls_hamilton_property(lazy=True)
+    street_index = StreetIndex()
+    shards = sorted(glob.glob(glob.escape(output_path)+".shard-*"))
+    sources = ([output_path] if os.path.exists(output_path) else []) + shards
+    positions = {}
+    for shard in sources:
+        with open(shard, "rb") as f:
+            offset = 0
+            for line in f:
+                if line.strip():
+                    positions[record_key(json.loads(line), prop, street_index)] = (shard, offset, len(line))
+                offset = offset + len(line)
+
+    files = {shard: open(shard, "rb") for shard in sources}
+    try:
+        with open(output_path+".tmp", "wb") as output:
+            for key in sorted(positions):
+                shard, offset, length = positions[key]
+                files[shard].seek(offset)
+                output.write(files[shard].read(length))
+        os.replace(output_path+".tmp", output_path)
+    finally:
+        for f in files.values():
+            f.close()
+    for shard in shards:
+        os.remove(shard)
+    logger.info("Merged %s records from %s shards into %s", len(positions), len(shards), output_path)
+    return len(positions)
+
+
+# Crawls every property on the streets in the streets file, in the given communities (or all of them), and writes the
+# records to the output file
+# Uses the response cache if it's turned on, and sends requests wherever this process is sending them (see
+# set_upstream in http_client.py)
+# Only merges the shards once every street is done; if some failed, run the crawl again to retry them
+# Returns the number of streets in each state, and the number of records written
+def crawl(streets_path, output_path, communities=None, processes=DEFAULT_PROCESSES, threads=DEFAULT_THREADS):
+    queue = WorkQueue(work_path(output_path))
+    queue.add(read_streets(streets_path, communities))
+    queue.reset()
+    counts = queue.counts()
+    logger.info("Crawling %s streets (%s done already) on %s processes", sum(counts[state] for state in STREET_STATES), counts['done'], processes)
+
+    cache = http_cache.get_cache()
+    cache = None if cache is None else (cache.path, cache.mode)
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=crawl_worker, args=(worker, output_path, processes, threads, cache, dict(upstream_overrides)), name="localsoup-crawl-"+str(worker))
+               for worker in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # Streets a worker was still on when it died go back in the queue for next time
+    queue.reset()
+    counts = queue.counts()
+    queue.close()
+    if counts['pending'] == 0:
+        counts['records'] = merge(output_path)
+    else:
+        logger.warning("%s streets weren't crawled, run the crawl again to retry them", counts['pending'])
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl every property on a list of Hamilton streets, on several processes")
+    parser.add_argument("streets", help="CSV or JSONL file of streets, as address objects without street numbers")
+    parser.add_argument("output", help="NDJSON file to write the property records to")
+    parser.add_argument("--community", action="append", choices=sorted(COMMUNITIES.values()), help="only crawl streets in this community; repeat for more than one")
+    parser.add_argument("--processes", type=int, default=DEFAULT_PROCESSES, help="how many worker processes to crawl with")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="how many properties each process builds at once")
+    parser.add_argument("--cache", default=http_cache.DEFAULT_CACHE_PATH, help="response cache file the processes share")
+    parser.add_argument("--cache-mode", choices=http_cache.CACHE_MODES, default="use", help="use the cache, refresh it, or bypass it")
+    args = parser.parse_args()
+    http_cache.enable_cache(args.cache, mode=args.cache_mode)
+    counts = crawl(args.streets, args.output, args.community, args.processes, args.threads)
+    print("Crawled "+str(counts['done'])+" streets and "+str(counts['records'])+" properties, "+str(counts['pending'])+" streets left to retry")
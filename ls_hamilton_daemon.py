@@ -0,0 +1,357 @@
+import ls_hamilton_property_class
+from ls_hamilton_property_class import ls_hamilton_property, eplans_sessions
+import ls_hamilton_spatial_index
+from ls_hamilton_street_index import StreetIndex
+from application.core.utils import http_cache
+from application.core.utils.circuit_breaker import breaker_states
+from application.core.utils.coalesce import SingleFlight
+from application.core.utils.hedging import enable_hedging, hedging_stats
+from application.core.utils.logger import logger, httpLogger
+from application.core.utils.stats import process_stats
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import argparse
+import collections
+import json
+import os
+import requests
+import signal
+import socketserver
+import threading
+import time
+
+
+# Keeps the class running in the background and answers property lookups over a local HTTP API, so other programs
+# don't pay for starting Python, importing everything, connecting to the city's servers and starting an Eplans
+# session every time they want a property
+#
+#   python ls_hamilton_daemon.py --port 8765
+#   python ls_hamilton_daemon.py --socket /tmp/localsoup.sock
+#
+# The daemon keeps its connections, Eplans sessions, street index and the records it's built in memory, so asking
+# for a property it's built recently takes milliseconds. It answers with JSON:
+#
+#   GET  /property?street_number=17&street_name=Discovery&street_type_short=DR&city=Hamilton
+#   POST /property     {"street_number": "17", "street_name": "Discovery", ...}
+#   POST /properties   {"addresses": [{...}, {...}]}
+#   GET  /stats
+#   GET  /health
+#
+# Any of them can ask for only some fields, with fields=ward,zoning in the query string or "fields": [...] in the body,
+# and for a record built from scratch instead of one from memory, with fresh=1 or "fresh": true.
+# /properties answers with {"records": [...]}, in the same order as the addresses, with {"error": ...} in place of
+# any that couldn't be built.
+#
+# Pass --deadline to answer every lookup within that many seconds, with whatever sections were finished by then (the
+# record's status lists the rest), and --hedge to hedge requests to the map services (see hedging.py).
+
+# Set the port the daemon listens on if you don't say otherwise
+DEFAULT_PORT = 8765
+
+# Set how many records the daemon keeps in memory, and how long it keeps them for
+MAX_RECORDS = 10000
+RECORD_MAX_AGE = 60 * 60 # seconds
+
+# Set how many properties the daemon builds at once for a /properties request
+BATCH_WORKERS = 8
+
+# Set the most addresses a single /properties request can ask for
+MAX_BATCH = 1000
+
+# The keys a lookup request can have besides the address itself
+LOOKUP_OPTIONS = ('fields', 'fresh')
+
+
+# The records the daemon has built recently, keyed by address and fields, dropping the least recently used ones once
+# there are too many
+class RecordCache:
+    def __init__(self, max_records=MAX_RECORDS, max_age=RECORD_MAX_AGE):
+        self.max_records = max_records
+        self.max_age = max_age
+        self.records = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Accepts a key and returns the record stored under it, or None if there isn't one or it's too old
+    def get(self, key):
+        with self.lock:
+            entry = self.records.get(key)
+            if entry is None or time.time() - entry[0] > self.max_age:
+                self.misses = self.misses + 1
+                return None
+            self.records.move_to_end(key)
+            self.hits = self.hits + 1
+            return entry[1]
+
+    def put(self, key, record):
+        with self.lock:
+            self.records[key] = (time.time(), record)
+            self.records.move_to_end(key)
+            while len(self.records) > self.max_records:
+                self.records.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.records.clear()
+
+
+# Everything the daemon keeps warm between lookups, and the lookups themselves
+class LookupService:
+    def __init__(self, concurrency=ls_hamilton_property_class.DEFAULT_CONCURRENCY, spatial_index=None, records=None, batch_workers=BATCH_WORKERS, deadline=None):
+        self.concurrency = concurrency
+        self.deadline = deadline
+        self.spatial_index = spatial_index
+        self.street_index = StreetIndex()
+        self.records = RecordCache() if records is None else records
+        self.flights = SingleFlight()
+        self.executor = ThreadPoolExecutor(max_workers=batch_workers)
+        self.started = time.time()
+
+    # Starts an Eplans session, so the first permit search doesn't have to
+    def warm(self):
+        try:
+            eplans_sessions.warm()
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+
+    # Accepts an address object and returns the key its record is kept under
+    def record_key(self, address, fields):
+        return json.dumps(address, sort_keys=True)+"|"+(",".join(fields) if fields is not None else "")
+
+    # Accepts an address object, and optionally a list of fields and whether to build it from scratch, and returns its
+    # record, from memory if it's been built recently
+    # Lookups for the same address at the same time share one build
+    def lookup(self, address, fields=None, fresh=False):
+        key = self.record_key(address, fields)
+        if not fresh:
+            record = self.records.get(key)
+            if record is not None:
+                return record
+        return self.flights.do(key, self.build, key, address, fields)[0]
+
+    # Builds a record and keeps it in memory, unless it's missing something, so the next lookup tries again
+    def build(self, key, address, fields):
+        record = ls_hamilton_property(address=dict(address), concurrency=self.concurrency, spatial_index=self.spatial_index, fields=fields, street_index=self.street_index, deadline=self.deadline).to_dict()
+        if 'status' not in record:
+            self.records.put(key, record)
+        return record
+
+    # Accepts a list of address objects, and optionally a list of fields and whether to build them from scratch, and
+    # returns their records in the same order, built a few at a time
+    # Addresses that can't be built get {"error": ...} instead
+    def lookup_many(self, addresses, fields=None, fresh=False):
+        futures = [self.executor.submit(self.lookup, address, fields, fresh) for address in addresses]
+        records = []
+        for address, future in zip(addresses, futures):
+            try:
+                records.append(future.result())
+            except Exception as e:
+                logger.error("Couldn't build %s: %s", address, e)
+                records.append({'error': str(e)})
+        return records
+
+    # Returns how long the daemon has been up, what it's holding in memory, the state of each server's circuit
+    # breaker (see circuit_breaker.py) and how many requests were hedged (see hedging.py)
+    def status(self):
+        return {
+            'status': "ok",
+            'uptime': round(time.time() - self.started, 1),
+            'records': len(self.records.records),
+            'record_hits': self.records.hits,
+            'record_misses': self.records.misses,
+            'streets': len(self.street_index.streets),
+            'breakers': breaker_states(),
+            'hedging': hedging_stats()
+        }
+
+
+# A request to the daemon that couldn't be answered, with the HTTP status to answer it with
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# Answers the daemon's API
+class LookupRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.answer_request("GET")
+
+    def do_POST(self):
+        self.answer_request("POST")
+
+    # Routes the request, and answers with JSON whatever happens
+    def answer_request(self, method):
+        started = time.perf_counter()
+        path = urlsplit(self.path).path
+        try:
+            status, body = 200, self.route(method, path)
+        except RequestError as e:
+            status, body = e.status, {'error': str(e)}
+        except ValueError as e:
+            status, body = 400, {'error': str(e)}
+        except Exception as e:
+            logger.error("The daemon couldn't answer %s %s: %s", method, path, e)
+            status, body = 500, {'error': str(e)}
+        self.answer(status, body)
+        logger.debug("Answered %s %s with %s in %s seconds", method, path, status, round(time.perf_counter() - started, 4))
+
+    def route(self, method, path):
+        service = self.server.service
+        if path == "/property":
+            request = self.read_request(method)
+            address = self.read_address(request.get('address', request))
+            return service.lookup(address, self.fields(request), self.fresh(request))
+        if path == "/properties":
+            if method != "POST":
+                raise RequestError(405, "Send the addresses in a POST request")
+            request = self.read_request(method)
+            addresses = request.get('addresses')
+            if not isinstance(addresses, list):
+                raise RequestError(400, "Send the addresses as a list, e.g. {\"addresses\": [...]}")
+            if len(addresses) > MAX_BATCH:
+                raise RequestError(413, "Ask for "+str(MAX_BATCH)+" addresses at most")
+
+            # Addresses that aren't any good get an error in their place, and the rest are looked up
+            records = [None] * len(addresses)
+            valid = {}
+            for index, address in enumerate(addresses):
+                try:
+                    valid[index] = self.read_address(address)
+                except RequestError as e:
+                    records[index] = {'error': "Address "+str(index)+": "+str(e)}
+            for index, record in zip(valid, service.lookup_many(list(valid.values()), self.fields(request), self.fresh(request))):
+                records[index] = record
+            return {'records': records}
+        if path == "/stats":
+            return process_stats.to_dict()
+        if path == "/health":
+            return service.status()
+        raise RequestError(404, "Nothing at "+path)
+
+    # Returns the request's query string parameters for a GET request, or its JSON body for a POST request
+    def read_request(self, method):
+        if method == "GET":
+            return dict(parse_qsl(urlsplit(self.path).query))
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise RequestError(400, "The request body isn't JSON")
+        if not isinstance(request, dict):
+            raise RequestError(400, "The request body should be a JSON object")
+        return request
+
+    # Accepts an address object from a request and returns it without any lookup options, or raises a RequestError if
+    # it isn't an address we can look up
+    def read_address(self, address):
+        if not isinstance(address, dict):
+            raise RequestError(400, "An address should be a JSON object")
+        address = {key: value for key, value in address.items() if key not in LOOKUP_OPTIONS}
+        if not address.get('street_number') or not address.get('street_name'):
+            raise RequestError(400, "An address needs at least a street_number and a street_name")
+        return address
+
+    # Returns the list of fields the request asks for, or None for all of them
+    def fields(self, request):
+        fields = request.get('fields')
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(",") if field.strip()]
+        return fields or None
+
+    # Returns True if the request asks for a record built from scratch
+    def fresh(self, request):
+        return request.get('fresh') in (True, "1", "true")
+
+    def answer(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Requests over a Unix socket don't have a client address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The daemon, listening on a local port
+class LookupServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, service, host="127.0.0.1", port=DEFAULT_PORT):
+        super().__init__((host, port), LookupRequestHandler)
+        self.service = service
+
+    # Returns where the daemon is listening, e.g. http://127.0.0.1:8765
+    def url(self):
+        return "http://"+self.server_address[0]+":"+str(self.server_address[1])
+
+
+# The daemon, listening on a Unix socket
+class UnixLookupServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, service, path):
+        if os.path.exists(path):
+            os.remove(path)
+        super().__init__(path, LookupRequestHandler)
+        self.service = service
+
+    def url(self):
+        return "unix:"+self.server_address
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+# Accepts a lookup service and a port or a Unix socket path, and answers lookups until the process is told to stop
+def serve(service, host="127.0.0.1", port=DEFAULT_PORT, socket_path=None):
+    server = UnixLookupServer(service, socket_path) if socket_path else LookupServer(service, host, port)
+
+    # Stop cleanly on SIGTERM as well as Ctrl-C; shutdown has to be called from another thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    service.warm()
+    logger.info("Answering property lookups at %s", server.url())
+    print("Answering property lookups at "+server.url())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.executor.shutdown()
+        logger.info("Stopped answering property lookups")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer Hamilton property lookups over a local HTTP API")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="port to listen on")
+    parser.add_argument("--socket", help="Unix socket to listen on instead of a port")
+    parser.add_argument("--concurrency", type=int, default=ls_hamilton_property_class.DEFAULT_CONCURRENCY, help="how many requests each property can have in flight")
+    parser.add_argument("--spatial-index", help="spatial index snapshot to look up ward, zoning and temp use data in")
+    parser.add_argument("--cache", help="response cache file to keep the city's responses in between restarts")
+    parser.add_argument("--max-records", type=int, default=MAX_RECORDS, help="how many records to keep in memory")
+    parser.add_argument("--max-age", type=int, default=RECORD_MAX_AGE, help="seconds to keep records in memory")
+    parser.add_argument("--deadline", type=float, help="most seconds to spend building a record, answering with whatever's finished by then")
+    parser.add_argument("--hedge", action="store_true", help="send slow requests to the map services twice and use whichever answers first")
+    args = parser.parse_args()
+    if args.cache:
+        http_cache.enable_cache(args.cache)
+    if args.hedge:
+        enable_hedging()
+    spatial_index = ls_hamilton_spatial_index.load(args.spatial_index) if args.spatial_index else None
+    service = LookupService(args.concurrency, spatial_index, RecordCache(args.max_records, args.max_age), deadline=args.deadline)
+    serve(service, args.host, args.port, args.socket)
@@ -0,0 +1,191 @@
+from bs4 import BeautifulSoup, SoupStrainer
+import re
+import arrow
+from application.core.utils.logger import logger
+
+
+# Pulls the data the class needs out of the property inquiry and Eplans pages
+# Each page is parsed once, with the fastest parser we have, and only the parts of the page we read are parsed at
+# all. The parse tree is thrown away as soon as the data is out of it, so only plain strings, lists and dicts are
+# kept around.
+
+# Use lxml if it's installed, because it's several times faster than Python's built-in parser
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
+
+# The parser to fall back on if a page doesn't come out the way we expect. It's the one the class always used, and
+# fallbacks parse the whole page, so a fallback reads the page exactly the way the class used to.
+FALLBACK_PARSER = "html.parser"
+
+# Only parse the tables on a property inquiry detail page
+DETAIL_STRAINER = SoupStrainer("table")
+
+# Only parse the paragraphs, links and tables on a property inquiry search page
+LIST_STRAINER = SoupStrainer(["p", "a", "table"])
+
+# Only parse the divs and tables on an Eplans permit search page
+PERMITS_STRAINER = SoupStrainer(["div", "table"])
+
+# The patterns we look for on the pages, compiled once
+# The row filters combine all of a table's header and footer labels, so each row is only searched once
+PROPERTY_LIST = re.compile("Property List")
+DETAIL_LINK = re.compile("detail.asp")
+ROLL_NUMBER = re.compile("Roll Number")
+EXEMPT = re.compile("Exempt")
+CURRENT_YEAR_ASSESSMENT = re.compile("Current Year Assessment")
+ASSESSMENT_SKIP = re.compile("Year|Total Assessment|Current Year Assessment")
+TAX_LEVY_HISTORY = re.compile("Tax Levy History")
+LEVY_SKIP = re.compile("Tax Levy History|Year")
+BREAKDOWN = re.compile("Breakdown")
+BREAKDOWN_SKIP = re.compile("Breakdown|Type|Total")
+INSTALMENTS = re.compile("Instalments")
+INSTALMENTS_SKIP = re.compile("Instalments|Amount|Total")
+APPLICATION_NUMBER = re.compile("Application #")
+STREET_NUMBER = re.compile(r"\s*(\d+[A-Za-z]?)\s")
+
+
+# Accepts a page, a strainer for the parts of it we need, and a function that reads data out of a parse tree
+# Returns whatever the reader returns, and frees the parse tree
+# If the reader trips over the page, tries again with the fallback parser on the whole page before giving up
+# Pass what the reader returns when it finds nothing as empty, to try the whole page again in that case too, since
+# what it looks for may be in a part of the page the strainer left out
+def extract(html, strainer, reader, empty=None):
+    attempts = [(HTML_PARSER, strainer), (FALLBACK_PARSER, None)]
+    missed = False
+    for attempt, (parser, parse_only) in enumerate(attempts):
+        document = BeautifulSoup(html, parser, parse_only=parse_only)
+        try:
+            result = reader(document)
+            if missed and result != empty:
+                logger.warning("The strainer left out what we read from the page, so it was read again in full with %s", parser)
+            if empty is None or result != empty or parse_only is None:
+                return result
+            missed = True
+            logger.debug("Found nothing on the page with %s, trying again with %s on the whole page", parser, FALLBACK_PARSER)
+        except (AttributeError, IndexError, KeyError, TypeError) as e:
+            if attempt == len(attempts) - 1:
+                raise
+            logger.debug("Couldn't read the page with %s, trying again with %s: %r", parser, FALLBACK_PARSER, e)
+        finally:
+            document.decompose()
+
+
+# Accepts the HTML of a property inquiry detail page and returns everything the class reads from it:
+# {'is_tax_exempt': ..., 'assessment_years': [...], 'levy_years': [...]}
+# levy_years is None if the property is tax exempt, because exempt properties don't have levy tables
+def extract_detail(html):
+    return extract(html, DETAIL_STRAINER, read_detail)
+
+
+# Reads the data out of a parsed detail page
+def read_detail(document):
+    detail = {}
+    detail['is_tax_exempt'] = document.find("td", {"class": "bodycopy"}, string = EXEMPT) is not None
+    detail['assessment_years'] = read_assessment_years(document)
+    detail['levy_years'] = None if detail['is_tax_exempt'] else read_levy_years(document)
+    return detail
+
+
+# Reads the rows of the tax assessment table out of a parsed detail page
+def read_assessment_years(document):
+    assessment_years = []
+    for row in document.find("b", string = CURRENT_YEAR_ASSESSMENT).parent.parent.parent.parent.find_all("tr"):
+        if not row.find(string = ASSESSMENT_SKIP):
+            cells = row.find_all("td")
+            assessment_years.append({
+                "year": cells[0].contents[0].strip(),
+                "class": cells[1].contents[0].strip(),
+                "description": cells[2].contents[0].strip(),
+                "amount": cells[3].contents[0].strip().replace(",", "")
+            })
+    return assessment_years
+
+
+# Reads the tax levy, breakdown and installment tables out of a parsed detail page
+# The breakdown and installments belong to the first levy year, which is always the current year
+def read_levy_years(document):
+    levy_years = []
+    for row in document.find(string = TAX_LEVY_HISTORY).parent.parent.parent.parent.parent.find_all("tr"):
+        if not row.find(string = LEVY_SKIP):
+            cells = row.find_all("td")
+            levy_years.append({"year": cells[1].contents[0].strip(), "amount": {"total": cells[2].contents[0].strip().replace(",", "")}})
+
+    for row in document.find(string = BREAKDOWN).parent.parent.parent.parent.parent.find_all("tr"):
+        if not row.find(string = BREAKDOWN_SKIP):
+            cells = row.find_all("td")
+            levy_years[0]['amount'][cells[0].contents[0].strip().replace(" ", "_").lower()] = cells[1].contents[0].strip().replace(",", "")
+
+    levy_years[0]['installments'] = []
+    for row in document.find(string = INSTALMENTS).parent.parent.parent.parent.parent.find_all("tr"):
+        if not row.find(string = INSTALMENTS_SKIP):
+            cells = row.find_all("td")
+            levy_years[0]['installments'].append({'date': arrow.get(cells[1].contents[0].strip(), 'MMMM\xa0D,\xa0YYYY').format('MM/DD/YYYY'), 'amount': cells[2].contents[0].strip().replace(",", "")})
+    return levy_years
+
+
+# Accepts the HTML of a property inquiry search and returns a list of roll numbers, and whether the page was a list of
+# properties (True) or a single property (False)
+# A page with no roll numbers on it is read again in full, in case the label is somewhere the strainer doesn't keep
+def extract_roll_numbers(html):
+    return extract(html, LIST_STRAINER, read_roll_numbers, empty=([], False))
+
+
+# Reads the roll numbers out of a parsed search page
+def read_roll_numbers(document):
+    if document.find("p", string = PROPERTY_LIST):
+        return [link.get_text().strip() for link in document.find_all(href = DETAIL_LINK)], True
+    label = document.find("b", string = ROLL_NUMBER)
+    if label:
+        return [label.parent.parent.next_sibling.next_sibling.contents[0].strip()], False
+    return [], False
+
+
+# Accepts the HTML of a property inquiry search for a whole street (no street number) and returns a list of
+# (roll number, street number) pairs, or None if the page isn't a list of properties
+# The street number is None for any roll number whose address we can't make out
+def extract_street_roll_numbers(html):
+    return extract(html, LIST_STRAINER, read_street_roll_numbers)
+
+
+# Reads the roll numbers and street numbers out of a parsed street search page
+# Each roll number's address is in the same table row as its link
+def read_street_roll_numbers(document):
+    if not document.find("p", string = PROPERTY_LIST):
+        return None
+    roll_numbers = []
+    for link in document.find_all(href = DETAIL_LINK):
+        roll_number = link.get_text().strip()
+        row = link.find_parent("tr")
+        street_number = None
+        if row is not None:
+            for cell in row.find_all("td"):
+                match = STREET_NUMBER.match(cell.get_text()+" ")
+                if match and cell.get_text().strip() != roll_number:
+                    street_number = match.group(1).upper()
+                    break
+        roll_numbers.append((roll_number, street_number))
+    return roll_numbers
+
+
+# Accepts the HTML of an Eplans permit search and returns a list of building permits, or None if the page doesn't
+# have a results panel
+def extract_building_permits(html):
+    return extract(html, PERMITS_STRAINER, read_building_permits)
+
+
+# Reads the building permits out of a parsed permit search page
+def read_building_permits(document):
+    if not document.find("div", {'class': 'panel-title'}):
+        return None
+    building_permits = []
+    for row in document.find("span", string = APPLICATION_NUMBER).parent.parent.parent.parent.tbody.find_all("tr"):
+        cells = row.find_all("td")
+        building_permits.append({
+            "application_number": cells[0].div.contents[0].strip().replace(" ", ""),
+            "description": cells[1].div.contents[0].strip(),
+            "status": cells[3].div.contents[0].strip()
+        })
+    return building_permits
@@ -0,0 +1,150 @@
+from bs4 import BeautifulSoup
+import re
+import arrow
+import argparse
+import os
+import time
+import ls_hamilton_extract
+
+
+# Measures how many pages per second the extraction layer in ls_hamilton_extract.py gets through, compared with the
+# way the class used to parse the same pages
+#
+# It runs over a directory of saved pages from the property inquiry and Eplans applications, named by what they are:
+#   detail*.html   property inquiry detail pages (detail.asp)
+#   list*.html     property inquiry search results (list.asp)
+#   permits*.html  Eplans permit search results
+#
+# A small set of sanitized pages comes with the class, in sample_pages/. To run over those, or over pages of your own:
+#   python ls_hamilton_extract_benchmark.py
+#   python ls_hamilton_extract_benchmark.py pages/ --repeat 50
+#
+# It also checks that both ways get exactly the same data out of every page.
+
+# Set how many times to run through the pages for each measurement
+DEFAULT_REPEAT = 20
+
+# The kinds of page we know how to read, by file name prefix
+PAGE_KINDS = ("detail", "list", "permits")
+
+# The sanitized sample pages that come with the class
+SAMPLE_PAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sample_pages")
+
+
+# -- BEFORE: HOW THE CLASS USED TO PARSE PAGES --
+
+
+# Parses the whole detail page with the built-in parser and reads it with the class's original code
+def legacy_detail(html):
+    document = BeautifulSoup(html, "html.parser")
+    detail = {}
+    detail['is_tax_exempt'] = bool(document.find_all("td", {"class": "bodycopy"}, string = re.compile("Exempt")))
+    assessment_years = []
+    for row in document.find("b", string = re.compile(r"Current Year Assessment")).parent.parent.parent.parent.find_all("tr"):
+        if not (row.find(string = re.compile("Year")) or row.find(string = re.compile("Total Assessment")) or row.find(string = re.compile("Current Year Assessment"))):
+            assessment_year = {}
+            assessment_year["year"] = row.find_all("td")[0].contents[0].strip()
+            assessment_year["class"] = row.find_all("td")[1].contents[0].strip()
+            assessment_year["description"] = row.find_all("td")[2].contents[0].strip()
+            assessment_year["amount"] = row.find_all("td")[3].contents[0].strip().replace(",", "")
+            assessment_years.append(assessment_year)
+    detail['assessment_years'] = assessment_years
+    detail['levy_years'] = None
+    if not detail['is_tax_exempt']:
+        levy_years = []
+        for row in document.find(string = re.compile("Tax Levy History")).parent.parent.parent.parent.parent.find_all("tr"):
+            if not (row.find(string = re.compile("Tax Levy History")) or row.find(string = re.compile("Year"))):
+                levy_year = {}
+                levy_year["year"] = row.find_all("td")[1].contents[0].strip()
+                levy_year['amount'] = {}
+                levy_year["amount"]['total'] = row.find_all("td")[2].contents[0].strip().replace(",", "")
+                levy_years.append(levy_year)
+        for row in document.find(string = re.compile("Breakdown")).parent.parent.parent.parent.parent.find_all("tr"):
+            if not (row.find(string = re.compile("Breakdown")) or row.find(string = re.compile("Type")) or row.find(string = re.compile("Total"))):
+                levy_years[0]['amount'][row.find_all("td")[0].contents[0].strip().replace(" ", "_").lower()] = row.find_all("td")[1].contents[0].strip().replace(",", "")
+        levy_years[0]['installments'] = []
+        for row in document.find_all(string = re.compile("Instalments"))[0].parent.parent.parent.parent.parent.find_all("tr"):
+            if not (row.find(string = re.compile("Instalments")) or row.find(string = re.compile("Amount")) or row.find(string = re.compile("Total"))):
+                levy_years[0]['installments'].append({'date': arrow.get(row.find_all("td")[1].contents[0].strip(), 'MMMM\xa0D,\xa0YYYY').format('MM/DD/YYYY'), 'amount': row.find_all("td")[2].contents[0].strip().replace(",", "")})
+        detail['levy_years'] = levy_years
+    return detail
+
+
+# Parses the whole search page with the built-in parser and reads it with the class's original code
+def legacy_list(html):
+    response = BeautifulSoup(html, "html.parser")
+    if response.find("p", string = re.compile("Property List")):
+        return [href.get_text().strip() for href in response.find_all(href=re.compile("detail.asp"))], True
+    if response.find("b", string = re.compile("Roll Number")):
+        return [response.find("b", string = re.compile("Roll Number")).parent.parent.next_sibling.next_sibling.contents[0].strip()], False
+    return [], False
+
+
+# Parses the whole permit search page with the built-in parser and reads it with the class's original code
+def legacy_permits(html):
+    response = BeautifulSoup(html, "html.parser")
+    if not response.find("div", {'class': 'panel-title'}):
+        return None
+    building_permits = []
+    for row in response.find("span", string = re.compile("Application #")).parent.parent.parent.parent.tbody.find_all("tr"):
+        permit = {}
+        permit["application_number"] = row.find_all("td")[0].div.contents[0].strip().replace(" ", "")
+        permit["description"] = row.find_all("td")[1].div.contents[0].strip()
+        permit["status"] = row.find_all("td")[3].div.contents[0].strip()
+        building_permits.append(permit)
+    return building_permits
+
+
+# The before and after reader for each kind of page
+READERS = {
+    "detail": (legacy_detail, ls_hamilton_extract.extract_detail),
+    "list": (legacy_list, ls_hamilton_extract.extract_roll_numbers),
+    "permits": (legacy_permits, ls_hamilton_extract.extract_building_permits)
+}
+
+
+# -- BENCHMARK --
+
+
+# Accepts a directory and returns a dict of page kind to a list of (file name, HTML) pairs
+def read_pages(directory):
+    pages = {kind: [] for kind in PAGE_KINDS}
+    for name in sorted(os.listdir(directory)):
+        for kind in PAGE_KINDS:
+            if name.startswith(kind) and name.endswith(".html"):
+                with open(os.path.join(directory, name), encoding="utf-8", errors="replace") as f:
+                    pages[kind].append((name, f.read()))
+    return pages
+
+
+# Accepts a reader, a list of pages and a repeat count, and returns how many pages per second the reader got through
+def pages_per_second(reader, pages, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        for name, html in pages:
+            reader(html)
+    return len(pages) * repeat / (time.perf_counter() - start)
+
+
+# Runs the benchmark over a directory of pages and prints the results
+# Raises an AssertionError if the two ways of reading a page don't agree
+def run_benchmark(directory, repeat=DEFAULT_REPEAT):
+    pages = read_pages(directory)
+    print("Parser: "+ls_hamilton_extract.HTML_PARSER)
+    for kind in PAGE_KINDS:
+        if not pages[kind]:
+            continue
+        before, after = READERS[kind]
+        for name, html in pages[kind]:
+            assert before(html) == after(html), name+" reads differently before and after"
+        before_rate = pages_per_second(before, pages[kind], repeat)
+        after_rate = pages_per_second(after, pages[kind], repeat)
+        print(kind+": "+str(len(pages[kind]))+" pages, before "+"%.1f" % before_rate+" pages/s, after "+"%.1f" % after_rate+" pages/s ("+"%.1f" % (after_rate / before_rate)+"x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the property inquiry and Eplans page extraction")
+    parser.add_argument("directory", nargs="?", default=SAMPLE_PAGES, help="directory of saved detail*.html, list*.html and permits*.html pages (default: the sample pages)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT, help="how many times to run through the pages")
+    args = parser.parse_args()
+    run_benchmark(args.directory, args.repeat)
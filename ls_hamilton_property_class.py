@@ -1,479 +1,877 @@
-from bs4 import BeautifulSoup
-import re
-import arrow
 from application.core.utils.logger import httpLogger, logger
 # from core.utils.logger import logger
-from application.core.utils.http_client import http_client
+from application.core.utils.http_client import http_client, create_client
+from application.core.utils.async_http_client import get_async_http_client, holding_async_http_client
+from application.core.utils.coalesce import SingleFlight
+from application.core.utils.deadline import DeadlineExceeded, deadline_in, remaining, within
+from application.core.utils.http_cache import get_cached, store_cached
+from application.core.utils.projection import web_mercator, web_mercator_array
+from application.core.utils.rate_limit import wake
+from application.core.utils.stats import Stats, collect, record_failure, timed
+import contextvars
+import logging
+from ls_hamilton_extract import extract_detail, extract_roll_numbers, extract_building_permits
 import requests
+import threading
+import asyncio
+import json
+import time
+import collections
+import hashlib
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
-# Factory class for generating Hamilton property objects 
+# Set how many requests a property can have in flight at once when it's being built
+# 1 builds the property one step at a time, anything higher builds it concurrently on a thread pool
+DEFAULT_CONCURRENCY = 1
+
+# The URL for the City of Hamilton's ArcGIS-powered address search, hosted by Spatial Solutions Inc
+LOCATION_URL = "https://spatialsolutions.hamilton.ca/webgis/rest/services/Geocoders/Address_Locator/GeocodeServer/findAddressCandidates"
+
+# The URL for geocoding lots of addresses in one request with the same address search
+LOCATION_BATCH_URL = "https://spatialsolutions.hamilton.ca/webgis/rest/services/Geocoders/Address_Locator/GeocodeServer/geocodeAddresses"
+
+# Set how many addresses to send in each batch geocoding request
+LOCATION_BATCH_SIZE = 100
+
+# The URL for the City of Hamilton's ArcGIS-powered ward query service, hosted by Spatial Solutions Inc
+WARD_URL = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Political/MapServer/15/query"
+
+# The query URL for the ArcGIS zoning map service, hosted for the city by Spatial Solutions
+ZONING_URL = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Zoning/MapServer/dynamicLayer/query"
+
+# The URL for retrieving a session cookie from the Eplans application
+EPLANS_COOKIE_URL = "https://eplans.hamilton.ca/EPlansPortal/sfjsp?interviewID=Welcome"
+
+# The URL for the Eplans application's session manager
+EPLANS_URL = "https://eplans.hamilton.ca/EPlansPortal/sfjsp"
+
+# Headers for the requests that set up an Eplans session, which must always reach the server
+EPLANS_SESSION_HEADERS = {"Cache-Control": "no-store"}
+
+# The form data that takes an Eplans session past the Welcome interview
+EPLANS_WELCOME_DATA = {"e_1482930323468": "onclick"}
+
+# If a permit search comes back with the Welcome interview's form on it, the Eplans session has expired
+EPLANS_WELCOME_MARKER = "e_1482930323468"
+
+# Permit searches always go to Eplans, and are only stored in the response cache once we know the session hadn't
+# expired, so a Welcome interview is never kept in place of the search results
+EPLANS_SEARCH_HEADERS = {"Cache-Control": "no-cache, no-store"}
+
+# Set how many Eplans sessions can be open at once, searching or waiting in the pool to be reused
+# Permit searches wait for one of them to come free rather than starting more
+EPLANS_POOL_SIZE = 8
+
+# Set how long to keep reusing an Eplans session before starting a new one
+EPLANS_SESSION_MAX_AGE = 10 * 60 # seconds
+
+# The query URL for the property inquiry application
+TAX_LIST_URL = "http://oldproperty.hamilton.ca/property-inquiry_noborders/list.asp"
+
+# The URL for querying by roll number against the property inquiry application
+TAX_DETAIL_URL = "http://oldproperty.hamilton.ca/property-inquiry_noborders/detail.asp?qryrollno="
+
+# The community code the property inquiry application uses for each of the cities that make up Hamilton
+COMMUNITIES = {
+    "Hamilton": "ham010081",
+    "Ancaster": "anc140140",
+    "Dundas": "dun260260",
+    "Flamborough": "fla301303",
+    "Glanbrook": "gla901902",
+    "Stoney Creek": "scr003003"
+}
+
+# The community code that searches all of them
+ALL_COMMUNITIES = "all000999"
+
+# The query URL for asking the ArcGIS zoning map service about several of its layers at once
+ZONING_LAYERS_URL = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Zoning/MapServer/query"
+
+# The fields we ask the zoning map service for
+ZONING_FIELDS = 'ZONING_CODE,ZONING_DESC,PARENT_BY_LAW_NUMBER,PARENT_BY_LAW_URL,BY_LAW_NUMBER,BY_LAW_URL,EXCEPTION1,EXCEPTION1_BYLAW,EXCEPTION1_URL,HOLDING1,HOLDING1_BYLAW,HOLDING1_URL,HOLDING2,HOLDING2_BYLAW,HOLDING2_URL,HOLDING3,HOLDING3_BYLAW,HOLDING3_URL,COMMUNITY,ZONING_MAP,COUNCIL_APP_DATE,ZONING_FILE,OMB_NUMBER,OMB_CASE_NUMBER,OPA_NUMBER,URBAN_RURAL_SETTLE,FINALBINDING_DATE,SHAPE.AREA,SHAPE.LEN'
+
+# The fields we ask the zoning map service for when we're looking for temporary use applications
+TEMP_USE_FIELDS = 'OBJECTID,ID,ZONING_CODE,ZONING_DESC,PARENT_BY_LAW_NUMBER,PARENT_BY_LAW_URL,BY_LAW_NUMBER,BY_LAW_URL,EXCEPTION1,EXCEPTION1_BYLAW,EXCEPTION1_URL,HOLDING1,HOLDING1_BYLAW,HOLDING1_URL,EXCEPTION2,EXCEPTION2_BYLAW,EXCEPTION2_URL,HOLDING2,HOLDING2_BYLAW,HOLDING2_URL,EXCEPTION3,EXCEPTION3_BYLAW,EXCEPTION3_URL,HOLDING3,HOLDING3_BYLAW,HOLDING3_URL,COMMUNITY,ZONING_MAP,COUNCIL_APP_DATE,ZONING_FILE,OMB_NUMBER,OMB_CASE_NUMBER,OPA_NUMBER,URBAN_RURAL_SETTLE,FINALBINDING_DATE,SHAPE.AREA,SHAPE.LEN'
+
+
+# The fields of a property record, in the order they appear in it
+FIELDS = ('address', 'location', 'taxes', 'ward', 'zoning', 'temp_use', 'building_permits')
+
+# The fields that come from the ward, zoning and temp use lookup
+SPATIAL_FIELDS = {'ward', 'zoning', 'temp_use'}
+
+# The other sections each field needs before it can be looked up
+FIELD_DEPENDENCIES = {'ward': ('location',), 'zoning': ('location',), 'temp_use': ('location',), 'building_permits': ('location',)}
+
+# The sections each stage looks up, so a request that fails in a stage can be put down to the sections it leaves
+# something out of (see section_status)
+STAGE_SECTIONS = {
+    'location': ('location',),
+    'taxes': ('taxes',),
+    'tax_details': ('taxes',),
+    'tax_exempt': ('taxes',),
+    'tax_assessment_years': ('taxes',),
+    'tax_levy_years': ('taxes',),
+    'spatial_data': ('ward', 'zoning', 'temp_use'),
+    'ward': ('ward',),
+    'zoning_layers': ('zoning', 'temp_use'),
+    'zoning_data': ('zoning',),
+    'temp_use_data': ('temp_use',),
+    'building_permits': ('building_permits',)
+}
+
+
+# Factory class for generating Hamilton property objects
 # Accepts an address object. Required address attributes are:
     #   'street_number' (e.g. 73)
     #   'street_name' (e.g. Tisdale)
     #   'street_type_short' (e.g. St) or 'street_type_long' (e.g. Street)
     #   'street_direction_short' (e.g. S) or 'street_direction_long' (South), if applicable
     #   'city' (must be one of Hamilton, Ancaster, Dundas, Flamborough, Glanbrook, or Stoney Creek)
+# If you're running inside an asyncio event loop, use 'await ls_hamilton_property.create(address)' instead
 class ls_hamilton_property:
-    def __init__(self, address={}):
+
+    # The record itself lives in __dict__, so it can be serialized with json.dumps(my_prop.__dict__)
+    # Everything the property needs in order to look up sections later lives in these slots, outside the record
+    __slots__ = ('__dict__', 'fields', 'sources', 'sections', 'stats')
+
+    # Optionally accepts a roll document cache (see ls_hamilton_document_cache below) if you want to inspect
+    # how many detail page requests each roll number cost once the property has been built
+    # Optionally accepts a concurrency level. Anything above 1 builds the property on a thread pool of that size,
+    # which is a lot faster but returns exactly the same record.
+    # Optionally accepts a location object you already have (e.g. from get_locations), so the address isn't geocoded again
+    # Optionally accepts a local spatial index (see ls_hamilton_spatial_index.py) to look up the ward, zoning and
+    # temp use data in, instead of asking the map services
+    # Optionally accepts a list of the fields you want in the record, e.g. ['ward', 'zoning'], or a single one, e.g.
+    # 'ward', so the others aren't looked up at all. The address is always included.
+    # Optionally accepts lazy=True, which looks up nothing at first, and looks up each field the first time you read it
+    # Optionally accepts a street index (see ls_hamilton_street_index.py) to find the roll numbers in, so each street
+    # is only searched once
+    # Optionally accepts a requests client (see create_client in http_client.py) to make every request with. Without
+    # one, the property gets its own client, with its own cookies, sharing connections with every other property.
+    # Optionally accepts a deadline, the most seconds the property can take. Every request is cut short so the property
+    # is done by then, with whatever sections were finished; the rest are listed in its status. Lazy properties count
+    # the deadline from when they're created.
+    # How long each step took and how many requests it made end up in my_prop.stats (see stats.py)
+    # If a server is down or a request fails, the record gets a 'status' listing the sections that are missing
+    # something (see section_status), so they can be looked up again later. Records that aren't missing anything
+    # don't have one.
+    def __init__(self, address={}, documents=None, concurrency=DEFAULT_CONCURRENCY, location=None, spatial_index=None, fields=None, lazy=False, street_index=None, client=None, deadline=None):
+        if client is None:
+            client = create_client(concurrency)
+        self.setup(address, documents, location, spatial_index, fields, street_index, client, deadline)
+        if lazy:
+            return
+        with collect(self.stats), within(self.sources['deadline']):
+            if concurrency > 1:
+                self.build_concurrently(concurrency)
+            else:
+                self.build()
+        self.stats.log("Built property", logging.DEBUG)
+
+
+    # Accepts an address object and returns a property object, built without blocking the event loop
+    # Optionally accepts a roll document cache, a location object, a spatial index, a list of fields, a street index,
+    # a requests client and a deadline, just like the regular constructor. The client is only used for fields read later
+    # with lazy lookups, since everything else goes through the async client.
+    # The async client is closed once the last property being built on the event loop is done.
+    @classmethod
+    async def create(cls, address={}, documents=None, location=None, spatial_index=None, fields=None, street_index=None, client=None, deadline=None):
+        self = cls.__new__(cls)
+        self.setup(address, documents, location, spatial_index, fields, street_index, client or create_client(), deadline)
+        async with holding_async_http_client():
+            with collect(self.stats), within(self.sources['deadline']):
+                await self.build_async()
+        self.stats.log("Built property", logging.DEBUG)
+        return self
+
+
+    # Checks the list of fields and gets everything ready for looking up sections of the record
+    def setup(self, address, documents, location, spatial_index, fields, street_index=None, client=http_client, deadline=None):
+        if fields is None:
+            fields = FIELDS
+        elif isinstance(fields, str):
+            fields = [fields]
+        self.check_fields(fields)
+
+        # The tax steps all read the same detail page for a roll number, so share one cache between them
+        if documents is None:
+            documents = ls_hamilton_document_cache(client=client)
+
+        # Keep the fields in the same order as a full record, so the JSON looks the same
+        self.fields = tuple(field for field in FIELDS if field in fields or field == 'address')
+
+        # The spatial index has the same ward, zoning and temp use getters as we do
+        self.sources = {
+            'documents': documents,
+            'spatial': self if spatial_index is None else spatial_index,
+            'streets': street_index,
+            'client': client,
+            'deadline': deadline_in(deadline),
+            'lock': threading.RLock()
+        }
+
+        # Every section we've looked up so far, whether it's one of the fields or just needed for one
+        self.sections = {'address': address}
+        if location is not None:
+            self.sections['location'] = location
+        self.stats = Stats()
         self.address = address
-        self.location = self.get_location(self.address)
-        self.taxes = self.get_taxes(self.address)
-        if self.taxes:
-            for tax in self.taxes:
-                tax = self.check_tax_exempt(tax)
-                tax = self.get_tax_assessment_years(tax)
-                tax = self.get_tax_levy_years(tax)
-        if self.location:
-            self.ward = self.get_ward(self.location)
-        else:
-            self.ward = None
-        if self.location:
-            self.zoning = self.get_zoning_data(self.location)
-        else:
-            self.zoning = {}
-        if self.location:
-            self.temp_use = self.get_temp_use_data(self.location)
-        else:
-            self.temp_use = {}
-        if self.location:
-            self.building_permits = self.get_building_permits(self.address)
-        else: self.building_permits = []
+
+
+    # Pickles the record along with the fields and every section looked up so far
+    # The client, the caches, the indexes, the lock and the deadline only mean something in the process that built the
+    # property, so they're left out. An unpickled property looks up any fields it hasn't yet with a new client of its
+    # own, asks the map services for the ward, zoning and temp use, and has no deadline.
+    def __getstate__(self):
+        with self.sources['lock']:
+            return {'record': dict(self.__dict__), 'fields': self.fields, 'sections': dict(self.sections), 'stats': self.stats}
+
+    def __setstate__(self, state):
+        self.setup(state['sections']['address'], None, None, None, state['fields'], client=create_client())
+        self.sections = state['sections']
+        self.stats = state['stats']
+        self.__dict__.update(state['record'])
+
+
+    # Reads a field that hasn't been looked up yet: looks it up, keeps it in the record and returns it
+    # Python only calls this for attributes that aren't already set, so each field is only looked up once
+    def __getattr__(self, name):
+        if name not in FIELDS:
+            raise AttributeError("'"+type(self).__name__+"' object has no attribute '"+name+"'")
+        value = self.section(name)
+        setattr(self, name, value)
+        self.mark_status()
+        return value
+
+
+    # Returns the requested fields as a dict, in the same order as a full record, looking up any that haven't been yet
+    # Includes the record's status if it's missing something
+    def to_dict(self):
+        record = {field: getattr(self, field) for field in self.fields}
+        status = self.section_status()
+        if status:
+            record['status'] = status
+        return record
+
+
+    # Returns the sections of the record that are missing something because a request failed, e.g.
+    # {'building_permits': 'skipped'}, or an empty dict if nothing is
+    # A section is 'incomplete' if a request for it failed or was cut short by the deadline, and 'skipped' if a request
+    # for it wasn't sent because its server's circuit breaker was open (see circuit_breaker.py) or the deadline had
+    # passed, or it needs a section that's missing something
+    def section_status(self):
+        status = {}
+        for stage, counts in self.stats.to_dict()['stages'].items():
+            for section in STAGE_SECTIONS.get(stage, ()):
+                if counts['failed_requests']:
+                    status[section] = 'incomplete'
+                elif counts['short_circuited']:
+                    status.setdefault(section, 'skipped')
+        for field, dependencies in FIELD_DEPENDENCIES.items():
+            if any(dependency in status for dependency in dependencies):
+                status.setdefault(field, 'skipped')
+        return {field: status[field] for field in FIELDS if field in status and field in self.__dict__}
+
+
+    # Keeps the record's status up to date, at the end of the record
+    def mark_status(self):
+        self.__dict__.pop('status', None)
+        status = self.section_status()
+        if status:
+            self.status = status
+
+
+    # Returns the set of sections we need to look up the requested fields
+    def needed_sections(self):
+        needed = set(self.fields)
+        for field in self.fields:
+            needed.update(FIELD_DEPENDENCIES.get(field, ()))
+        return needed
+
+
+    # Accepts the name of a section and returns it, looking it up the first time it's asked for
+    def section(self, name):
+        with self.sources['lock']:
+            if name not in self.sections:
+                with collect(self.stats), within(self.sources['deadline']):
+                    self.load_section(name)
+            return self.sections[name]
+
+
+    # Accepts the name of a section and looks it up, along with anything it needs
+    # Ward, zoning and temp use come from the same lookup, so asking for one of them gets all three
+    def load_section(self, name):
+        address = self.sections['address']
+        if name == 'location':
+            self.sections['location'] = self.get_location(address)
+        elif name == 'taxes':
+            self.sections['taxes'] = self.get_taxes_with_details(address, self.sources['documents'])
+        elif name in SPATIAL_FIELDS:
+            location = self.section('location')
+            if location:
+                self.sections['ward'], self.sections['zoning'], self.sections['temp_use'] = self.sources['spatial'].get_spatial_data(location)
+            else:
+                self.sections['ward'], self.sections['zoning'], self.sections['temp_use'] = None, {}, {}
+        elif name == 'building_permits':
+            if self.section('location'):
+                self.sections['building_permits'] = self.get_building_permits(address)
+            else:
+                self.sections['building_permits'] = []
+
+
+    # Builds the property record one step at a time, by reading each requested field in order
+    def build(self):
+        for field in self.fields:
+            getattr(self, field)
+
+
+    # Builds the property record on a thread pool
+    # Geocoding, taxes and building permits only need the address, so they all start right away. The ward, zoning
+    # and temp use lookup starts as soon as geocoding finishes, and each roll number's tax details start as soon as the
+    # roll numbers come back. Building permits are fetched before we know whether geocoding worked, so they're
+    # thrown away afterwards if it didn't, just like the sequential build skips them.
+    # Only the sections the requested fields need are looked up.
+    def build_concurrently(self, concurrency):
+        address = self.sections['address']
+        documents = self.sources['documents']
+        spatial = self.sources['spatial']
+        needed = self.needed_sections()
+        location_future = taxes_future = permits_future = spatial_future = None
+        tax_futures = []
+
+        # Runs each step in a copy of our context, so the stats it records end up in this property's stats
+        def submit(function, *args):
+            return executor.submit(contextvars.copy_context().run, function, *args)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+
+            # If we already have the location, treat geocoding as done
+            if 'location' in self.sections:
+                location_future = Future()
+                location_future.set_result(self.sections['location'])
+            elif 'location' in needed:
+                location_future = submit(self.get_location, address)
+            if 'taxes' in needed:
+                taxes_future = submit(self.get_taxes, address)
+            if 'building_permits' in needed:
+                permits_future = submit(self.get_building_permits, address)
+
+            # Fan out the dependent steps as soon as the step they depend on finishes
+            pending = {future for future in (location_future, taxes_future) if future is not None}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if location_future in done:
+                    self.sections['location'] = location_future.result()
+                    if self.sections['location'] and needed & SPATIAL_FIELDS:
+                        spatial_future = submit(spatial.get_spatial_data, self.sections['location'])
+                if taxes_future in done:
+                    for tax in taxes_future.result():
+                        tax_futures.append(submit(self.get_tax_details, tax, documents))
+
+            # Wait for the rest
+            if taxes_future is not None:
+                for tax_future in tax_futures:
+                    tax_future.result()
+                self.sections['taxes'] = taxes_future.result()
+                documents.clear()
+            if needed & SPATIAL_FIELDS:
+                self.sections['ward'], self.sections['zoning'], self.sections['temp_use'] = spatial_future.result() if spatial_future else (None, {}, {})
+            if permits_future is not None:
+                self.sections['building_permits'] = permits_future.result() if self.sections['location'] else []
+
+        # Set the attributes in the same order as the sequential build
+        for field in self.fields:
+            setattr(self, field, self.sections[field])
+        self.mark_status()
+
+
+    # Builds the property record on the running event loop
+    # Fans out the same way as the concurrent build, with tasks instead of threads
+    async def build_async(self):
+        address = self.sections['address']
+        documents = self.sources['documents']
+        spatial = self.sources['spatial']
+        needed = self.needed_sections()
+
+        # Accepts the geocoding task and returns ward, zoning and temp use once it's done
+        async def get_spatial_data(location_task):
+            location = await location_task
+            if not location:
+                return None, {}, {}
+            return await spatial.get_spatial_data_async(location)
+
+        # If we already have the location, treat geocoding as done
+        tasks = {}
+        if 'location' in self.sections:
+            tasks['location'] = asyncio.get_running_loop().create_future()
+            tasks['location'].set_result(self.sections['location'])
+        elif 'location' in needed:
+            tasks['location'] = asyncio.ensure_future(self.get_location_async(address))
+        if 'taxes' in needed:
+            tasks['taxes'] = asyncio.ensure_future(self.get_taxes_with_details_async(address, documents))
+        if needed & SPATIAL_FIELDS:
+            tasks['spatial'] = asyncio.ensure_future(get_spatial_data(tasks['location']))
+        if 'building_permits' in needed:
+            tasks['building_permits'] = asyncio.ensure_future(self.get_building_permits_async(address))
+
+        # If anything blows up, don't leave the other tasks running
+        try:
+            results = dict(zip(tasks, await asyncio.gather(*tasks.values())))
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+
+        # Set the attributes in the same order as the sequential build
+        if 'spatial' in results:
+            results['ward'], results['zoning'], results['temp_use'] = results.pop('spatial')
+        if 'building_permits' in results and not results['location']:
+            results['building_permits'] = []
+        self.sections.update(results)
+        for field in self.fields:
+            setattr(self, field, self.sections[field])
+        self.mark_status()
+
+
+    # Accepts an address object and returns a list of tax objects with all of their details filled in
+    def get_taxes_with_details(self, address, documents):
+        taxes = self.get_taxes(address)
+        for tax in taxes:
+            self.get_tax_details(tax, documents)
+
+        # We're done with the pages, so let them go
+        documents.clear()
+        return taxes
+
+
+    # Async version of get_taxes_with_details
+    async def get_taxes_with_details_async(self, address, documents):
+        taxes = await self.get_taxes_async(address)
+        if taxes:
+            await asyncio.gather(*[self.get_tax_details_async(tax, documents) for tax in taxes])
+        documents.clear()
+        return taxes
+
+
+    # Accepts a tax object and fills in its tax exemption, assessment years and levy years
+    # Tax object must have a a roll number attribute
+    @timed("tax_details")
+    def get_tax_details(self, tax, documents):
+        return self.fill_tax_details(tax, documents)
+
+
+    # Runs the tax steps for get_tax_details and get_tax_details_async
+    def fill_tax_details(self, tax, documents):
+        roll_number = tax['roll_number']
+        tax = self.check_tax_exempt(tax, documents)
+        tax = self.get_tax_assessment_years(tax, documents)
+        tax = self.get_tax_levy_years(tax, documents)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Fetched the detail page for roll number %s with %s request(s) and %s parse(s)", roll_number, documents.request_count(roll_number), documents.parse_count(roll_number))
+        return tax
+
+
+    # Async version of get_tax_details
+    # Downloads the detail page without blocking, then fills in the tax object from the cached page
+    @timed("tax_details")
+    async def get_tax_details_async(self, tax, documents):
+
+        # Any HTTP error is remembered by the cache and logged by the tax steps
+        try:
+            await documents.get_async(tax['roll_number'])
+        except requests.exceptions.RequestException:
+            pass
+        return self.fill_tax_details(tax, documents)
 
 
     # Accepts an address object and returns long/lat in EPSG:4326 and EPSG:3857 coordinates.
+    # We only ask the address search for EPSG:4326 coordinates, and project them to EPSG:3857 ourselves
     # Required input address attributes:
     #   'street_number'
     #   'street_name'
     #   'street_type_long'
     #   'street_direction_short' or 'street_direction_long' if applicable
+    @timed("location")
     def get_location(self, address):
 
-        # The URL for the City of Hamilton's ArcGIS-powered address search, hosted by Spatial Solutions Inc
-        url = "https://spatialsolutions.hamilton.ca/webgis/rest/services/Geocoders/Address_Locator/GeocodeServer/findAddressCandidates"
-        # url = "https://httpstat.us/500"
-
         # Format the address object as a single-line string
-        addressString = address['street_number']+" "+address['street_name']+" "+address['street_type_long'] 
-        if address.get('street_direction_long') is not None:
-            addressString = addressString+" "+address['street_direction_long']
-        if address.get('city') is not None:
-            addressString = addressString+" "+address['city']
+        addressString = self.location_address_string(address)
 
-        # Create an empty location object and let's go!
-        location = {}
-
-        # Assemble the address string into requests for EPSG:4326 and EPSG:3857 coordinates,
-        # along with other required parameters
-        requestData4326 = {'SingleLine': addressString, 'f': 'json', 'outSR': '{wkid: 4326}', 'outFields': '*', 'maxLocations': '1'}
-        requestData3857 = {'SingleLine': addressString, 'f': 'json', 'outSR': '{wkid: 3857}', 'outFields': '*', 'maxLocations': '1'}
-
-        # Check if a request returns an HTTP error
+        # Check if the request returns an HTTP error
         try:
-            http_client.get(url, params=requestData4326)
+            response = self.sources['client'].get(LOCATION_URL, params=self.location_request_data(addressString)).json()
 
         # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return location
+            return {}
 
-        # If it doesn't, get the responses
+        # If it doesn't, assemble the response into a location object
         else:
-            response4326 = http_client.get(url, params=requestData4326).json()
-            response3857 = http_client.get(url, params=requestData3857).json()
+            return self.parse_location(response, addressString)
 
-            # If the responses contain candidate results, assemble them into a location object 
-            if response4326["candidates"]:
-                location['EPSG:4326'] = response4326["candidates"][0]["location"]
-                location['EPSG:3857'] = response3857["candidates"][0]["location"]
-                logger.debug("Found the location for "+addressString)
 
-            # If they don't, log a warning and return nothing
+    # Async version of get_location
+    @timed("location")
+    async def get_location_async(self, address):
+        client = get_async_http_client()
+        addressString = self.location_address_string(address)
+        try:
+            response = (await client.get(LOCATION_URL, params=self.location_request_data(addressString))).json()
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return {}
+        else:
+            return self.parse_location(response, addressString)
+
+
+    # Accepts a list of address objects and returns a list of location objects in the same order, geocoding
+    # up to LOCATION_BATCH_SIZE addresses per request instead of one request per address
+    # Addresses that can't be found get an empty location object, just like get_location. If a batch request
+    # returns an HTTP error, its addresses get None instead, so you can fall back to geocoding them one at a time.
+    # Optionally accepts a requests client to geocode with
+    @classmethod
+    @timed("locations")
+    def get_locations(cls, addresses, client=http_client):
+        locations = []
+        for start in range(0, len(addresses), LOCATION_BATCH_SIZE):
+            batch = addresses[start:start+LOCATION_BATCH_SIZE]
+
+            # Check if the request returns an HTTP error
+            try:
+                response = client.post(LOCATION_BATCH_URL, data=cls.location_batch_request_data(batch)).json()
+
+            # If it does, log the HTTP error and mark the whole batch as not geocoded
+            except requests.exceptions.RequestException as e:
+                httpLogger.error(e)
+                locations.extend([None] * len(batch))
+
+            # If it doesn't, assemble the response into location objects
             else:
-                logger.warning("Can't find a location for "+addressString)
-            return location
+                locations.extend(cls.parse_locations(response, len(batch)))
+        return locations
 
 
-    # Accepts a location object and returns the city ward
-    def get_ward(self, location):
+    # Accepts a location object and returns its ward, zoning data and temp use data
+    # Asks each map service just once: one query for the ward, and one query covering both zoning layers
+    @timed("spatial_data")
+    def get_spatial_data(self, location):
+        ward = self.get_ward(location)
+        zoning, temp_use = self.get_zoning_layers(location)
+        return ward, zoning, temp_use
 
-        # The URL for the City of Hamilton's ArcGIS-powered ward query service, hosted by Spatial Solutions Inc
-        url = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Political/MapServer/15/query"
-        # url = "https://httpstat.us/500"
 
-        # Assemble the location data into a request, along with other required parameters
-        requestData = {
-                'f': 'json',
-                'outSR': '{wkid:4326}',
-                'geometryType': 'esriGeometryPoint',
-                'inSR': '{wkid:4326}',
-                'geometry': "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}",
-                'returnIdsOnly': 'true'
-            }
+    # Async version of get_spatial_data
+    # The two map services are asked at the same time
+    @timed("spatial_data")
+    async def get_spatial_data_async(self, location):
+        ward, (zoning, temp_use) = await asyncio.gather(self.get_ward_async(location), self.get_zoning_layers_async(location))
+        return ward, zoning, temp_use
+
+
+    # Accepts a location object and returns its zoning data and temp use data, from one request to the zoning map service
+    # If the map service can't query more than one layer at a time, falls back to querying them one at a time
+    @timed("zoning_layers")
+    def get_zoning_layers(self, location):
 
         # Check if the request returns an HTTP error
         try:
-            http_client.get(url, params=requestData)
+            response = self.sources['client'].get(ZONING_LAYERS_URL, params=self.zoning_layers_request_data(location)).json()
 
-        # If it does, log the HTTP error and return nothing
+        # If it does, log the HTTP error and return empty zoning and temp use objects
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return None
+            return {}, {}
 
-        # If it doesn't, get the response
+        # If it doesn't, split the response into zoning and temp use data
         else:
-            response = http_client.get(url, params=requestData)
-
-            # If the reponse contains a ward object, return it
-            if response.json()['objectIds'] != None:
-                ward = str(response.json()['objectIds'][0])
-                logger.debug("Found ward "+ward)
-                return ward
-            else:
-                logger.warning("Couldn't find the ward")
-                return None
-
-
-    # Accepts a location object and returns zoning data
-    def get_zoning_data(self, location):
+            if 'error' in response:
+                logger.warning("Couldn't query the zoning layers together, so querying them one at a time: %s", json.dumps(response['error']))
+                return self.get_zoning_data(location), self.get_temp_use_data(location)
+            return self.parse_zoning_layers(response)
 
-        # The query URL for the ArcGIS zoning map service, hosted for the city by Spatial Solutions
-        url = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Zoning/MapServer/dynamicLayer/query"
-        # url = "https://httpstat.us/500"
 
-        # Assemble the location object into query request data, including some other required parameters
-        # We will use this request to check to see if zoning is returned for this location
-        checkRequestData = {
-                'f': 'json',
-                'outSR': '{wkid:4326}',
-                'geometryType': 'esriGeometryPoint',
-                'inSR': '{wkid:4326}',
-                'geometry': "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}",
-                'returnIdsOnly': 'true',
-                'layer': "{'source':{'type':'mapLayer','mapLayerId': '9'}}"
-        }
+    # Async version of get_zoning_layers
+    @timed("zoning_layers")
+    async def get_zoning_layers_async(self, location):
+        client = get_async_http_client()
+        try:
+            response = (await client.get(ZONING_LAYERS_URL, params=self.zoning_layers_request_data(location))).json()
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return {}, {}
+        else:
+            if 'error' in response:
+                logger.warning("Couldn't query the zoning layers together, so querying them one at a time: %s", json.dumps(response['error']))
+                return await asyncio.gather(self.get_zoning_data_async(location), self.get_temp_use_data_async(location))
+            return self.parse_zoning_layers(response)
 
-        # Assemble the location object into query request data, including some other required parameters
-        # We will use this request to retrieve the zoning data if the check comes back positive
-        requestData = {
-            'f': 'json',
-            'returnGeometry': 'false',
-            'outSR': '{wkid:4326}',
-            'geometryType': 'esriGeometryPoint',
-            'inSR': '{wkid:4326}',
-            'geometry': "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}",
-            'layer': "{'source':{'type':'mapLayer','mapLayerId': '9'}}",
-            'outFields': 'ZONING_CODE,ZONING_DESC,PARENT_BY_LAW_NUMBER,PARENT_BY_LAW_URL,BY_LAW_NUMBER,BY_LAW_URL,EXCEPTION1,EXCEPTION1_BYLAW,EXCEPTION1_URL,HOLDING1,HOLDING1_BYLAW,HOLDING1_URL,HOLDING2,HOLDING2_BYLAW,HOLDING2_URL,HOLDING3,HOLDING3_BYLAW,HOLDING3_URL,COMMUNITY,ZONING_MAP,COUNCIL_APP_DATE,ZONING_FILE,OMB_NUMBER,OMB_CASE_NUMBER,OPA_NUMBER,URBAN_RURAL_SETTLE,FINALBINDING_DATE,SHAPE.AREA,SHAPE.LEN'
-        }
 
-        # Create an empty zoning object and off we go!
-        zoning = {}
+    # Accepts a location object and returns the city ward
+    @timed("ward")
+    def get_ward(self, location):
 
         # Check if the request returns an HTTP error
         try:
-            response = http_client.get(url, params=checkRequestData)
+            response = self.sources['client'].get(WARD_URL, params=self.ward_request_data(location)).json()
 
-        # If it does, log the HTTP error and return an empty zoning data object
+        # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return zoning
+            return None
 
-        # If it doesn't, check to see if the response contains zoning data
+        # If it doesn't, pull the ward out of the response
         else:
-            checkResponse = http_client.get(url, params=checkRequestData).json()
-            
-            # If it does, return the zoning data
-            if checkResponse['objectIds'] != None:
-                zoning = http_client.get(url, params=requestData).json()['features'][0]['attributes']
-                logger.debug("Found zoning data")
-                return zoning
+            return self.parse_ward(response)
 
-            # If it doesn't, log a warning and return the empty zoning object
-            else:
-                logger.warning("Could not find zoning data")
-                return zoning
-
-
-    # Accepts a location object and returns any temporary use applications
-    def get_temp_use_data(self, location):
 
-        # The query URL for the ArcGIS zoning map service, hosted for the city by Spatial Solutions
-        url = "https://spatialsolutions.hamilton.ca/webgis/rest/services/General/Zoning/MapServer/dynamicLayer/query"
-        # url = "https://httpstat.us/500"
+    # Async version of get_ward
+    @timed("ward")
+    async def get_ward_async(self, location):
+        client = get_async_http_client()
+        try:
+            response = (await client.get(WARD_URL, params=self.ward_request_data(location))).json()
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return None
+        else:
+            return self.parse_ward(response)
 
-        # Assemble the location object into query request data, including some other required parameters
-        # We will use this request to check to see if temp use data is returned for this location
-        checkRequestData = {
-                'f': 'json',
-                'outSR': '{wkid:4326}',
-                'geometryType': 'esriGeometryPoint',
-                'inSR': '{wkid:4326}',
-                'geometry': "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}",
-                'returnIdsOnly': 'true',
-                'layer': "{'source':{'type':'mapLayer','mapLayerId': '20'}}"
-        }
 
-        # Assemble the location object into query request data, including some other required parameters
-        # We will use this request to retrieve the temp use data if the check comes back positive
-        requestData = {
-                'f': 'json',
-                'returnGeometry': 'false',
-                'outSR': '{wkid:4326}',
-                'geometryType': 'esriGeometryPoint',
-                'inSR': '{wkid:4326}',
-                'geometry': "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}",
-                'layer': "{'source':{'type':'mapLayer','mapLayerId': '9'}}",
-                'outFields': 'OBJECTID,ID,ZONING_CODE,ZONING_DESC,PARENT_BY_LAW_NUMBER,PARENT_BY_LAW_URL,BY_LAW_NUMBER,BY_LAW_URL,EXCEPTION1,EXCEPTION1_BYLAW,EXCEPTION1_URL,HOLDING1,HOLDING1_BYLAW,HOLDING1_URL,EXCEPTION2,EXCEPTION2_BYLAW,EXCEPTION2_URL,HOLDING2,HOLDING2_BYLAW,HOLDING2_URL,EXCEPTION3,EXCEPTION3_BYLAW,EXCEPTION3_URL,HOLDING3,HOLDING3_BYLAW,HOLDING3_URL,COMMUNITY,ZONING_MAP,COUNCIL_APP_DATE,ZONING_FILE,OMB_NUMBER,OMB_CASE_NUMBER,OPA_NUMBER,URBAN_RURAL_SETTLE,FINALBINDING_DATE,SHAPE.AREA,SHAPE.LEN'
-        }
-
-        # Create an empty temp use object and off we go!
-        temp_use = {}
+    # Accepts a location object and returns zoning data
+    @timed("zoning_data")
+    def get_zoning_data(self, location):
 
-        # Check if the request returns an HTTP error
+        # Check if the requests return an HTTP error
         try:
-            response = http_client.get(url, params=checkRequestData)
+            checkResponse = self.sources['client'].get(ZONING_URL, params=self.layer_check_request_data(location, '9')).json()
 
-        # If it does, log the HTTP error and return an empty temp use data object
+            # If the check response says there's zoning data, ask for it
+            response = None
+            if checkResponse['objectIds'] != None:
+                response = self.sources['client'].get(ZONING_URL, params=self.layer_request_data(location, '9', ZONING_FIELDS)).json()
+
+        # If they do, log the HTTP error and return an empty zoning data object
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return temp_use
+            return {}
 
-        # If it doesn't, check to see if the response contains temp use data
+        # If they don't, check to see if we found zoning data
         else:
-            checkResponse = http_client.get(url, params=checkRequestData).json()
+            return self.parse_layer_attributes(checkResponse, response, "zoning")
 
-            # If it does, return the temp use data
-            if checkResponse['objectIds'] != None:
-                temp_use = http_client.get(url, params=requestData).json()['features'][0]['attributes']
-                logger.debug("Found temp use data")
-                return temp_use
 
-            # If it doesn't, log a warning and return the empty temp use object
-            else:
-                logger.warning("Could not find temp use data")
-                return temp_use
+    # Async version of get_zoning_data
+    @timed("zoning_data")
+    async def get_zoning_data_async(self, location):
+        client = get_async_http_client()
+        try:
+            checkResponse = (await client.get(ZONING_URL, params=self.layer_check_request_data(location, '9'))).json()
+            response = None
+            if checkResponse['objectIds'] != None:
+                response = (await client.get(ZONING_URL, params=self.layer_request_data(location, '9', ZONING_FIELDS))).json()
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return {}
+        else:
+            return self.parse_layer_attributes(checkResponse, response, "zoning")
 
 
-    # Accepts an address object and returns a list of any building permits
-    def get_building_permits(self, address):
+    # Accepts a location object and returns any temporary use applications
+    @timed("temp_use_data")
+    def get_temp_use_data(self, location):
 
-        # Create an empty building permits list
-        building_permits = []
+        # Check if the requests return an HTTP error
+        try:
+            checkResponse = self.sources['client'].get(ZONING_URL, params=self.layer_check_request_data(location, '20')).json()
 
-        # The URL for retrieving a session cookie from the Eplans application
-        cookieURL = "https://eplans.hamilton.ca/EPlansPortal/sfjsp?interviewID=Welcome"
+            # If the check response says there's temp use data, ask for it
+            response = None
+            if checkResponse['objectIds'] != None:
+                response = self.sources['client'].get(ZONING_URL, params=self.layer_request_data(location, '20', TEMP_USE_FIELDS)).json()
 
-        # Extract the raw session cookie from the http client's 'cookies' object
-        cookies = http_client.get(cookieURL, verify=False).cookies.get_dict()
-        cookie = "JSESSIONID="+cookies["JSESSIONID"]
-        http_client.cookies.clear()
+        # If they do, log the HTTP error and return an empty temp use data object
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return {}
 
-        # The URL for the application's session manager 
-        url = "https://eplans.hamilton.ca/EPlansPortal/sfjsp"
+        # If they don't, check to see if we found temp use data
+        else:
+            return self.parse_layer_attributes(checkResponse, response, "temp use")
 
-        # Assemble the request headers required to get a session 
-        headers = {"Cookie": cookie, "Host": "eplans.hamilton.ca"}
 
-        # Check if the request for a session returns an HTTP error
+    # Async version of get_temp_use_data
+    @timed("temp_use_data")
+    async def get_temp_use_data_async(self, location):
+        client = get_async_http_client()
         try:
-            session_response = http_client.post(url, data = {"e_1482930323468": "onclick"}, headers = headers, verify = False)
-
-        # If it does, log the HTTP error and return an empty building permits list
+            checkResponse = (await client.get(ZONING_URL, params=self.layer_check_request_data(location, '20'))).json()
+            response = None
+            if checkResponse['objectIds'] != None:
+                response = (await client.get(ZONING_URL, params=self.layer_request_data(location, '20', TEMP_USE_FIELDS))).json()
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return building_permits
-
-        # If it doesn't, time to query the app for permits
+            return {}
         else:
+            return self.parse_layer_attributes(checkResponse, response, "temp use")
 
-            # Construct an address string from the address object
-            if address.get('street_direction_long') is not None:
-                addressString = address['street_number']+';'+address['city']+';'+address['street_name']+';'+address['street_direction_long']+';'
-            else:
-                addressString = address['street_number']+';'+address['city']+';'+address['street_name']+';'
 
-            # Assemble the address string along with other required post parameters into the query request
-            request_data = {
-                    "d_1536239857790": "buildingnewconstructionpermit",
-                    "d_1537469348077": "address",
-                    "d_1536259115820": addressString,
-                    "e_1536239857797": "onclick"
-                }
+    # Accepts an address object and returns a list of any building permits
+    @timed("building_permits")
+    def get_building_permits(self, address):
+
+        # Construct an address string from the address object
+        addressString = self.permit_address_string(address)
 
-            # Check if the request for build permits returns an HTTP error
-            try:
-                http_client.post(url, data = request_data, headers = headers, verify = False)
+        # If the permit search is in the response cache, we don't need a session to read it
+        response = get_cached("POST", EPLANS_URL, data=self.permit_request_data(addressString))
+        if response is not None and not eplans_sessions.is_expired(response):
+            return self.sources['documents'].pages.read("permits", response.text, self.parse_building_permits, addressString)
 
-            # If it does, log the HTTP error and return an empty building permits list
-            except requests.exceptions.RequestException as e:
-                httpLogger.error(e)
-                return building_permits
+        # Check if the requests for a session or for building permits return an HTTP error
+        # The search uses a session from the pool, which only starts a new one if it has to
+        try:
+            response = eplans_sessions.search(self.permit_request_data(addressString))
 
-            # If it doesn't, get the response and pass it to BeautifulSoup
-            else:
-                response = BeautifulSoup(http_client.post(url, data = request_data, headers = headers, verify = False).text, "html.parser")
+        # If they do, log the HTTP error and return an empty building permits list
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return []
 
-                # If there are building permit records on the page
-                if response.find("div", {'class': 'panel-title'}):
+        # If they don't, pull the permits out of the response
+        else:
+            return self.sources['documents'].pages.read("permits", response.text, self.parse_building_permits, addressString)
 
-                    # Append them to the building permits list
-                    for row in response.find("span", text = re.compile("Application #")).parent.parent.parent.parent.tbody.find_all("tr"):
-                        permit = {}
-                        permit["application_number"] = row.find_all("td")[0].div.contents[0].strip().replace(" ", "")
-                        permit["description"] = row.find_all("td")[1].div.contents[0].strip()
-                        permit["status"] = row.find_all("td")[3].div.contents[0].strip()
-                        building_permits.append(permit)
-                    logger.debug("Found building permits for "+addressString)
 
-                # If there are no records, log a warning
-                else:
-                    logger.debug("Could not find building permits for "+addressString)
+    # Async version of get_building_permits
+    # Uses the same pool of Eplans sessions
+    @timed("building_permits")
+    async def get_building_permits_async(self, address):
+        addressString = self.permit_address_string(address)
+        response = get_cached("POST", EPLANS_URL, data=self.permit_request_data(addressString))
+        if response is not None and not eplans_sessions.is_expired(response):
+            return self.sources['documents'].pages.read("permits", response.text, self.parse_building_permits, addressString)
+        try:
+            response = await eplans_sessions.search_async(self.permit_request_data(addressString))
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return []
+        else:
+            return self.sources['documents'].pages.read("permits", response.text, self.parse_building_permits, addressString)
 
-                # Return the building permits object
-                return building_permits
 
     # Accepts an address object and returns a list of tax objects with roll number attributes, ready to be populated
+    @timed("taxes")
     def get_taxes(self, address):
 
-        # Create an empty list to add tax objects to
-        taxes = []
+        # Create the address string, e.g. Tisdale St S
+        addressString = self.tax_address_string(address)
 
-        # The query URL for the property inquiry application
-        url = "http://oldproperty.hamilton.ca/property-inquiry_noborders/list.asp"
-        # url = "https://httpstat.us/500"
-
-        # Create the address string from the street name and the short street type, e.g. 73 Tisdale St 
-        # The property inquiry app chokes on long street types, e.g. 73 Tisdale Street
-        addressString = address['street_name']+" "+address['street_type_short']
-
-        # Check to see if the street has a direction, and if so append the short version, e.g. 73 Tisdale St S
-        # The property inquiry app chokes on long street directions, e.g 73 Tisdale S South
-        if address.get('street_direction_short') is not None:
-            addressString = addressString+" "+address['street_direction_short']
-
-        # Map the city attribute to a 'community' value that the application accepts
-        if 'city' in address:
-            if address['city'] == "Hamilton":
-                community = "ham010081"
-            else:
-                if address['city'] == "Ancaster":
-                    community = "anc140140"
-                else:
-                    if address['city'] == "Dundas":
-                        community = "dun260260"
-                    else:
-                        if address['city'] == "Flamborough":
-                            community = "fla301303"
-                        else:
-                            if address['city'] == "Glanbrook":
-                                community = "gla901902"
-                            else:
-                                if address['city'] == "Stoney Creek":
-                                    community = "scr003003"
-                                else:
-                                    community = "all000999"
-        else:
-            community = "all000999"
-
-        # Append the address string along with other required parameters into the request body
-        requestData = {
-                "stnum": address['street_number'],
-                "address": addressString,
-                "community": community,
-                "B1": "Search"
-            }
+        # If we have a street index, the roll numbers may already be in it
+        taxes = self.street_index_taxes(address, addressString, fetch=True)
+        if taxes is not None:
+            return taxes
 
         # Check if the request returns an HTTP error
         try:
-            response = http_client.post(url, requestData)
+            response = self.sources['client'].post(TAX_LIST_URL, self.tax_request_data(address, addressString))
 
         # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
-            return taxes
+            return []
 
-        # If it doesn't, convert the HTML response to text and parse it with BeautifulSoup
+        # If it doesn't, pull the roll numbers out of the response
         else:
-            response = BeautifulSoup(http_client.post(url, requestData).text, "html.parser")
+            return self.parse_roll_numbers(response.text, address, addressString)
 
-            # If the response includes a list of properties, there is more than one roll number associated with the address
-            # That means we'll need to populate the taxes list with more than one tax object
-            if response.find("p", text = re.compile("Property List")):
-                logger.debug ("Found more than one roll number for "+address['street_number']+" "+addressString)
 
-                # Parse out the roll numbers and return them in a list    
-                roll_numbers = [href.get_text().strip() for href in response.find_all(href=re.compile("detail.asp"))]
+    # Async version of get_taxes
+    @timed("taxes")
+    async def get_taxes_async(self, address):
+        client = get_async_http_client()
+        addressString = self.tax_address_string(address)
 
-                # For each roll number in the list, append a tax object to the taxes list and add the roll number as an attribute
-                for r in roll_numbers:
-                    taxes.append({"roll_number": r})
-
-                # return the taxes list
-                return taxes
-
-            # If the response doesn't contain a list of properties, check to see if the response contains a single roll number
-            else:
-                if response.find("b", text = re.compile("Roll Number")):
+        # Only use streets that are already in the street index, because searching one would block the event loop
+        taxes = self.street_index_taxes(address, addressString, fetch=False)
+        if taxes is not None:
+            return taxes
+        try:
+            response = await client.post(TAX_LIST_URL, self.tax_request_data(address, addressString))
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return []
+        else:
+            return self.parse_roll_numbers(response.text, address, addressString)
 
-                    # If it does, return it
-                    roll_number = response.find("b", text = re.compile("Roll Number")).parent.parent.next_sibling.next_sibling.contents[0].strip() 
-                    logger.debug("Found the roll number for "+address['street_number']+" "+addressString)
-                    taxes = [{"roll_number": roll_number}]
-                    return taxes
 
-                # If it doesn't, log a warning and return nothing
-                else:
-                    logger.warning("No roll number for "+address['street_number']+" "+addressString)
-                    return taxes
+    # Accepts an address object and returns a list of tax objects with the roll numbers from the street index, or None
+    # if there's no street index or it doesn't know the address
+    # Searches the address's street if it hasn't been yet, unless fetch is False
+    def street_index_taxes(self, address, addressString, fetch):
+        street_index = self.sources['streets']
+        if street_index is None:
+            return None
+        roll_numbers = street_index.lookup(self, address, fetch)
+        if roll_numbers is None:
+            return None
+        logger.debug("Found %s roll number(s) for %s %s in the street index", len(roll_numbers), address['street_number'], addressString)
+        return [{"roll_number": roll_number} for roll_number in roll_numbers]
 
 
     # Accepts a tax object and appends an is_tax_exempt attribute
     # Tax object must have a a roll number attribute
-    def check_tax_exempt(self, tax):
- 
-        # The URL for querying by roll number against the Property Inquiry application 
-        url = "http://oldproperty.hamilton.ca/property-inquiry_noborders/detail.asp?qryrollno="+tax['roll_number']
-        # url = "https://httpstat.us/500"
+    # Optionally accepts a roll document cache so the detail page is only downloaded once per roll number
+    @timed("tax_exempt")
+    def check_tax_exempt(self, tax, documents=None):
 
-        # Check if the request returns an HTTP error
+        # Use a throwaway cache if we weren't given one
+        if documents is None:
+            documents = ls_hamilton_document_cache(client=self.sources['client'])
+
+        # Check if the request for the detail page returns an HTTP error
         try:
-            response = http_client.get(url)
+            document = documents.get(tax['roll_number'])
 
         # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
             httpLogger.error(e)
             return tax
 
-        # If it doesn't, parse the response with BeautifulSoup and check to see if it's exempt
+        # If it doesn't, check the page's data to see if it's exempt
         else:
-            if self.fetch(url).find_all("td", {"class": "bodycopy"}, text = re.compile("Exempt")):
+            if document['is_tax_exempt']:
 
                 # If it is, set is_tax_exempt to True, and return tax object
-                logger.debug(tax['roll_number']+" is tax exempt")
+                logger.debug("%s is tax exempt", tax['roll_number'])
                 tax["is_tax_exempt"] = True
                 return tax
 
             # If it isn't, set is_tax_exempt to False, and return tax object
             else:
-                logger.debug(tax['roll_number']+" is not tax exempt")
+                logger.debug("%s is not tax exempt", tax['roll_number'])
                 tax["is_tax_exempt"] = False
                 return tax
 
 
     # Accepts a tax object and appends a list of tax assessment years
     # Tax object must have a a roll number attribute
-    def get_tax_assessment_years(self, tax):
+    # Optionally accepts a roll document cache so the detail page is only downloaded once per roll number
+    @timed("tax_assessment_years")
+    def get_tax_assessment_years(self, tax, documents=None):
 
         # Create an empty list to populate with tax assessment years
         assessment_years = []
 
-        # URL for querying Property Inquiry application by roll number
-        url = "http://oldproperty.hamilton.ca/property-inquiry_noborders/detail.asp?qryrollno="+tax['roll_number']
-        # url = "https://httpstat.us/500"
+        # Use a throwaway cache if we weren't given one
+        if documents is None:
+            documents = ls_hamilton_document_cache(client=self.sources['client'])
 
-        # Check if the request returns an HTTP error
+        # Check if the request for the detail page returns an HTTP error
         try:
-            response = http_client.get(url)
+            document = documents.get(tax['roll_number'])
 
         # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
@@ -481,41 +879,32 @@ class ls_hamilton_property:
             tax["assessment_years"] = assessment_years
             return tax
 
-        # If it doesn't, convert the HTML response to text and parse it with BeautifulSoup
+        # If it doesn't, take the rows of the assessment table from the page's data
         else:
-
-            # For each row in the tax assessment table, create a record
-            for row in self.fetch(url).find("b", text = re.compile(r"Current Year Assessment")).parent.parent.parent.parent.find_all("tr"):
-                if not (row.find(text = re.compile("Year")) or row.find(text = re.compile("Total Assessment")) or row.find(text = re.compile("Current Year Assessment"))):
-                    assessment_year = {}
-                    assessment_year["year"] = row.find_all("td")[0].contents[0].strip()
-                    assessment_year["class"] = row.find_all("td")[1].contents[0].strip()
-                    assessment_year["description"] = row.find_all("td")[2].contents[0].strip()
-                    assessment_year["amount"] = row.find_all("td")[3].contents[0].strip().replace(",", "")
-                    
-                    # Append the record to the assessment years list
-                    assessment_years.append(assessment_year)
+            assessment_years.extend(document['assessment_years'])
 
             # Add the assessment years attribute to the tax object, and return it
             tax["assessment_years"] = assessment_years
-            logger.debug("Found tax assessment years for roll number "+tax['roll_number'])
+            logger.debug("Found tax assessment years for roll number %s", tax['roll_number'])
             return tax
 
 
     # Accepts a tax object and appends a list of tax levy years
     # Tax object must have a a roll number attribute
-    def get_tax_levy_years(self, tax):
+    # Optionally accepts a roll document cache so the detail page is only downloaded once per roll number
+    @timed("tax_levy_years")
+    def get_tax_levy_years(self, tax, documents=None):
 
         # Create an empty list to populate with tax levy years
         levy_years = []
 
-        # URL for querying Property Inquiry application by roll number
-        url = "http://oldproperty.hamilton.ca/property-inquiry_noborders/detail.asp?qryrollno="+tax['roll_number']
-        # url = "https://httpstat.us/500"
+        # Use a throwaway cache if we weren't given one
+        if documents is None:
+            documents = ls_hamilton_document_cache(client=self.sources['client'])
 
-        # Check if the request returns an HTTP error
+        # Check if the request for the detail page returns an HTTP error
         try:
-            response = http_client.get(url)
+            document = documents.get(tax['roll_number'])
 
         # If it does, log the HTTP error and return nothing
         except requests.exceptions.RequestException as e:
@@ -523,52 +912,670 @@ class ls_hamilton_property:
             tax["levy_years"] = levy_years
             return tax
 
-        # If it doesn't, convert the HTML response to text and parse it with BeautifulSoup
+        # If it doesn't, take the levy years from the page's data
         else:
 
             # Check to see if the property is tax exempt
             if not tax.get('is_tax_exempt'):
 
-                # If not, for each year in the tax levy table, add a year object
-                for row in self.fetch(url).find(text = re.compile("Tax Levy History")).parent.parent.parent.parent.parent.find_all("tr"):
-                    if not (row.find(text = re.compile("Tax Levy History")) or row.find(text = re.compile("Year"))):
-                        levy_year = {}
-                        levy_year["year"] = row.find_all("td")[1].contents[0].strip()
+                # If not, the page's data has the levy history, with the current year's breakdown and installments
+                # (The first year will always be the current year, for which the app breaks out amounts)
+                levy_years.extend(document['levy_years'] or [])
 
-                        # Add an amount object to the year object
-                        levy_year['amount'] = {}
+                # Add the levy years attribute to the tax object, and return it
+                tax["levy_years"] = levy_years
+                logger.debug("Found tax levy years for roll number %s", tax['roll_number'])
+                return tax
 
-                        # Add the total amount for the year
-                        levy_year["amount"]['total'] = row.find_all("td")[2].contents[0].strip().replace(",", "")
 
-                        # Append the record to the levy years list
-                        levy_years.append(levy_year) 
+# -- REQUEST DATA --
 
-                # For each row in the Breakdown table, add municipal and education levy attributes to the amount 
-                # record for the first levy year (The first year will always be the current year, for which the app 
-                # breaks out amounts)
-                for row in self.fetch(url).find(text = re.compile("Breakdown")).parent.parent.parent.parent.parent.find_all("tr"):
-                    if not (row.find(text = re.compile("Breakdown")) or row.find(text = re.compile("Type")) or row.find(text = re.compile("Total"))):
-                        levy_years[0]['amount'][row.find_all("td")[0].contents[0].strip().replace(" ", "_").lower()] = row.find_all("td")[1].contents[0].strip().replace(",", "")
 
-                # Add an empty installments list to first levy year object (The first year will always be the current year, 
-                # for which the app provides a table of installments)
-                levy_years[0]['installments'] = []
+    # Accepts a list of fields, a single field, or None for all of them, and raises a ValueError if any of them aren't
+    # in FIELDS
+    # Use this to check the fields for a lot of properties once, before building any of them
+    @staticmethod
+    def check_fields(fields):
+        if isinstance(fields, str):
+            fields = [fields]
+        unknown = [field for field in fields or () if field not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown property fields: "+", ".join(unknown)+". Choose from "+", ".join(FIELDS))
 
-                # For each row in the Installments table, append an installment object to the list (inc. date and amount)
-                for row in self.fetch(url).find_all(text = re.compile("Instalments"))[0].parent.parent.parent.parent.parent.find_all("tr"):
-                    if not (row.find(text = re.compile("Instalments")) or row.find(text = re.compile("Amount")) or row.find(text = re.compile("Total"))):
-                        levy_years[0]['installments'].append({'date': arrow.get(row.find_all("td")[1].contents[0].strip(), 'MMMM\xa0D,\xa0YYYY').format('MM/DD/YYYY'), 'amount': row.find_all("td")[2].contents[0].strip().replace(",", "")})
 
-                # Add the levy years attribute to the tax object, and return it
-                tax["levy_years"] = levy_years
-                logger.debug("Found tax levy years for roll number "+tax['roll_number'])
-                return tax
+    # Accepts an address object and formats it as a single-line string for the address search
+    @staticmethod
+    def location_address_string(address):
+        addressString = address['street_number']+" "+address['street_name']+" "+address['street_type_long']
+        if address.get('street_direction_long') is not None:
+            addressString = addressString+" "+address['street_direction_long']
+        if address.get('city') is not None:
+            addressString = addressString+" "+address['city']
+        return addressString
+
+
+    # Assembles the address string into a request for EPSG:4326 coordinates, along with other required parameters
+    def location_request_data(self, addressString):
+        return {'SingleLine': addressString, 'f': 'json', 'outSR': '{wkid: 4326}', 'outFields': '*', 'maxLocations': '1'}
+
+
+    # Assembles a list of address objects into a batch geocoding request for EPSG:4326 coordinates
+    # Each address is tagged with its position in the list, so we can match the results back up
+    @staticmethod
+    def location_batch_request_data(addresses):
+        records = [{'attributes': {'OBJECTID': i, 'SingleLine': ls_hamilton_property.location_address_string(address)}} for i, address in enumerate(addresses)]
+        return {'addresses': json.dumps({'records': records}), 'f': 'json', 'outSR': '4326'}
+
 
+    # Accepts a location object and formats it as a point geometry for the map services
+    def point_geometry(self, location):
+        return "{'x': "+str(location['EPSG:4326']['x'])+", 'y': "+str(location['EPSG:4326']['y'])+", 'spatialReference': '{'wkid': '4326'}'}"
 
-# -- UTILITY FUNCTIONS --
+
+    # Assembles the location data into a ward request, along with other required parameters
+    def ward_request_data(self, location):
+        return {
+                'f': 'json',
+                'outSR': '{wkid:4326}',
+                'geometryType': 'esriGeometryPoint',
+                'inSR': '{wkid:4326}',
+                'geometry': self.point_geometry(location),
+                'returnIdsOnly': 'true'
+            }
+
+
+    # Assembles the location object into query request data, including some other required parameters
+    # We use this request to check to see if a zoning map layer has anything at this location
+    def layer_check_request_data(self, location, layerId):
+        return {
+                'f': 'json',
+                'outSR': '{wkid:4326}',
+                'geometryType': 'esriGeometryPoint',
+                'inSR': '{wkid:4326}',
+                'geometry': self.point_geometry(location),
+                'returnIdsOnly': 'true',
+                'layer': "{'source':{'type':'mapLayer','mapLayerId': '"+layerId+"'}}"
+        }
+
+
+    # Assembles the location object into query request data, including some other required parameters
+    # We use this request to retrieve the data from a zoning map layer if the check comes back positive
+    def layer_request_data(self, location, layerId, outFields):
+        return {
+            'f': 'json',
+            'returnGeometry': 'false',
+            'outSR': '{wkid:4326}',
+            'geometryType': 'esriGeometryPoint',
+            'inSR': '{wkid:4326}',
+            'geometry': self.point_geometry(location),
+            'layer': "{'source':{'type':'mapLayer','mapLayerId': '"+layerId+"'}}",
+            'outFields': outFields
+        }
+
+
+    # Assembles the location object into a query for the zoning (9) and temporary use (20) layers at once,
+    # including some other required parameters
+    def zoning_layers_request_data(self, location):
+        return {
+            'f': 'json',
+            'returnGeometry': 'false',
+            'geometryType': 'esriGeometryPoint',
+            'spatialRel': 'esriSpatialRelIntersects',
+            'inSR': '{wkid:4326}',
+            'geometry': self.point_geometry(location),
+            'layerDefs': json.dumps([
+                {'layerId': 9, 'where': '1=1', 'outFields': ZONING_FIELDS},
+                {'layerId': 20, 'where': '1=1', 'outFields': TEMP_USE_FIELDS}
+            ])
+        }
 
 
-    # Makes a get request and returns the HTML response to the BeautifulSoup parser
-    def fetch(self, url):
-        return(BeautifulSoup(http_client.get(url).text, "html.parser"))
+    # Accepts an address object and formats it the way the Eplans application expects
+    def permit_address_string(self, address):
+        if address.get('street_direction_long') is not None:
+            return address['street_number']+';'+address['city']+';'+address['street_name']+';'+address['street_direction_long']+';'
+        else:
+            return address['street_number']+';'+address['city']+';'+address['street_name']+';'
+
+
+    # Assembles the address string along with other required post parameters into the permit query request
+    def permit_request_data(self, addressString):
+        return {
+                "d_1536239857790": "buildingnewconstructionpermit",
+                "d_1537469348077": "address",
+                "d_1536259115820": addressString,
+                "e_1536239857797": "onclick"
+            }
+
+
+    # Accepts an address object and formats it the way the property inquiry application expects
+    def tax_address_string(self, address):
+
+        # Create the address string from the street name and the short street type, e.g. 73 Tisdale St
+        # The property inquiry app chokes on long street types, e.g. 73 Tisdale Street
+        addressString = address['street_name']+" "+address['street_type_short']
+
+        # Check to see if the street has a direction, and if so append the short version, e.g. 73 Tisdale St S
+        # The property inquiry app chokes on long street directions, e.g 73 Tisdale S South
+        if address.get('street_direction_short') is not None:
+            addressString = addressString+" "+address['street_direction_short']
+        return addressString
+
+
+    # Accepts an address object and maps the city attribute to a 'community' value that the property inquiry application accepts
+    def community(self, address):
+        return COMMUNITIES.get(address.get('city'), ALL_COMMUNITIES)
+
+
+    # Appends the address string along with other required parameters into the request body for the property inquiry application
+    def tax_request_data(self, address, addressString):
+        return {
+                "stnum": address['street_number'],
+                "address": addressString,
+                "community": self.community(address),
+                "B1": "Search"
+            }
+
+
+# -- RESPONSE PARSERS --
+
+
+    # Accepts the address search response and returns a location object
+    def parse_location(self, response, addressString):
+        location = {}
+
+        # If the response contains candidate results, assemble them into a location object
+        if response["candidates"]:
+            location['EPSG:4326'] = response["candidates"][0]["location"]
+            location['EPSG:3857'] = web_mercator(location['EPSG:4326']['x'], location['EPSG:4326']['y'])
+            logger.debug("Found the location for %s", addressString)
+
+        # If it doesn't, log a warning and return nothing
+        else:
+            logger.warning("Can't find a location for %s", addressString)
+        return location
+
+
+    # Accepts a batch geocoding response and the number of addresses in the batch, and returns a list of location objects
+    # All of the matched points are projected to EPSG:3857 in one go
+    @staticmethod
+    def parse_locations(response, count):
+        locations = [{} for i in range(count)]
+
+        # Pick out the addresses that matched
+        matches = []
+        for result in response['locations']:
+            point = result.get('location') or {}
+            if result['attributes'].get('Status') != 'U' and isinstance(point.get('x'), (int, float)) and isinstance(point.get('y'), (int, float)):
+                matches.append((result['attributes']['ResultID'], point))
+        logger.debug("Found locations for %s of %s addresses", len(matches), count)
+
+        # Project them and assemble them into location objects
+        if matches:
+            xs, ys = web_mercator_array([point['x'] for i, point in matches], [point['y'] for i, point in matches])
+            for (i, point), x, y in zip(matches, xs.tolist(), ys.tolist()):
+                locations[i] = {'EPSG:4326': {'x': point['x'], 'y': point['y']}, 'EPSG:3857': {'x': x, 'y': y}}
+        return locations
+
+
+    # Accepts the ward query response and returns the ward
+    def parse_ward(self, response):
+
+        # If the reponse contains a ward object, return it
+        if response['objectIds'] != None:
+            ward = str(response['objectIds'][0])
+            logger.debug("Found ward %s", ward)
+            return ward
+        else:
+            logger.warning("Couldn't find the ward")
+            return None
+
+
+    # Accepts the check and query responses from a zoning map layer and returns its attributes
+    # The description is only used for logging, e.g. "zoning"
+    def parse_layer_attributes(self, checkResponse, response, description):
+
+        # If the check found something, return its data
+        if checkResponse['objectIds'] != None:
+            attributes = response['features'][0]['attributes']
+            logger.debug("Found %s data", description)
+            return attributes
+
+        # If it didn't, log a warning and return an empty object
+        else:
+            logger.warning("Could not find %s data", description)
+            return {}
+
+
+    # Accepts the response from a query of both zoning layers and returns the zoning data and the temp use data
+    def parse_zoning_layers(self, response):
+        features = {str(layer['id']): layer.get('features') or [] for layer in response['layers']}
+        found = []
+        for layerId, description in (('9', "zoning"), ('20', "temp use")):
+
+            # If the layer has something at this location, keep its data
+            if features.get(layerId):
+                found.append(features[layerId][0]['attributes'])
+                logger.debug("Found %s data", description)
+
+            # If it doesn't, log a warning and keep an empty object
+            else:
+                found.append({})
+                logger.warning("Could not find %s data", description)
+        return found[0], found[1]
+
+
+    # Accepts the HTML of an Eplans permit search and returns a list of building permits
+    def parse_building_permits(self, html, addressString):
+
+        # Pull the building permit records out of the page
+        building_permits = extract_building_permits(html)
+
+        # If there are building permit records on the page, return them
+        if building_permits is not None:
+            logger.debug("Found building permits for %s", addressString)
+            return building_permits
+
+        # If there are no records, log a warning and return an empty building permits list
+        else:
+            logger.debug("Could not find building permits for %s", addressString)
+            return []
+
+
+    # Accepts the HTML of a property inquiry search and returns a list of tax objects with roll number attributes
+    def parse_roll_numbers(self, html, address, addressString):
+
+        # Pull the roll numbers out of the page, and make a tax object for each one
+        roll_numbers, multiple = extract_roll_numbers(html)
+        taxes = [{"roll_number": r} for r in roll_numbers]
+
+        # If the response includes a list of properties, there is more than one roll number associated with the address
+        # That means we'll need to populate the taxes list with more than one tax object
+        if multiple:
+            logger.debug ("Found more than one roll number for %s %s", address['street_number'], addressString)
+            return taxes
+
+        # If the response doesn't contain a list of properties, check to see if the response contains a single roll number
+        else:
+            if taxes:
+                logger.debug("Found the roll number for %s %s", address['street_number'], addressString)
+                return taxes
+
+            # If it doesn't, log a warning and return nothing
+            else:
+                logger.warning("No roll number for %s %s", address['street_number'], addressString)
+                return taxes
+
+
+# Remembers a hash of every page a property reads, so a page that hasn't changed since the last time doesn't have to
+# be parsed again (see ls_hamilton_refresh.py)
+# Accepts a dict of page name to (hash, data) for the pages read last time, where data is what was read off the page
+# Pages are named "detail:" plus the roll number for detail pages, and "permits" for the permit search
+class ls_hamilton_page_memory:
+    def __init__(self, known=None):
+        self.known = known or {}
+        self.hashes = {}
+        self.unchanged = 0
+        self.lock = threading.Lock()
+
+
+    # Accepts the name of a page, its HTML, and a function (plus any extra arguments) that reads data out of the HTML
+    # Returns the data, reading the page only if it's changed
+    def read(self, name, html, parse, *args):
+        page_hash = hashlib.sha1(html.encode("utf-8")).hexdigest()
+        with self.lock:
+            self.hashes[name] = page_hash
+            known = self.known.get(name)
+            if known is not None and known[0] == page_hash:
+                self.unchanged = self.unchanged + 1
+                return known[1]
+        return parse(html, *args)
+
+
+# Detail pages that are being parsed right now, keyed by their HTML, so properties that read the same page at the same
+# time share one parse
+detail_parses = SingleFlight()
+
+
+# Cache for the Property Inquiry application's detail pages, keyed by roll number
+# The tax exemption, assessment and levy steps all read the same detail.asp page, so they share one of these
+# to download and parse each page exactly once. It also counts requests and parses per roll number so you
+# can keep an eye on how much each roll costs.
+# Optionally accepts a page memory, so detail pages that haven't changed since an earlier build aren't parsed again.
+# The property's other pages are remembered in the same page memory.
+# Optionally accepts a requests client to download the pages with.
+class ls_hamilton_document_cache:
+    def __init__(self, pages=None, client=http_client):
+        self.pages = ls_hamilton_page_memory() if pages is None else pages
+        self.client = client
+        self.documents = {}
+        self.errors = {}
+        self.requests = {}
+        self.parses = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.tasks = {}
+
+
+    # Accepts a roll number and returns the URL of its detail page
+    def url(self, roll_number):
+        return TAX_DETAIL_URL+roll_number
+
+
+    # Accepts a roll number and returns the data from its detail page, downloading it the first time it's asked for
+    # Raises the original HTTP error if the download failed, without asking the server again
+    # Safe to call from several threads; each roll number gets its own lock so different rolls download in parallel
+    def get(self, roll_number):
+        with self.lock:
+            roll_lock = self.locks.setdefault(roll_number, threading.Lock())
+        with roll_lock:
+            if roll_number in self.documents:
+                return self.documents[roll_number]
+            if roll_number in self.errors:
+                raise self.errors[roll_number]
+            self.requests[roll_number] = self.requests.get(roll_number, 0) + 1
+            try:
+                response = self.client.get(self.url(roll_number))
+            except requests.exceptions.RequestException as e:
+                self.errors[roll_number] = e
+                raise
+            return self.store(roll_number, response.text)
+
+
+    # Async version of get
+    # Coroutines asking for the same roll number at the same time share one download
+    async def get_async(self, roll_number):
+        if roll_number in self.documents:
+            return self.documents[roll_number]
+        if roll_number in self.errors:
+            raise self.errors[roll_number]
+        if roll_number not in self.tasks:
+            self.tasks[roll_number] = asyncio.ensure_future(self.download_async(roll_number))
+        return await asyncio.shield(self.tasks[roll_number])
+
+
+    # Downloads and parses the detail page for a roll number with the async client
+    async def download_async(self, roll_number):
+        self.requests[roll_number] = self.requests.get(roll_number, 0) + 1
+        try:
+            response = await get_async_http_client().get(self.url(roll_number))
+        except requests.exceptions.RequestException as e:
+            self.errors[roll_number] = e
+            raise
+        finally:
+            self.tasks.pop(roll_number, None)
+        return self.store(roll_number, response.text)
+
+
+    # Pulls the data out of a downloaded detail page and keeps it for the next step
+    # Only the extracted data is kept, not the parse tree
+    def store(self, roll_number, html):
+        self.documents[roll_number] = self.pages.read("detail:"+roll_number, html, self.parse, roll_number)
+        return self.documents[roll_number]
+
+
+    # Pulls the data out of a detail page and counts the parse
+    # If another property is parsing the same page right now, waits for its data instead of parsing the page again
+    def parse(self, html, roll_number):
+        document, shared = detail_parses.do(html, extract_detail, html)
+        if not shared:
+            self.parses[roll_number] = self.parses.get(roll_number, 0) + 1
+        return document
+
+
+    # Returns the number of detail page requests made for a roll number
+    def request_count(self, roll_number):
+        return self.requests.get(roll_number, 0)
+
+
+    # Returns the number of times the detail page for a roll number was parsed
+    def parse_count(self, roll_number):
+        return self.parses.get(roll_number, 0)
+
+
+    # Drops the cached pages and errors but keeps the counters
+    def clear(self):
+        with self.lock:
+            self.documents.clear()
+            self.errors.clear()
+            self.locks.clear()
+
+
+# A requests client for Eplans that shares every other client's connections, retries and cache, but never keeps cookies
+# Each Eplans session's cookie is passed along in the request headers instead, so threads can't mix them up
+eplans_client = create_client(keep_cookies=False)
+
+
+# Pool of Eplans sessions that have already been through the Welcome interview, ready for permit searches
+# Starting a session takes two requests, so sessions are handed back to the pool after each search and reused.
+# Each session is only used for one search at a time, and only size sessions are ever open at once, so when they're
+# all busy, searches wait for one to come free instead of starting another. A session is retired once it's older than
+# max_age, or as soon as a search comes back with the Welcome interview on it, which means Eplans has forgotten it.
+# Safe to share between threads and event loops. Threads wait on a condition and coroutines wait on futures, the same
+# way they do for a host's concurrency limit (see rate_limit.py).
+class ls_hamilton_eplans_session_pool:
+    def __init__(self, size=EPLANS_POOL_SIZE, max_age=EPLANS_SESSION_MAX_AGE):
+        self.size = size
+        self.max_age = max_age
+        self.idle = collections.deque()
+        self.open = 0
+        self.condition = threading.Condition()
+        self.waiters = collections.deque()
+        self.started = 0
+        self.reused = 0
+        self.expired = 0
+        self.waited = 0
+
+
+    # Takes the freshest idle session, or room for a new one if fewer than size sessions are open
+    # Returns whether it got either, and the session, which is None if the caller should start a new one
+    # Has to be called with the condition held
+    def claim(self):
+        while self.idle:
+            session = self.idle.pop()
+            if time.monotonic() - session['started'] < self.max_age:
+                self.reused = self.reused + 1
+                return True, session
+
+            # Sessions go back on the right, so everything else in the pool is even older
+            self.open = self.open - len(self.idle) - 1
+            self.idle.clear()
+        if self.open < self.size:
+            self.open = self.open + 1
+            return True, None
+        return False, None
+
+
+    # Waits for a session to search with, but not past the deadline
+    # Returns the freshest idle session, or None if the caller should start a new one, and then either hand it back
+    # with release or give up its place with discard
+    def take(self):
+        with self.condition:
+            claimed, session = self.claim()
+            if claimed:
+                return session
+            self.waited = self.waited + 1
+            while not claimed:
+                left = remaining()
+                if left == 0:
+                    break
+                self.condition.wait(left)
+                claimed, session = self.claim()
+        if not claimed:
+            self.give_up()
+        return session
+
+
+    # Async version of take
+    async def take_async(self):
+        loop = asyncio.get_running_loop()
+        waited = False
+        while True:
+            with self.condition:
+                claimed, session = self.claim()
+                if claimed:
+                    return session
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+                if not waited:
+                    self.waited = self.waited + 1
+                    waited = True
+            try:
+                await asyncio.wait_for(future, remaining())
+            except asyncio.TimeoutError:
+                self.give_up()
+
+
+    # Counts a search that gave up waiting for a session against the permit search, so the record's status shows it,
+    # and raises DeadlineExceeded
+    def give_up(self):
+        record_failure(short_circuited=True)
+        raise DeadlineExceeded("The deadline passed while the permit search waited for an Eplans session")
+
+
+    # Accepts a session that's just finished a search and puts it back in the pool for the next one
+    def release(self, session):
+        with self.condition:
+            self.idle.append(session)
+            self.notify()
+
+
+    # Gives up the place of a session that won't be handed back, because it failed or was never started
+    def discard(self):
+        with self.condition:
+            self.open = self.open - 1
+            self.notify()
+
+
+    # Wakes up every thread and coroutine waiting for a session, so they can check for one
+    # Has to be called with the condition held
+    def notify(self):
+        self.condition.notify_all()
+        waiters = list(self.waiters)
+        self.waiters.clear()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+
+    # Starts a session and puts it in the pool, so the first permit search doesn't have to, unless there's an idle one
+    # already
+    def warm(self):
+        session = self.take()
+        try:
+            if session is None:
+                session = self.start()
+        except BaseException:
+            self.discard()
+            raise
+        self.release(session)
+
+
+    # Accepts a session cookie and returns a new session object with the request headers it needs
+    def session(self, jsessionid):
+        with self.condition:
+            self.started = self.started + 1
+        return {'headers': {"Cookie": "JSESSIONID="+jsessionid, "Host": "eplans.hamilton.ca"}, 'started': time.monotonic()}
+
+
+    # Starts a new session: gets a session cookie from the Welcome interview, then takes the session past it
+    # Session requests are never answered from or stored in the response cache
+    def start(self):
+        session = self.session(eplans_client.get(EPLANS_COOKIE_URL, headers = EPLANS_SESSION_HEADERS, verify = False).cookies["JSESSIONID"])
+        eplans_client.post(EPLANS_URL, data = EPLANS_WELCOME_DATA, headers = dict(session['headers'], **EPLANS_SESSION_HEADERS), verify = False)
+        logger.debug("Started a new Eplans session")
+        return session
+
+
+    # Async version of start
+    async def start_async(self):
+        client = get_async_http_client()
+        session = self.session((await client.get(EPLANS_COOKIE_URL, headers = EPLANS_SESSION_HEADERS, verify = False)).cookies["JSESSIONID"])
+        await client.post(EPLANS_URL, data = EPLANS_WELCOME_DATA, headers = dict(session['headers'], **EPLANS_SESSION_HEADERS), verify = False)
+        logger.debug("Started a new Eplans session")
+        return session
+
+
+    # Accepts a response from Eplans and returns True if it shows the session has expired
+    def is_expired(self, response):
+        return EPLANS_WELCOME_MARKER in response.text
+
+
+    # Accepts permit search request data, runs the search on a pooled session and returns the response
+    # If the pooled session turns out to have expired, starts a new one and searches again
+    # Search results are stored in the response cache, but a Welcome interview never is
+    # Raises the usual requests exceptions if Eplans returns an HTTP error, and an HTTPError if even a new session
+    # lands on the Welcome interview
+    # A session whose search fails is thrown away, and its place goes to the next search
+    def search(self, data):
+        session = self.take()
+        try:
+            if session is not None:
+                response = eplans_client.post(EPLANS_URL, data = data, headers = dict(session['headers'], **EPLANS_SEARCH_HEADERS), verify = False)
+                if not self.is_expired(response):
+                    self.finish(session, data, response)
+                    return response
+                self.retire()
+            session = self.start()
+            response = eplans_client.post(EPLANS_URL, data = data, headers = dict(session['headers'], **EPLANS_SEARCH_HEADERS), verify = False)
+            if self.is_expired(response):
+                self.fail(response)
+            self.finish(session, data, response)
+            return response
+        except BaseException:
+            self.discard()
+            raise
+
+
+    # Async version of search
+    async def search_async(self, data):
+        client = get_async_http_client()
+        session = await self.take_async()
+        try:
+            if session is not None:
+                response = await client.post(EPLANS_URL, data = data, headers = dict(session['headers'], **EPLANS_SEARCH_HEADERS), verify = False)
+                if not self.is_expired(response):
+                    self.finish(session, data, response)
+                    return response
+                self.retire()
+            session = await self.start_async()
+            response = await client.post(EPLANS_URL, data = data, headers = dict(session['headers'], **EPLANS_SEARCH_HEADERS), verify = False)
+            if self.is_expired(response):
+                self.fail(response)
+            self.finish(session, data, response)
+            return response
+        except BaseException:
+            self.discard()
+            raise
+
+
+    # Accepts the response from a new session that landed on the Welcome interview, counts it against the permit search
+    # so the record's status shows it, and raises an HTTPError
+    def fail(self, response):
+        record_failure()
+        raise requests.exceptions.HTTPError("Eplans answered a new session with the Welcome interview instead of the permit search", response=response)
+
+
+    # Accepts a session whose search worked, the search request data and the response, stores the response in the
+    # response cache and puts the session back in the pool
+    def finish(self, session, data, response):
+        store_cached("POST", EPLANS_URL, response, data=data)
+        self.release(session)
+
+
+    # Counts an expired session
+    def retire(self):
+        with self.condition:
+            self.expired = self.expired + 1
+        logger.debug("An Eplans session expired, starting a new one")
+
+
+    # Throws away every idle session
+    def clear(self):
+        with self.condition:
+            self.open = self.open - len(self.idle)
+            self.idle.clear()
+            self.notify()
+
+
+# The Eplans session pool shared by every property
+eplans_sessions = ls_hamilton_eplans_session_pool()
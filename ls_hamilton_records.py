@@ -0,0 +1,326 @@
+from ls_hamilton_property_class import FIELDS
+import argparse
+import datetime
+import json
+import re
+import numpy
+
+
+# Compact, typed versions of the property record, for holding a lot of properties in memory at once
+#
+# The property object keeps everything as nested dicts of strings, the way it comes off the city's pages. These
+# records keep the same data in classes with __slots__, with amounts parsed into numbers, years into ints and
+# instalment dates into dates, once:
+#   record = ls_hamilton_records.from_property(my_prop)
+#   record.taxes[1].levy_years[0].amounts['total']   # 19393.86
+#
+# record.to_dict() (or dumps(record)) gives back exactly the same JSON as the property object, so records can be
+# written out in the same format the batch runner writes. To load a batch runner output file and flatten the tax
+# history into NumPy arrays for analysis:
+#   python ls_hamilton_records.py properties.ndjson properties.npz
+#
+# Anything that doesn't look the way we expect (an amount with no cents where there should be, a blank year) is
+# kept as the original string, so it still comes back out unchanged.
+
+# Assessment amounts are whole dollars, and levy and instalment amounts are dollars and cents
+WHOLE_AMOUNT = re.compile(r"-?\d+\Z")
+CENTS_AMOUNT = re.compile(r"-?\d+\.\d\d\Z")
+
+# The tables the columnar export flattens records into, and their columns
+# Every table has a 'property' column with the position of the record the row came from
+COLUMNS = {
+    'taxes': ('property', 'roll_number', 'is_tax_exempt'),
+    'assessment_years': ('property', 'roll_number', 'year', 'class', 'description', 'amount'),
+    'levy_years': ('property', 'roll_number', 'year', 'total'),
+    'levy_amounts': ('property', 'roll_number', 'year', 'type', 'amount'),
+    'installments': ('property', 'roll_number', 'year', 'date', 'amount'),
+    'building_permits': ('property', 'application_number', 'description', 'status')
+}
+
+
+# -- PARSING AND FORMATTING --
+
+
+# Accepts an amount string from an assessment row, e.g. "637400", and returns it as an int
+def parse_whole_amount(text):
+    return int(text) if WHOLE_AMOUNT.match(text) else text
+
+
+# Accepts an amount string from a levy or instalment row, e.g. "19393.86", and returns it as a float
+def parse_cents_amount(text):
+    return float(text) if CENTS_AMOUNT.match(text) else text
+
+
+# Accepts an amount parsed with parse_cents_amount and returns the string it came from
+def format_cents_amount(amount):
+    return amount if isinstance(amount, str) else "%.2f" % amount
+
+
+# Accepts a year string, e.g. "2022", and returns it as an int
+def parse_year(text):
+    return int(text) if text.isdigit() else text
+
+
+# Accepts an instalment date in MM/DD/YYYY format and returns it as a date
+def parse_date(text):
+    try:
+        month, day, year = text.split("/")
+        return datetime.date(int(year), int(month), int(day))
+    except ValueError:
+        return text
+
+
+# Accepts a date parsed with parse_date and returns it in MM/DD/YYYY format
+def format_date(date):
+    return date if isinstance(date, str) else "%02d/%02d/%04d" % (date.month, date.day, date.year)
+
+
+# -- RECORDS --
+# Each record has a from_dict class method that reads the matching part of a property object, and a to_dict method
+# that gives it back. Parts of the property object that can be missing (levy years for tax exempt properties, fields
+# that weren't asked for) are left unset, and left out again by to_dict.
+
+
+# One row of a property's tax assessment
+class ls_hamilton_assessment_year:
+    __slots__ = ('year', 'property_class', 'description', 'amount')
+
+    def __init__(self, year, property_class, description, amount):
+        self.year = year
+        self.property_class = property_class
+        self.description = description
+        self.amount = amount
+
+    @classmethod
+    def from_dict(cls, assessment_year):
+        return cls(parse_year(assessment_year['year']), assessment_year['class'], assessment_year['description'], parse_whole_amount(assessment_year['amount']))
+
+    def to_dict(self):
+        return {"year": str(self.year), "class": self.property_class, "description": self.description, "amount": str(self.amount)}
+
+
+# One instalment of a year's tax levy
+class ls_hamilton_installment:
+    __slots__ = ('date', 'amount')
+
+    def __init__(self, date, amount):
+        self.date = date
+        self.amount = amount
+
+    @classmethod
+    def from_dict(cls, installment):
+        return cls(parse_date(installment['date']), parse_cents_amount(installment['amount']))
+
+    def to_dict(self):
+        return {'date': format_date(self.date), 'amount': format_cents_amount(self.amount)}
+
+
+# One year of a property's tax levy
+# amounts holds the total and, for the current year, the breakdown by type, e.g. {'total': 19393.86, 'municipal_levy': ...}
+# installments is only set for the current year
+class ls_hamilton_levy_year:
+    __slots__ = ('year', 'amounts', 'installments')
+
+    def __init__(self, year, amounts, installments=None):
+        self.year = year
+        self.amounts = amounts
+        if installments is not None:
+            self.installments = installments
+
+    @classmethod
+    def from_dict(cls, levy_year):
+        amounts = {name: parse_cents_amount(amount) for name, amount in levy_year['amount'].items()}
+        installments = None
+        if 'installments' in levy_year:
+            installments = [ls_hamilton_installment.from_dict(installment) for installment in levy_year['installments']]
+        return cls(parse_year(levy_year['year']), amounts, installments)
+
+    def to_dict(self):
+        levy_year = {"year": str(self.year), "amount": {name: format_cents_amount(amount) for name, amount in self.amounts.items()}}
+        if hasattr(self, 'installments'):
+            levy_year['installments'] = [installment.to_dict() for installment in self.installments]
+        return levy_year
+
+
+# The tax details for one roll number
+class ls_hamilton_tax:
+    __slots__ = ('roll_number', 'is_tax_exempt', 'assessment_years', 'levy_years')
+
+    def __init__(self, roll_number):
+        self.roll_number = roll_number
+
+    @classmethod
+    def from_dict(cls, tax):
+        self = cls(tax['roll_number'])
+        if 'is_tax_exempt' in tax:
+            self.is_tax_exempt = tax['is_tax_exempt']
+        if 'assessment_years' in tax:
+            self.assessment_years = [ls_hamilton_assessment_year.from_dict(assessment_year) for assessment_year in tax['assessment_years']]
+        if 'levy_years' in tax:
+            self.levy_years = None if tax['levy_years'] is None else [ls_hamilton_levy_year.from_dict(levy_year) for levy_year in tax['levy_years']]
+        return self
+
+    def to_dict(self):
+        tax = {'roll_number': self.roll_number}
+        if hasattr(self, 'is_tax_exempt'):
+            tax['is_tax_exempt'] = self.is_tax_exempt
+        if hasattr(self, 'assessment_years'):
+            tax['assessment_years'] = [assessment_year.to_dict() for assessment_year in self.assessment_years]
+        if hasattr(self, 'levy_years'):
+            tax['levy_years'] = None if self.levy_years is None else [levy_year.to_dict() for levy_year in self.levy_years]
+        return tax
+
+
+# One building permit
+class ls_hamilton_building_permit:
+    __slots__ = ('application_number', 'description', 'status')
+
+    def __init__(self, application_number, description, status):
+        self.application_number = application_number
+        self.description = description
+        self.status = status
+
+    @classmethod
+    def from_dict(cls, permit):
+        return cls(permit['application_number'], permit['description'], permit['status'])
+
+    def to_dict(self):
+        return {"application_number": self.application_number, "description": self.description, "status": self.status}
+
+
+# A whole property
+# The address, location, zoning and temp use objects are kept as they are, since their attributes come straight from
+# the city's map services. Only the fields the property object had are set, along with its status if it had one.
+class ls_hamilton_property_record:
+    __slots__ = FIELDS + ('status',)
+
+    @classmethod
+    def from_dict(cls, record):
+        self = cls()
+        for field in self.__slots__:
+            if field not in record:
+                continue
+            value = record[field]
+            if field == 'taxes':
+                value = [ls_hamilton_tax.from_dict(tax) for tax in value]
+            elif field == 'building_permits':
+                value = [ls_hamilton_building_permit.from_dict(permit) for permit in value]
+            setattr(self, field, value)
+        return self
+
+    # Returns the record in exactly the same shape as the property object it came from
+    def to_dict(self):
+        record = {}
+        for field in self.__slots__:
+            if not hasattr(self, field):
+                continue
+            value = getattr(self, field)
+            if field == 'taxes':
+                value = [tax.to_dict() for tax in value]
+            elif field == 'building_permits':
+                value = [permit.to_dict() for permit in value]
+            record[field] = value
+        return record
+
+
+# Accepts a property object and returns it as a typed record
+def from_property(prop):
+    return ls_hamilton_property_record.from_dict(prop.to_dict())
+
+
+# Accepts a typed record and returns it as a JSON string, in the same shape as json.dumps(my_prop.__dict__)
+def dumps(record):
+    return json.dumps(record.to_dict())
+
+
+# Accepts a JSON string of a property object and returns it as a typed record
+def loads(text):
+    return ls_hamilton_property_record.from_dict(json.loads(text))
+
+
+# Accepts the path to an NDJSON file written by the batch runner and yields a typed record for each line
+def read_records(path):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+# -- COLUMNAR EXPORT --
+
+
+# Accepts an amount or year and returns it as a float, or NaN if it couldn't be parsed
+def number_or_nan(value):
+    return numpy.nan if isinstance(value, str) else float(value)
+
+
+# Accepts a parsed year and returns it as an int, or 0 if it couldn't be parsed
+def year_or_zero(value):
+    return 0 if isinstance(value, str) else value
+
+
+# Accepts a parsed date and returns it as a NumPy date, or NaT if it couldn't be parsed
+def date_or_nat(value):
+    return numpy.datetime64("NaT", "D") if isinstance(value, str) else numpy.datetime64(value, "D")
+
+
+# Accepts a list of typed records and flattens their taxes, tax history and building permits into tables of NumPy
+# arrays, one row per assessment year, levy year, etc.
+# Returns a dict of table name to a dict of column name to array (see COLUMNS)
+# Amounts are floats in dollars and missing or unreadable ones are NaN, years are ints (0 if unreadable), and
+# instalment dates are datetime64 days.
+def to_columns(records):
+    rows = {table: {column: [] for column in columns} for table, columns in COLUMNS.items()}
+
+    # Adds a row to a table, in COLUMNS order
+    def add(table, *values):
+        for column, value in zip(COLUMNS[table], values):
+            rows[table][column].append(value)
+
+    for index, record in enumerate(records):
+        for tax in getattr(record, 'taxes', None) or []:
+            add('taxes', index, tax.roll_number, bool(getattr(tax, 'is_tax_exempt', False)))
+            for assessment_year in getattr(tax, 'assessment_years', None) or []:
+                add('assessment_years', index, tax.roll_number, year_or_zero(assessment_year.year), assessment_year.property_class, assessment_year.description, number_or_nan(assessment_year.amount))
+            for levy_year in getattr(tax, 'levy_years', None) or []:
+                year = year_or_zero(levy_year.year)
+                add('levy_years', index, tax.roll_number, year, number_or_nan(levy_year.amounts.get('total', "")))
+                for name, amount in levy_year.amounts.items():
+                    if name != 'total':
+                        add('levy_amounts', index, tax.roll_number, year, name, number_or_nan(amount))
+                for installment in getattr(levy_year, 'installments', []):
+                    add('installments', index, tax.roll_number, year, date_or_nat(installment.date), number_or_nan(installment.amount))
+        for permit in getattr(record, 'building_permits', None) or []:
+            add('building_permits', index, permit.application_number, permit.description, permit.status)
+
+    # Give every column a proper type, even when the table is empty
+    types = {'property': numpy.int32, 'is_tax_exempt': bool, 'year': numpy.int32, 'amount': numpy.float64, 'total': numpy.float64, 'date': 'datetime64[D]'}
+    return {table: {column: numpy.array(values, dtype=types.get(column, str)) for column, values in columns.items()} for table, columns in rows.items()}
+
+
+# Accepts the tables from to_columns and a file path, and saves them there as a compressed NumPy archive, with each
+# column stored as table.column, e.g. levy_years.total
+def save_columns(columns, path):
+    arrays = {table+"."+column: values for table, table_columns in columns.items() for column, values in table_columns.items()}
+    with open(path, 'wb') as f:
+        numpy.savez_compressed(f, **arrays)
+
+
+# Accepts the path to an archive saved with save_columns and returns the tables
+def load_columns(path):
+    columns = {}
+    with numpy.load(path, allow_pickle=False) as arrays:
+        for name in arrays.files:
+            table, column = name.split(".", 1)
+            columns.setdefault(table, {})[column] = arrays[name]
+    return columns
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Flatten the tax history and building permits in a batch runner output file into NumPy arrays")
+    parser.add_argument("input", help="NDJSON file of property records, e.g. from ls_hamilton_batch.py")
+    parser.add_argument("output", help="file to save the arrays to, e.g. properties.npz")
+    args = parser.parse_args()
+    columns = to_columns(list(read_records(args.input)))
+    save_columns(columns, args.output)
+    print("Saved "+", ".join(str(len(table['property']))+" "+name for name, table in columns.items())+" to "+args.output)
\ No newline at end of file
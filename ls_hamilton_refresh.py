@@ -0,0 +1,234 @@
+import ls_hamilton_property_class
+from ls_hamilton_property_class import FIELDS, SPATIAL_FIELDS, ls_hamilton_property, ls_hamilton_document_cache, ls_hamilton_page_memory
+import ls_hamilton_spatial_index
+from ls_hamilton_batch import read_chunks
+from application.core.utils.http_client import create_client
+from application.core.utils.logger import logger
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import time
+
+
+# Brings stored property records up to date without rebuilding them from scratch
+#
+# Every section of a record has a freshness policy (REFRESH_POLICY). Refreshing a record only looks up the sections
+# that are older than their policy allows, reuses the stored location so the address isn't geocoded again, and
+# skips reading detail and permit pages that haven't changed since the last time (their hashes are kept with the
+# record). It also works out what changed.
+#
+#   record, metadata, changes = ls_hamilton_refresh.refresh(record, metadata)
+#
+# The metadata is a small dict that says when each section was last looked up, and the hashes of the pages it was
+# read from. Keep it next to the record and pass it back in next time. Without it, every section except the location
+# is looked up again, and the metadata that comes back makes the next refresh incremental.
+#
+# Sections listed in the record's status (because a server was down or a request failed when it was built) are always
+# looked up again, whatever their age. A section that can't be looked up properly this time either keeps what it had.
+#
+# To refresh a whole file written by the batch runner, with the metadata kept in a file next to it:
+#   python ls_hamilton_refresh.py properties.ndjson refreshed.ndjson --changes changes.ndjson
+
+# Set how old each section can get before it's looked up again, in seconds
+# None means the section is never looked up again once we have it (an empty location is always looked up again)
+# Ward, zoning and temp use come from the same lookup, so if one of them is stale they're all looked up again
+DAY = 24 * 60 * 60
+REFRESH_POLICY = {
+    'location': None,
+    'taxes': 7 * DAY,
+    'ward': 30 * DAY,
+    'zoning': 30 * DAY,
+    'temp_use': 30 * DAY,
+    'building_permits': 1 * DAY
+}
+
+# Set the most changes to report for a single record, so one rewritten section doesn't flood the change log
+MAX_CHANGES = 50
+
+# The attribute that identifies each item in a list, so lists are compared item by item even if their order changes
+LIST_KEYS = ('roll_number', 'application_number', 'year', 'date')
+
+# Set how many records to refresh at once from the command line
+DEFAULT_WORKERS = 8
+
+
+# Accepts a record, its metadata, the time now and a refresh policy, and returns the set of fields to look up again
+def stale_fields(record, metadata, now, policy=REFRESH_POLICY):
+    fetched = metadata.get('fetched', {})
+    stale = {field for field in record.get('status', {}) if field in record}
+    for field in record:
+        if field in ('address', 'status'):
+            continue
+        max_age = policy.get(field)
+        if field == 'location':
+            if not record[field]:
+                stale.add(field)
+        elif field not in fetched:
+            stale.add(field)
+        elif max_age is not None and now - fetched[field] > max_age:
+            stale.add(field)
+
+    # Ward, zoning and temp use are looked up together
+    if stale & SPATIAL_FIELDS:
+        stale.update(SPATIAL_FIELDS & set(record))
+    return stale
+
+
+# Accepts a record and its metadata, and returns what the record's detail and permit pages said, keyed by page name,
+# with the hash each page had, ready for ls_hamilton_page_memory
+def known_pages(record, metadata):
+    hashes = metadata.get('pages', {})
+    known = {}
+    for tax in record.get('taxes') or []:
+        name = "detail:"+tax['roll_number']
+        if name in hashes and 'assessment_years' in tax:
+            known[name] = (hashes[name], {'is_tax_exempt': tax.get('is_tax_exempt'), 'assessment_years': tax['assessment_years'], 'levy_years': tax.get('levy_years')})
+    if "permits" in hashes and 'building_permits' in record:
+        known["permits"] = (hashes["permits"], record['building_permits'])
+    return known
+
+
+# Accepts an old and a new value and yields (path, old, new) for every part of them that's different
+# Dicts are compared key by key, and lists item by item, matching items up by LIST_KEYS when they have one
+def changes_between(old, new, path):
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in list(old) + [key for key in new if key not in old]:
+            yield from changes_between(old.get(key), new.get(key), path+"."+key)
+    elif isinstance(old, list) and isinstance(new, list):
+        key = list_key(old, new)
+        if key is None:
+            for index in range(max(len(old), len(new))):
+                yield from changes_between(old[index] if index < len(old) else None, new[index] if index < len(new) else None, path+"["+str(index)+"]")
+        else:
+            old_items = {item[key]: item for item in old}
+            new_items = {item[key]: item for item in new}
+            for value in list(old_items) + [value for value in new_items if value not in old_items]:
+                yield from changes_between(old_items.get(value), new_items.get(value), path+"["+key+"="+str(value)+"]")
+    elif old != new:
+        yield path, old, new
+
+
+# Accepts two lists of items and returns the attribute from LIST_KEYS that tells the items in each of them apart, or
+# None if there isn't one
+def list_key(old, new):
+    for key in LIST_KEYS:
+        if all(is_unique_key(items, key) for items in (old, new)):
+            return key
+    return None
+
+
+# Accepts a list of items and an attribute, and returns True if every item has a different, hashable value for it
+def is_unique_key(items, key):
+    if not all(isinstance(item, dict) and isinstance(item.get(key), (str, int)) for item in items):
+        return False
+    return len({item[key] for item in items}) == len(items)
+
+
+# Accepts an old and a new record and returns a list of what changed, as {'path': ..., 'old': ..., 'new': ...} dicts
+# Reports at most MAX_CHANGES changes
+def diff(old, new):
+    changes = []
+    for path, old_value, new_value in changes_between(old, new, ""):
+        if len(changes) >= MAX_CHANGES:
+            break
+        changes.append({'path': path[1:], 'old': old_value, 'new': new_value})
+    return changes
+
+
+# Accepts a stored property record and its metadata (or None if there isn't any), and looks up the stale sections
+# Returns the refreshed record, its new metadata and a list of what changed
+# Optionally accepts the time now, a refresh policy, a concurrency level and a spatial index, like the class does
+def refresh(record, metadata=None, now=None, policy=REFRESH_POLICY, concurrency=ls_hamilton_property_class.DEFAULT_CONCURRENCY, spatial_index=None):
+    if metadata is None:
+        metadata = {}
+    if now is None:
+        now = time.time()
+    stale = stale_fields(record, metadata, now, policy)
+    new_metadata = {'fetched': dict(metadata.get('fetched', {})), 'pages': dict(metadata.get('pages', {}))}
+    if not stale:
+        return record, new_metadata, []
+
+    # Reuse the stored location unless it's the thing that's stale
+    location = None if 'location' in stale or 'location' not in record else record['location']
+    client = create_client(concurrency)
+    documents = ls_hamilton_document_cache(ls_hamilton_page_memory(known_pages(record, metadata)), client)
+    prop = ls_hamilton_property(address=record['address'], documents=documents, concurrency=concurrency, location=location, spatial_index=spatial_index, fields=stale, client=client)
+
+    # Keep the record's fields in the order they were in, and only replace the stale ones
+    # A stale section that's missing something this time only replaces one that was missing something already
+    old_status = record.get('status', {})
+    new_status = prop.section_status()
+    replaced = {field for field in stale if field not in new_status or field in old_status}
+    refreshed = {field: getattr(prop, field) if field in replaced else value for field, value in record.items() if field != 'status'}
+    for field in replaced - set(new_status):
+        new_metadata['fetched'][field] = now
+
+    # Keep the status of the sections that weren't replaced, and add the ones that are still missing something
+    status = {field: state for field, state in old_status.items() if field not in replaced}
+    status.update({field: new_status[field] for field in replaced if field in new_status})
+    if status:
+        refreshed['status'] = {field: status[field] for field in FIELDS if field in status}
+
+    # Keep the hashes of the pages we read, and forget the ones for roll numbers the property doesn't have any more
+    if 'taxes' in stale:
+        new_metadata['pages'] = {name: page_hash for name, page_hash in new_metadata['pages'].items() if not name.startswith("detail:")}
+    new_metadata['pages'].update(documents.pages.hashes)
+    logger.debug("Refreshed %s with %s unchanged page(s)", ", ".join(sorted(stale)), documents.pages.unchanged)
+    return refreshed, new_metadata, diff(record, refreshed)
+
+
+# Accepts a path and returns the path of the metadata file that goes with it
+def metadata_path(path):
+    return path+".refresh"
+
+
+# Accepts the path to a metadata file and returns a list of the metadata on each line, or an empty list if there isn't one
+def read_metadata(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+# Refreshes every record in an NDJSON file written by the batch runner and writes them, in the same order, to another
+# NDJSON file, with their metadata in a .refresh file next to each
+# Optionally writes what changed to a third NDJSON file, as {'line': ..., 'changes': [...]} for every record that changed
+# Returns the number of records refreshed and the number that changed
+def refresh_file(input_path, output_path, changes_path=None, workers=DEFAULT_WORKERS, concurrency=1, spatial_index=None):
+    metadata = read_metadata(metadata_path(input_path))
+    now = time.time()
+    count = 0
+    changed = 0
+
+    with open(input_path, encoding="utf-8") as records, open(output_path, "w", encoding="utf-8") as output, open(metadata_path(output_path), "w", encoding="utf-8") as output_metadata, \
+            open(changes_path or os.devnull, "w", encoding="utf-8") as changes_file, ThreadPoolExecutor(max_workers=workers) as executor:
+        lines = ((index, json.loads(line)) for index, line in enumerate(records) if line.strip())
+        for chunk in read_chunks(lines, workers * 2):
+            futures = [executor.submit(refresh, record, metadata[index] if index < len(metadata) else None, now, REFRESH_POLICY, concurrency, spatial_index) for index, record in chunk]
+            for (index, record), future in zip(chunk, futures):
+                refreshed, new_metadata, changes = future.result()
+                output.write(json.dumps(refreshed)+"\n")
+                output_metadata.write(json.dumps(new_metadata)+"\n")
+                if changes:
+                    changed = changed + 1
+                    changes_file.write(json.dumps({'line': index, 'changes': changes})+"\n")
+                count = count + 1
+
+    logger.info("Refreshed %s records, %s of which changed", count, changed)
+    return count, changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Refresh the stale sections of stored Hamilton property records")
+    parser.add_argument("input", help="NDJSON file of property records, e.g. from ls_hamilton_batch.py")
+    parser.add_argument("output", help="NDJSON file to write the refreshed records to")
+    parser.add_argument("--changes", help="NDJSON file to write what changed in each record to")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="how many records to refresh at once")
+    parser.add_argument("--concurrency", type=int, default=1, help="how many requests each record can have in flight")
+    parser.add_argument("--spatial-index", help="spatial index snapshot to look up ward, zoning and temp use data in")
+    args = parser.parse_args()
+    spatial_index = ls_hamilton_spatial_index.load(args.spatial_index) if args.spatial_index else None
+    count, changed = refresh_file(args.input, args.output, args.changes, args.workers, args.concurrency, spatial_index)
+    print("Refreshed "+str(count)+" records, "+str(changed)+" changed")
\ No newline at end of file
@@ -0,0 +1,259 @@
+import ls_hamilton_property_class
+from ls_hamilton_batch import read_addresses
+from application.core.utils.http_client import http_client, InstrumentedHTTPAdapter, retries, set_upstream, clear_upstreams
+from application.core.utils.logger import logger
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+import argparse
+import base64
+import itertools
+import json
+import random
+import threading
+import time
+
+
+# Records what the city's servers say while building some properties, and plays it back from a local server, so the
+# class can be run (and benchmarked, see ls_hamilton_benchmark.py) without touching the network
+#
+# Record once, against the real servers:
+#   python ls_hamilton_replay.py addresses.jsonl recording.jsonl
+#
+# Then start a replay server in the same process as the class. Every request for a host in the recording goes to the
+# replay server instead, with whatever latency, jitter and errors you ask for:
+#   server = ls_hamilton_replay.start_replay("recording.jsonl", latency=0.2, jitter=0.05, error_rate=0.01)
+#   my_prop = ls_hamilton_property_class.ls_hamilton_property(address=my_address)
+#   ls_hamilton_replay.stop_replay(server)
+#
+# A recording is an NDJSON file. The first line lists the addresses it was recorded for, and each line after that is
+# one request and the response to it. Requests are matched on their method, host, path, query and form data, in any
+# order. If the same request was made more than once, the recorded responses are played back in turn, so every
+# Eplans session start gets its own session cookie.
+
+# Leave these response headers out of recordings: the content is recorded already decoded, and the replay server
+# works out its own length, date and connection handling
+SKIPPED_HEADERS = ("content-length", "content-encoding", "transfer-encoding", "connection", "keep-alive", "date")
+
+# The status code the replay server answers with when it injects an error
+DEFAULT_ERROR_STATUS = 503
+
+
+# -- RECORDING --
+
+
+# Accepts a request's method, host, path, query string and body, and returns the key it's matched on
+# Query and form parameters are sorted, so it doesn't matter what order they were sent in
+def request_key(method, host, path, query, body):
+    return (method.upper(), host.lower(), path, tuple(sorted(parse_qsl(query, keep_blank_values=True))), tuple(sorted(parse_qsl(body, keep_blank_values=True))))
+
+
+# Accepts a request body as bytes, a string or None, and returns it as a string
+def body_text(body):
+    if body is None:
+        return ""
+    if isinstance(body, bytes):
+        return body.decode("latin-1")
+    return body
+
+
+# Recorded requests and responses, and the addresses they were recorded for
+class Recording:
+    def __init__(self, addresses=None):
+        self.addresses = addresses or []
+        self.exchanges = []
+        self.responses = {}
+        self.turns = {}
+        self.lock = threading.Lock()
+
+    # Accepts the parts of a request and its response, and adds them to the recording
+    def add(self, method, host, path, query, body, status, headers, content):
+        exchange = {
+            'method': method, 'host': host, 'path': path, 'query': query, 'body': body,
+            'status': status, 'headers': headers, 'content': base64.b64encode(content).decode("ascii")
+        }
+        with self.lock:
+            self.exchanges.append(exchange)
+            self.responses.setdefault(request_key(method, host, path, query, body), []).append(exchange)
+
+    # Accepts a request key and returns the next recorded response to it, or None if it was never recorded
+    def lookup(self, key):
+        with self.lock:
+            responses = self.responses.get(key)
+            if not responses:
+                return None
+            turn = self.turns.get(key, 0)
+            self.turns[key] = turn + 1
+            return responses[turn % len(responses)]
+
+    # Returns the set of hosts the recording has responses from
+    def hosts(self):
+        with self.lock:
+            return {exchange['host'] for exchange in self.exchanges}
+
+    def save(self, path):
+        with self.lock, open(path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({'addresses': self.addresses})+"\n")
+            for exchange in self.exchanges:
+                f.write(json.dumps(exchange)+"\n")
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding="utf-8") as f:
+            self = cls(json.loads(f.readline())['addresses'])
+            for line in f:
+                if line.strip():
+                    exchange = json.loads(line)
+                    self.exchanges.append(exchange)
+                    self.responses.setdefault(request_key(exchange['method'], exchange['host'], exchange['path'], exchange['query'], exchange['body']), []).append(exchange)
+        return self
+
+
+# Extend the instrumented adapter so that it adds every response it gets to a recording
+class RecordingHTTPAdapter(InstrumentedHTTPAdapter):
+    def __init__(self, recording, *args, **kwargs):
+        self.recording = recording
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        response = super().send(request, **kwargs)
+        parts = urlsplit(request.url)
+        headers = getattr(response.raw, "headers", None) or response.headers
+        self.recording.add(request.method, parts.hostname, parts.path, parts.query, body_text(request.body), response.status_code,
+                           [[name, value] for name, value in headers.items() if name.lower() not in SKIPPED_HEADERS], response.content)
+        return response
+
+
+# Accepts a list of address objects and the path to save the recording to
+# Builds each property one at a time with the regular HTTP client, recording every response, and returns the recording
+# Turn the response cache off first if you want every request to reach the city's servers
+def record(addresses, path):
+    recording = Recording(addresses)
+    adapters = dict(http_client.adapters)
+    http_client.mount("https://", RecordingHTTPAdapter(recording, max_retries=retries))
+    http_client.mount("http://", RecordingHTTPAdapter(recording, max_retries=retries))
+    try:
+        for address in addresses:
+            ls_hamilton_property_class.ls_hamilton_property(address=dict(address), concurrency=1)
+    finally:
+        http_client.adapters.clear()
+        http_client.adapters.update(adapters)
+    recording.save(path)
+    logger.info("Recorded %s responses for %s addresses to %s", len(recording.exchanges), len(addresses), path)
+    return recording
+
+
+# -- REPLAYING --
+
+
+# Answers requests from a recording, after a delay, sometimes with an error
+class ReplayRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.replay()
+
+    def do_POST(self):
+        self.replay()
+
+    def replay(self):
+        server = self.server
+        parts = urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("latin-1")
+        host = (self.headers.get("Host") or "").split(":")[0]
+        exchange = server.recording.lookup(request_key(self.command, host, parts.path, parts.query, body))
+        server.wait()
+
+        if exchange is None:
+            server.count('unmatched')
+            self.answer(404, [["Content-Type", "text/plain"]], ("Not in the recording: "+self.command+" "+host+self.path).encode("utf-8"))
+        elif server.inject_error():
+            server.count('errors')
+            self.answer(server.error_status, [["Content-Type", "text/plain"]], b"Injected error")
+        else:
+            server.count('replayed')
+            self.answer(exchange['status'], exchange['headers'], base64.b64decode(exchange['content']))
+
+    def answer(self, status, headers, content):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# A local HTTP server that plays back a recording
+# Each response is held back for latency seconds, give or take up to jitter seconds, and error_rate of them (0 to 1)
+# are replaced with an error_status error
+# Counts how many requests were replayed, answered with an injected error, and not found in the recording
+class ReplayServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, recording, port=0, latency=0, jitter=0, error_rate=0, error_status=DEFAULT_ERROR_STATUS, seed=None):
+        super().__init__(("127.0.0.1", port), ReplayRequestHandler)
+        self.recording = recording
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.counts = {'replayed': 0, 'errors': 0, 'unmatched': 0}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    # Holds back a response for the latency, plus or minus the jitter
+    def wait(self):
+        with self.lock:
+            delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+    # Returns True if this response should be replaced with an error
+    def inject_error(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts[name] + 1
+
+    # Returns the base URL of the server, e.g. http://127.0.0.1:8080
+    def url(self):
+        return "http://127.0.0.1:"+str(self.server_address[1])
+
+
+# Accepts a recording (or the path to one) and starts a replay server for it on a background thread
+# Accepts the same latency, jitter and error options as ReplayServer
+# Sends every request for a host in the recording to the server until stop_replay is called, and returns the server
+def start_replay(recording, latency=0, jitter=0, error_rate=0, error_status=DEFAULT_ERROR_STATUS, seed=None, port=0):
+    if isinstance(recording, str):
+        recording = Recording.load(recording)
+    server = ReplayServer(recording, port, latency, jitter, error_rate, error_status, seed)
+    server.thread = threading.Thread(target=server.serve_forever, name="localsoup-replay", daemon=True)
+    server.thread.start()
+    for host in recording.hosts():
+        set_upstream(host, server.url())
+    logger.info("Replaying %s responses at %s", len(recording.exchanges), server.url())
+    return server
+
+
+# Stops a replay server and sends requests to the real hosts again
+def stop_replay(server):
+    clear_upstreams()
+    server.shutdown()
+    server.server_close()
+    server.thread.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record the city's responses for a file of addresses, to replay them later")
+    parser.add_argument("input", help="CSV or JSONL file of address objects")
+    parser.add_argument("output", help="NDJSON file to save the recording to")
+    parser.add_argument("--limit", type=int, help="only record the first this many addresses")
+    args = parser.parse_args()
+    addresses = [address for index, address in itertools.islice(read_addresses(args.input), args.limit)]
+    recording = record(addresses, args.output)
+    print("Recorded "+str(len(recording.exchanges))+" responses for "+str(len(addresses))+" addresses")
\ No newline at end of file
@@ -0,0 +1,293 @@
+from ls_hamilton_property_class import WARD_URL, ZONING_URL, ZONING_FIELDS, TEMP_USE_FIELDS
+from application.core.utils.http_client import http_client
+from application.core.utils.logger import logger
+from application.core.utils.stats import timed
+import argparse
+import json
+import numpy
+
+
+# Answers ward, zoning and temp use lookups locally, from a snapshot of the city's map layers
+#
+# The ward, zoning and temporary use polygons hardly ever change, so instead of asking the map services about
+# every single property, download the layers once:
+#   python ls_hamilton_spatial_index.py localsoup_spatial.npz
+#
+# and then hand the snapshot to the class:
+#   spatial_index = ls_hamilton_spatial_index.load("localsoup_spatial.npz")
+#   my_prop = ls_hamilton_property_class.ls_hamilton_property(address=my_address, spatial_index=spatial_index)
+#
+# The answers are the same attribute objects the getters return.
+
+
+# The map layers we keep a copy of, with the URL and extra request parameters for querying each one
+LAYERS = {
+    '15': {'url': WARD_URL, 'params': {}},
+    '9': {'url': ZONING_URL, 'params': {'layer': "{'source':{'type':'mapLayer','mapLayerId': '9'}}"}},
+    '20': {'url': ZONING_URL, 'params': {'layer': "{'source':{'type':'mapLayer','mapLayerId': '20'}}"}}
+}
+
+# Set how many features to ask for in each download request
+# The map services won't return more than 1000 at a time
+DOWNLOAD_BATCH_SIZE = 500
+
+# Set the size of the grid cells used to find candidate polygons, in degrees (about 1km)
+GRID_CELL_SIZE = 0.01
+
+
+# A single map layer: its polygons, their attributes, and a grid index over their bounding boxes
+class LayerIndex:
+
+    # Accepts the arrays that make up a layer (see from_features for what they are)
+    # Optionally accepts a grid that's already been built (see build_grid), e.g. from a saved snapshot
+    def __init__(self, vertices, ring_offsets, feature_rings, attributes, grid=None):
+        self.vertices = vertices
+        self.ring_offsets = ring_offsets
+        self.feature_rings = feature_rings
+        self.attributes = attributes
+
+        # Turn the rings into edges, leaving out the step from the end of one ring to the start of the next
+        starts = numpy.ones(len(vertices), dtype=bool)
+        starts[ring_offsets[1:][numpy.diff(ring_offsets) > 0] - 1] = False
+        edge_starts = numpy.nonzero(starts)[0]
+        self.x1 = vertices[edge_starts, 0]
+        self.y1 = vertices[edge_starts, 1]
+        self.x2 = vertices[edge_starts + 1, 0]
+        self.y2 = vertices[edge_starts + 1, 1]
+
+        # Work out where each feature's edges start, so we can test one feature's edges at a time
+        ring_edges = numpy.maximum(numpy.diff(ring_offsets) - 1, 0)
+        self.feature_edges = numpy.concatenate(([0], numpy.cumsum(ring_edges)))[feature_rings]
+
+        # Work out each feature's bounding box (features without any geometry get an empty one)
+        vertex_starts = ring_offsets[feature_rings]
+        has_vertices = numpy.diff(vertex_starts) > 0
+        self.bboxes = numpy.tile([numpy.inf, numpy.inf, -numpy.inf, -numpy.inf], (len(attributes), 1))
+        if has_vertices.any():
+            starts = vertex_starts[:-1][has_vertices]
+            self.bboxes[has_vertices, 0] = numpy.minimum.reduceat(vertices[:, 0], starts)
+            self.bboxes[has_vertices, 1] = numpy.minimum.reduceat(vertices[:, 1], starts)
+            self.bboxes[has_vertices, 2] = numpy.maximum.reduceat(vertices[:, 0], starts)
+            self.bboxes[has_vertices, 3] = numpy.maximum.reduceat(vertices[:, 1], starts)
+
+        if grid is None:
+            self.build_grid()
+        else:
+            self.origin, self.shape, self.cell_offsets, self.cell_features = grid
+
+
+    # Accepts a list of ArcGIS features with polygon geometry and returns a layer index
+    # Features are kept in the order given, and when a point falls in more than one, the first one wins
+    @classmethod
+    def from_features(cls, features):
+        vertices = []
+        ring_offsets = [0]
+        feature_rings = [0]
+        attributes = []
+        for feature in features:
+            for ring in (feature.get('geometry') or {}).get('rings', []):
+                vertices.extend(ring)
+                ring_offsets.append(len(vertices))
+            feature_rings.append(len(ring_offsets) - 1)
+            attributes.append(feature['attributes'])
+        return cls(numpy.array(vertices, dtype=numpy.float64).reshape(-1, 2), numpy.array(ring_offsets, dtype=numpy.int64), numpy.array(feature_rings, dtype=numpy.int64), attributes)
+
+
+    # Builds a grid over the layer, listing which features' bounding boxes touch each cell
+    # The grid is stored as two flat arrays: cell_features holds the feature numbers for every cell, one cell
+    # after another, and cell_offsets says where each cell's run starts
+    def build_grid(self):
+        finite = numpy.isfinite(self.bboxes).all(axis=1)
+        if finite.any():
+            self.origin = self.bboxes[finite, :2].min(axis=0)
+            far_corner = self.bboxes[finite, 2:].max(axis=0)
+        else:
+            self.origin = far_corner = numpy.zeros(2)
+        self.shape = (numpy.floor((far_corner - self.origin) / GRID_CELL_SIZE).astype(numpy.int64) + 1)
+        cells = [[] for i in range(int(self.shape[0] * self.shape[1]))]
+        for i in numpy.nonzero(finite)[0]:
+            low = numpy.floor((self.bboxes[i, :2] - self.origin) / GRID_CELL_SIZE).astype(numpy.int64)
+            high = numpy.floor((self.bboxes[i, 2:] - self.origin) / GRID_CELL_SIZE).astype(numpy.int64)
+            for cx in range(low[0], high[0] + 1):
+                for cy in range(low[1], high[1] + 1):
+                    cells[cx * self.shape[1] + cy].append(i)
+        self.cell_offsets = numpy.concatenate(([0], numpy.cumsum([len(cell) for cell in cells]))).astype(numpy.int64)
+        self.cell_features = numpy.array([i for cell in cells for i in cell], dtype=numpy.int64)
+
+
+    # Accepts a longitude and latitude and returns the number of the first feature that contains the point, or None
+    def feature_at(self, x, y):
+
+        # Find the grid cell, and the features whose bounding boxes contain the point
+        cell = numpy.floor((numpy.array([x, y]) - self.origin) / GRID_CELL_SIZE).astype(numpy.int64)
+        if (cell < 0).any() or (cell >= self.shape).any():
+            return None
+        cell = cell[0] * self.shape[1] + cell[1]
+        candidates = numpy.sort(self.cell_features[self.cell_offsets[cell]:self.cell_offsets[cell + 1]])
+        boxes = self.bboxes[candidates]
+        candidates = candidates[(boxes[:, 0] <= x) & (x <= boxes[:, 2]) & (boxes[:, 1] <= y) & (y <= boxes[:, 3])]
+        if not len(candidates):
+            return None
+
+        # Cast a ray from the point across all of the candidates' edges at once, and count the crossings per feature
+        # An odd number of crossings means the point is inside (holes are just more rings, so they work too)
+        starts = self.feature_edges[candidates]
+        ends = self.feature_edges[candidates + 1]
+        edges = numpy.concatenate([numpy.arange(start, end) for start, end in zip(starts, ends)])
+        x1, y1, x2, y2 = self.x1[edges], self.y1[edges], self.x2[edges], self.y2[edges]
+        straddles = (y1 > y) != (y2 > y)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            crosses = straddles & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+        counts = numpy.add.reduceat(crosses.astype(numpy.int64), numpy.concatenate(([0], numpy.cumsum(ends - starts)[:-1])))
+        inside = candidates[counts % 2 == 1]
+        return int(inside[0]) if len(inside) else None
+
+
+    # Returns the layer as a dict of arrays for saving
+    def to_arrays(self, name):
+        return {
+            name+'_vertices': self.vertices,
+            name+'_ring_offsets': self.ring_offsets,
+            name+'_feature_rings': self.feature_rings,
+            name+'_attributes': numpy.array(json.dumps(self.attributes)),
+            name+'_origin': self.origin,
+            name+'_shape': self.shape,
+            name+'_cell_offsets': self.cell_offsets,
+            name+'_cell_features': self.cell_features
+        }
+
+
+    # Accepts a loaded snapshot and a layer name and returns the layer, without rebuilding its grid
+    @classmethod
+    def from_arrays(cls, arrays, name):
+        grid = (arrays[name+'_origin'], arrays[name+'_shape'], arrays[name+'_cell_offsets'], arrays[name+'_cell_features'])
+        return cls(arrays[name+'_vertices'], arrays[name+'_ring_offsets'], arrays[name+'_feature_rings'], json.loads(str(arrays[name+'_attributes'])), grid)
+
+
+# A local copy of the ward, zoning and temp use map layers
+# Has the same get_ward, get_zoning_data, get_temp_use_data and get_spatial_data methods as the class, so the class can use it
+# in place of the map services
+class SpatialIndex:
+
+    # Accepts a dict of layer indexes keyed by map layer ID (see LAYERS)
+    def __init__(self, layers):
+        self.layers = layers
+
+
+    # Accepts a location object and returns the attributes of the first feature in a layer that contains it, or None
+    def attributes_at(self, layerId, location):
+        layer = self.layers[layerId]
+        feature = layer.feature_at(location['EPSG:4326']['x'], location['EPSG:4326']['y'])
+        if feature is None:
+            return None
+        return layer.attributes[feature]
+
+
+    # Accepts a location object and returns the city ward
+    def get_ward(self, location):
+        attributes = self.attributes_at('15', location)
+        if attributes is not None:
+            ward = str(attributes['OBJECTID'])
+            logger.debug("Found ward %s in the spatial index", ward)
+            return ward
+        else:
+            logger.warning("Couldn't find the ward in the spatial index")
+            return None
+
+
+    # Accepts a location object and returns zoning data
+    def get_zoning_data(self, location):
+        attributes = self.attributes_at('9', location)
+        if attributes is not None:
+            logger.debug("Found zoning data in the spatial index")
+            return select_fields(attributes, ZONING_FIELDS)
+        else:
+            logger.warning("Could not find zoning data in the spatial index")
+            return {}
+
+
+    # Accepts a location object and returns any temporary use applications
+    def get_temp_use_data(self, location):
+        attributes = self.attributes_at('20', location)
+        if attributes is not None:
+            logger.debug("Found temp use data in the spatial index")
+            return select_fields(attributes, TEMP_USE_FIELDS)
+        else:
+            logger.warning("Could not find temp use data in the spatial index")
+            return {}
+
+
+    # Accepts a location object and returns its ward, zoning data and temp use data
+    @timed("spatial_data")
+    def get_spatial_data(self, location):
+        return self.get_ward(location), self.get_zoning_data(location), self.get_temp_use_data(location)
+
+
+    # Async versions of the lookups, so the index can stand in for the class's async getters too
+    async def get_ward_async(self, location):
+        return self.get_ward(location)
+
+    async def get_zoning_data_async(self, location):
+        return self.get_zoning_data(location)
+
+    async def get_temp_use_data_async(self, location):
+        return self.get_temp_use_data(location)
+
+    async def get_spatial_data_async(self, location):
+        return self.get_spatial_data(location)
+
+
+    # Accepts a file path and saves the index there as a compressed NumPy archive
+    def save(self, path):
+        arrays = {}
+        for layerId, layer in self.layers.items():
+            arrays.update(layer.to_arrays('layer'+layerId))
+        with open(path, 'wb') as f:
+            numpy.savez_compressed(f, **arrays)
+        logger.info("Saved the spatial index to %s", path)
+
+
+# Accepts a field list like ZONING_FIELDS and returns just those fields from an attributes object, in that order
+# Fields the layer doesn't have are left out, just as the map service leaves them out
+def select_fields(attributes, fields):
+    return {field: attributes[field] for field in fields.split(',') if field in attributes}
+
+
+# Accepts the path to a snapshot saved with SpatialIndex.save and returns the spatial index
+def load(path):
+    with numpy.load(path, allow_pickle=False) as arrays:
+        arrays = dict(arrays)
+    return SpatialIndex({layerId: LayerIndex.from_arrays(arrays, 'layer'+layerId) for layerId in LAYERS})
+
+
+# Accepts a map layer ID from LAYERS and downloads all of its polygons and attributes, ordered by object ID
+def download_layer(layerId):
+    url = LAYERS[layerId]['url']
+    params = dict(LAYERS[layerId]['params'], f='json', where='1=1')
+
+    # Ask for the IDs of every feature first, since the map service only hands out a limited number of features at a time
+    objectIds = sorted(http_client.get(url, params=dict(params, returnIdsOnly='true')).json()['objectIds'] or [])
+    logger.info("Downloading %s features from map layer %s", len(objectIds), layerId)
+
+    # Then ask for the features a batch at a time
+    features = []
+    for start in range(0, len(objectIds), DOWNLOAD_BATCH_SIZE):
+        batch = objectIds[start:start+DOWNLOAD_BATCH_SIZE]
+        response = http_client.post(url, data=dict(params, objectIds=','.join(str(i) for i in batch), outFields='*', returnGeometry='true', outSR='{wkid:4326}')).json()
+        features.extend(response['features'])
+
+    # Keep them in object ID order, which is the order the map services list matches in
+    features.sort(key=lambda feature: feature['attributes'].get('OBJECTID', 0))
+    return LayerIndex.from_features(features)
+
+
+# Downloads all of the layers and returns a spatial index
+def download():
+    return SpatialIndex({layerId: download_layer(layerId) for layerId in LAYERS})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the ward, zoning and temp use map layers into a local spatial index")
+    parser.add_argument("output", help="file to save the spatial index to, e.g. localsoup_spatial.npz")
+    args = parser.parse_args()
+    download().save(args.output)
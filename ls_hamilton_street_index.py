@@ -0,0 +1,151 @@
+from ls_hamilton_property_class import TAX_LIST_URL, ls_hamilton_property
+from ls_hamilton_extract import extract_street_roll_numbers
+from application.core.utils.logger import logger, httpLogger
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import requests
+import threading
+import time
+
+
+# Looks up roll numbers a whole street at a time, instead of one address at a time
+#
+# The property inquiry application lists every property on a street if you search for the street without a street
+# number. The street index runs that search once per street and community, and keeps the roll numbers it finds by
+# street number, so every other address on the street gets its roll numbers without a request of its own:
+#   street_index = ls_hamilton_street_index.StreetIndex()
+#   my_prop = ls_hamilton_property_class.ls_hamilton_property(address=my_address, street_index=street_index)
+#
+# The index can be saved and loaded again, so a batch that's run again doesn't have to search the streets again:
+#   street_index.save("localsoup_streets.json")
+#   street_index = ls_hamilton_street_index.load("localsoup_streets.json")
+#
+# If a street can't be searched, or a street number isn't in its list, the class searches for the address itself,
+# just like it does without an index.
+
+# Set how long a street's roll numbers are trusted before the street is searched again
+STREET_MAX_AGE = 30 * 24 * 60 * 60 # seconds
+
+# Set how many streets to search at once when prefetching
+PREFETCH_CONCURRENCY = 4
+
+
+# Roll numbers by street and street number
+class StreetIndex:
+
+    # Optionally accepts the streets from a saved index (see load)
+    # Optionally accepts max_age, in seconds, after which a street is searched again
+    def __init__(self, streets=None, max_age=STREET_MAX_AGE):
+        self.streets = streets or {}
+        self.max_age = max_age
+        self.locks = {}
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    # Accepts a property object and an address object, and returns the key of the address's street
+    # e.g. "TISDALE ST S|ham010081"
+    def street_key(self, prop, address):
+        return prop.tax_address_string(address).upper()+"|"+str(prop.community(address))
+
+
+    # Accepts a street key and returns True if the street has been searched recently enough
+    def is_fresh(self, key):
+        street = self.streets.get(key)
+        return street is not None and time.time() - street['fetched'] <= self.max_age
+
+
+    # Accepts a property object and an address object, and returns the list of roll numbers at the address, or None
+    # if the index doesn't know them and the address should be searched for on its own
+    # Searches the address's street first if it hasn't been yet, unless fetch is False
+    # Safe to call from several threads; each street is only searched once, however many threads ask for it
+    def lookup(self, prop, address, fetch=True):
+        numbers = self.street_numbers(prop, address, fetch)
+        roll_numbers = numbers.get(str(address['street_number']).strip().upper()) if numbers is not None else None
+        with self.lock:
+            if roll_numbers is None:
+                self.misses = self.misses + 1
+            else:
+                self.hits = self.hits + 1
+        return roll_numbers
+
+
+    # Accepts a property object and an address object (the street number isn't needed), and returns a dict of every
+    # street number on the address's street and its roll numbers, or None if the street couldn't be searched
+    # Searches the street first if it hasn't been yet, unless fetch is False
+    def street_numbers(self, prop, address, fetch=True):
+        key = self.street_key(prop, address)
+        if fetch and not self.is_fresh(key):
+            with self.lock:
+                street_lock = self.locks.setdefault(key, threading.Lock())
+            with street_lock:
+                if not self.is_fresh(key):
+                    self.fetch(prop, address, key)
+        street = self.streets.get(key)
+        return street['numbers'] if street else None
+
+
+    # Accepts a street key and drops the street from the index, e.g. once every address on it has been built
+    def forget(self, key):
+        with self.lock:
+            self.streets.pop(key, None)
+            self.locks.pop(key, None)
+
+
+    # Searches for every property on the address's street and adds them to the index
+    # If the search fails, the street is left out, so its addresses are searched for one at a time
+    def fetch(self, prop, address, key):
+        addressString = prop.tax_address_string(address)
+        with self.lock:
+            self.searches = self.searches + 1
+        try:
+            response = prop.sources['client'].post(TAX_LIST_URL, prop.tax_request_data(dict(address, street_number=""), addressString))
+        except requests.exceptions.RequestException as e:
+            httpLogger.error(e)
+            return
+        roll_numbers = extract_street_roll_numbers(response.text)
+        if roll_numbers is None:
+            logger.warning("Couldn't find a list of properties on %s", addressString)
+            return
+        numbers = {}
+        for roll_number, street_number in roll_numbers:
+            if street_number is not None:
+                numbers.setdefault(street_number, []).append(roll_number)
+        with self.lock:
+            self.streets[key] = {'fetched': time.time(), 'numbers': numbers}
+        logger.debug("Found %s roll numbers on %s", len(roll_numbers), addressString)
+
+
+    # Accepts a list of address objects and searches all of their streets that aren't in the index yet, a few at a time
+    def prefetch(self, addresses, concurrency=PREFETCH_CONCURRENCY):
+        prop = ls_hamilton_property(lazy=True)
+        streets = {}
+        for address in addresses:
+            key = self.street_key(prop, address)
+            if key not in streets and not self.is_fresh(key):
+                streets[key] = address
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(self.lookup, prop, address) for address in streets.values()]:
+                future.result()
+
+
+    # Accepts a file path and saves the index there as JSON
+    def save(self, path):
+        with self.lock:
+            streets = dict(self.streets)
+        with open(path+".tmp", "w", encoding="utf-8") as f:
+            json.dump({'streets': streets}, f)
+        os.replace(path+".tmp", path)
+        logger.info("Saved %s streets to the street index at %s", len(streets), path)
+
+
+# Accepts the path to an index saved with StreetIndex.save and returns the street index
+# Returns an empty index if there's nothing saved there yet
+def load(path, max_age=STREET_MAX_AGE):
+    if not os.path.exists(path):
+        return StreetIndex(max_age=max_age)
+    with open(path, encoding="utf-8") as f:
+        return StreetIndex(json.load(f)['streets'], max_age)
\ No newline at end of file
@@ -0,0 +1,25 @@
+import math
+import numpy
+
+
+# Converts longitude/latitude coordinates (EPSG:4326) to Web Mercator coordinates (EPSG:3857)
+# Web Mercator is a closed-form projection of WGS84, so there's no need to ask a server to do it for us
+
+# The radius of the sphere that Web Mercator projects onto, in metres
+EARTH_RADIUS = 6378137.0
+
+
+# Accepts a longitude and a latitude in degrees and returns an EPSG:3857 point object, e.g. {'x': ..., 'y': ...}
+def web_mercator(x, y):
+    return {
+        'x': EARTH_RADIUS * math.radians(x),
+        'y': EARTH_RADIUS * math.log(math.tan(math.pi / 4 + math.radians(y) / 2))
+    }
+
+
+# Accepts sequences of longitudes and latitudes in degrees and returns NumPy arrays of EPSG:3857 x and y coordinates
+# Projects the whole lot in one go, which is a lot faster than calling web_mercator in a loop
+def web_mercator_array(xs, ys):
+    xs = numpy.radians(numpy.asarray(xs, dtype=numpy.float64))
+    ys = numpy.radians(numpy.asarray(ys, dtype=numpy.float64))
+    return EARTH_RADIUS * xs, EARTH_RADIUS * numpy.log(numpy.tan(numpy.pi / 4 + ys / 2))
@@ -0,0 +1,253 @@
+import asyncio
+import collections
+import threading
+import time
+
+
+# Keeps us from flooding the city's servers once requests run in parallel
+# Every host gets a token bucket, which caps how many requests per second we send it, and an adaptive concurrency
+# limit, which caps how many requests it has in flight. The concurrency limit creeps up while the host answers
+# quickly, and is cut back as soon as it starts throttling us, erroring or slowing down (additive increase,
+# multiplicative decrease).
+
+# Set the limits for each host
+    # rate: the most requests per second to send
+    # burst: how many requests can go out at once after a quiet spell
+    # min_concurrency / max_concurrency: the range the concurrency limit can move in
+    # initial_concurrency: where the concurrency limit starts
+    # latency_target: responses slower than this many seconds count as the host struggling
+HOST_LIMITS = {
+    "spatialsolutions.hamilton.ca": {'rate': 20, 'burst': 20, 'min_concurrency': 1, 'max_concurrency': 16, 'initial_concurrency': 4, 'latency_target': 2},
+    "oldproperty.hamilton.ca": {'rate': 5, 'burst': 5, 'min_concurrency': 1, 'max_concurrency': 8, 'initial_concurrency': 2, 'latency_target': 3},
+    "eplans.hamilton.ca": {'rate': 5, 'burst': 5, 'min_concurrency': 1, 'max_concurrency': 8, 'initial_concurrency': 2, 'latency_target': 3}
+}
+
+# Status codes that mean a host is overloaded or throttling us
+OVERLOADED_STATUSES = (429, 500, 502, 503, 504)
+
+# Set how much to cut the concurrency limit by when a host is overloaded, and when it's slow
+OVERLOADED_DECREASE = 0.5
+SLOW_DECREASE = 0.9
+
+# Set the shortest time between two cuts of the same concurrency limit, so one bad moment doesn't cut it to the floor
+DECREASE_COOLDOWN = 1 # seconds
+
+# Set how long to hold off a host that throttled us without saying how long to wait
+DEFAULT_RETRY_AFTER = 1 # seconds
+
+
+# A token bucket that allows rate requests per second on average, and up to burst requests at once
+# Callers reserve a token and are told how long to wait for it, so the same bucket works for threads and coroutines
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    # Reserves a token and returns how many seconds to wait before using it
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+            wait = max(0, -self.tokens / self.rate, self.paused_until - now)
+            return wait
+
+    # Stops handing out tokens for the given number of seconds, e.g. when the host sends a Retry-After header
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Gives back a reserved token that won't be used, e.g. because its request gave up waiting for it
+    def refund(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+    # Optionally accepts the most seconds to wait for a token, and returns False straight away if it wouldn't come in time
+    def acquire(self, timeout=None):
+        wait = self.reserve()
+        if timeout is not None and wait > timeout:
+            self.refund()
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+    # If the coroutine is cancelled while it waits, the token is given back
+    async def acquire_async(self):
+        wait = self.reserve()
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except BaseException:
+                self.refund()
+                raise
+
+
+# A concurrency limit that grows by about one for every limit's worth of good responses, and shrinks when the host
+# is overloaded or slow
+# Threads wait on a condition and coroutines wait on futures, so both can share one limit
+class AdaptiveConcurrencyLimit:
+    def __init__(self, min_concurrency, max_concurrency, initial_concurrency, latency_target):
+        self.min = min_concurrency
+        self.max = max_concurrency
+        self.limit = float(initial_concurrency)
+        self.latency_target = latency_target
+        self.in_flight = 0
+        self.last_decrease = 0
+        self.condition = threading.Condition()
+        self.waiters = collections.deque()
+
+    # Takes a slot if one is free, and returns True if it did
+    # Has to be called with the condition held
+    def take(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight = self.in_flight + 1
+            return True
+        return False
+
+    # Optionally accepts the most seconds to wait for a slot, and returns False if none came free in time
+    def acquire(self, timeout=None):
+        give_up = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self.take():
+                left = None if give_up is None else give_up - time.monotonic()
+                if left is not None and left <= 0:
+                    return False
+                self.condition.wait(left)
+        return True
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.condition:
+                if self.take():
+                    return
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            await future
+
+    # Gives back a slot and adjusts the limit
+    # Accepts how long the request took and whether the host was overloaded
+    def release(self, latency, overloaded):
+        with self.condition:
+            now = time.monotonic()
+            if overloaded or latency > self.latency_target:
+                if now - self.last_decrease >= DECREASE_COOLDOWN:
+                    self.limit = max(self.min, self.limit * (OVERLOADED_DECREASE if overloaded else SLOW_DECREASE))
+                    self.last_decrease = now
+            else:
+                self.limit = min(self.max, self.limit + 1 / self.limit)
+        self.give_back()
+
+    # Gives back a slot without adjusting the limit, and wakes everyone up to check for a free slot
+    def give_back(self):
+        with self.condition:
+            self.in_flight = self.in_flight - 1
+            self.condition.notify_all()
+            waiters = list(self.waiters)
+            self.waiters.clear()
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(wake, future)
+
+
+# Accepts a future a coroutine is waiting on and wakes it up, unless it's given up waiting
+def wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+# The token bucket and concurrency limit for one host
+class HostLimiter:
+    def __init__(self, rate, burst, min_concurrency, max_concurrency, initial_concurrency, latency_target):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = AdaptiveConcurrencyLimit(min_concurrency, max_concurrency, initial_concurrency, latency_target)
+        self.throttled = 0
+
+    # Waits for a free slot and a token, in that order, so queued requests don't use up tokens
+    # Optionally accepts the most seconds to wait for both, and returns None if they didn't come in time
+    def acquire(self, timeout=None):
+        give_up = None if timeout is None else time.monotonic() + timeout
+        if not self.concurrency.acquire(timeout):
+            return None
+        if not self.bucket.acquire(None if give_up is None else max(0, give_up - time.monotonic())):
+            self.concurrency.give_back()
+            return None
+        return time.monotonic()
+
+    # If the coroutine is cancelled while it waits for a token, the slot is given back
+    async def acquire_async(self):
+        await self.concurrency.acquire_async()
+        try:
+            await self.bucket.acquire_async()
+        except BaseException:
+            self.concurrency.give_back()
+            raise
+        return time.monotonic()
+
+    # Accepts the time acquire returned and the response, or None if the request failed without one
+    # Gives back the slot, and holds the host off for a while if it throttled us
+    def release(self, started, response):
+        latency = time.monotonic() - started
+        overloaded = response is None or response.status_code in OVERLOADED_STATUSES
+        if response is not None and response.status_code in (429, 503):
+            self.throttled = self.throttled + 1
+            self.bucket.pause(retry_after(response))
+        self.concurrency.release(latency, overloaded)
+
+    # Gives back the slot of a request we gave up on (see deadline.py), without taking it as a sign of how the host is
+    def give_back(self):
+        self.concurrency.give_back()
+
+
+# Accepts a response and returns how many seconds its Retry-After header asks us to wait
+def retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After", DEFAULT_RETRY_AFTER))
+    except ValueError:
+        return DEFAULT_RETRY_AFTER
+
+
+# The limiter for each host we've sent requests to
+host_limiters = {}
+host_limiters_lock = threading.Lock()
+
+
+# Accepts a host name and returns its limiter, or None if the host doesn't have limits
+def get_host_limiter(host):
+    limiter = host_limiters.get(host)
+    if limiter is None and host in HOST_LIMITS:
+        with host_limiters_lock:
+            limiter = host_limiters.get(host)
+            if limiter is None:
+                limiter = HostLimiter(**HOST_LIMITS[host])
+                host_limiters[host] = limiter
+    return limiter
+
+
+# Accepts a host name and its limits, with the same keys as HOST_LIMITS, and replaces the host's limits
+# Pass None to take the host's limits off
+def set_host_limits(host, limits):
+    with host_limiters_lock:
+        host_limiters.pop(host, None)
+        if limits is None:
+            HOST_LIMITS.pop(host, None)
+        else:
+            HOST_LIMITS[host] = limits
+
+
+# Accepts the number of processes that will be sending requests to the city's servers at the same time, and gives this
+# process its share of every host's limits, so together they keep to the limits in HOST_LIMITS
+def divide_host_limits(processes):
+    for host, limits in list(HOST_LIMITS.items()):
+        max_concurrency = max(1, limits['max_concurrency'] // processes)
+        set_host_limits(host, dict(limits,
+                                   rate=limits['rate'] / processes,
+                                   burst=max(1, limits['burst'] / processes),
+                                   min_concurrency=min(limits['min_concurrency'], max_concurrency),
+                                   max_concurrency=max_concurrency,
+                                   initial_concurrency=max(1, min(limits['initial_concurrency'], max_concurrency))))
@@ -0,0 +1,261 @@
+import contextlib
+import contextvars
+import copy
+import functools
+import inspect
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+from application.core.utils.logger import logger
+
+
+# Counts and times what the class does, so you can see which stages and which servers are slow, and how many
+# requests each property costs
+#
+# Everything is recorded twice: into the stats of the property being built (my_prop.stats), and into process-wide
+# totals (process_stats). Stages are the getters, e.g. "location" or "taxes"; stages can run inside other stages, so
+# their times overlap. HTTP calls are counted per host, and failed ones are counted against the stage they were made in
+# too, so a property can tell which of its sections are missing something (see section_status in the class).
+
+# The prefix for the names of exported Prometheus metrics
+PROMETHEUS_PREFIX = "localsoup"
+
+
+# Counters and timers for stages and hosts
+# Safe to record into from several threads at once
+class Stats:
+    def __init__(self):
+        self.stages = {}
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    # Pickles the counters without the lock, and gives an unpickled copy a lock of its own
+    def __getstate__(self):
+        with self.lock:
+            return {'stages': copy.deepcopy(self.stages), 'hosts': copy.deepcopy(self.hosts)}
+
+    def __setstate__(self, state):
+        self.stages = state['stages']
+        self.hosts = state['hosts']
+        self.lock = threading.Lock()
+
+    # Accepts a stage name and how long it took, and adds it to the stage's totals
+    def record_stage(self, name, seconds, failed=False):
+        with self.lock:
+            stage = self.stage_counts(name)
+            stage['calls'] = stage['calls'] + 1
+            stage['seconds'] = stage['seconds'] + seconds
+            if failed:
+                stage['errors'] = stage['errors'] + 1
+
+    # Accepts a stage name and whether an HTTP call made in it was short circuited (not sent, because of a circuit
+    # breaker or a deadline) rather than failing, and adds it to the stage's failed calls
+    def record_stage_failure(self, name, short_circuited=False):
+        with self.lock:
+            stage = self.stage_counts(name)
+            if short_circuited:
+                stage['short_circuited'] = stage['short_circuited'] + 1
+            else:
+                stage['failed_requests'] = stage['failed_requests'] + 1
+
+    # Returns a stage's totals, adding them the first time the stage is seen
+    # Has to be called with the lock held
+    def stage_counts(self, name):
+        return self.stages.setdefault(name, {'calls': 0, 'errors': 0, 'failed_requests': 0, 'short_circuited': 0, 'seconds': 0.0})
+
+    # Accepts a host and the details of one HTTP call to it, and adds them to the host's totals
+    # Calls that were short circuited never reached the host, and calls that were coalesced shared another call, so
+    # neither of them count as errors, whatever happened
+    def record_request(self, host, seconds, size, retries, from_cache, failed, coalesced=False, short_circuited=False):
+        with self.lock:
+            counts = self.hosts.setdefault(host, {'requests': 0, 'cache_hits': 0, 'coalesced': 0, 'short_circuited': 0, 'retries': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0})
+            counts['requests'] = counts['requests'] + 1
+            counts['bytes'] = counts['bytes'] + size
+            counts['retries'] = counts['retries'] + retries
+            counts['seconds'] = counts['seconds'] + seconds
+            if from_cache:
+                counts['cache_hits'] = counts['cache_hits'] + 1
+            if coalesced:
+                counts['coalesced'] = counts['coalesced'] + 1
+            elif short_circuited:
+                counts['short_circuited'] = counts['short_circuited'] + 1
+            elif failed:
+                counts['errors'] = counts['errors'] + 1
+
+    # Returns the total number of HTTP calls, not counting ones answered from the cache, shared with another call or
+    # short circuited
+    def request_count(self):
+        with self.lock:
+            return sum(counts['requests'] - counts['cache_hits'] - counts['coalesced'] - counts['short_circuited'] for counts in self.hosts.values())
+
+    # Returns a copy of the stats as a plain dict, ready for json.dumps
+    def to_dict(self):
+        with self.lock:
+            return {
+                'stages': {name: dict(stage) for name, stage in self.stages.items()},
+                'hosts': {host: dict(counts) for host, counts in self.hosts.items()}
+            }
+
+    # Returns the stats in the Prometheus text exposition format
+    def to_prometheus(self):
+        stats = self.to_dict()
+        lines = []
+        metrics = [
+            ("stage_calls_total", "Number of times each stage ran", "stage", 'stages', 'calls'),
+            ("stage_errors_total", "Number of times each stage raised an error", "stage", 'stages', 'errors'),
+            ("stage_failed_requests_total", "HTTP calls made in each stage that failed", "stage", 'stages', 'failed_requests'),
+            ("stage_short_circuited_total", "HTTP calls made in each stage that weren't sent because the host's circuit breaker was open or the deadline had passed", "stage", 'stages', 'short_circuited'),
+            ("stage_seconds_total", "Wall time spent in each stage", "stage", 'stages', 'seconds'),
+            ("http_requests_total", "HTTP calls to each host, including ones answered from the cache", "host", 'hosts', 'requests'),
+            ("http_cache_hits_total", "HTTP calls to each host answered from the cache", "host", 'hosts', 'cache_hits'),
+            ("http_coalesced_total", "HTTP calls to each host that shared an identical call already in flight", "host", 'hosts', 'coalesced'),
+            ("http_short_circuited_total", "HTTP calls to each host that weren't sent because its circuit breaker was open or the deadline had passed", "host", 'hosts', 'short_circuited'),
+            ("http_retries_total", "HTTP retries to each host", "host", 'hosts', 'retries'),
+            ("http_errors_total", "HTTP calls to each host that failed", "host", 'hosts', 'errors'),
+            ("http_response_bytes_total", "Response bytes from each host", "host", 'hosts', 'bytes'),
+            ("http_seconds_total", "Wall time spent on HTTP calls to each host", "host", 'hosts', 'seconds')
+        ]
+        for metric, description, label, section, key in metrics:
+            name = PROMETHEUS_PREFIX+"_"+metric
+            lines.append("# HELP "+name+" "+description)
+            lines.append("# TYPE "+name+" counter")
+            for value_name, values in sorted(stats[section].items()):
+                lines.append(name+"{"+label+"=\""+value_name.replace("\\", "\\\\").replace("\"", "\\\"")+"\"} "+repr(values[key]))
+        return "\n".join(lines)+"\n"
+
+    # Writes the stats to a file in the Prometheus text format, e.g. for node_exporter's textfile collector
+    # Writes to a temporary file first, so the collector never reads half a file
+    def write_prometheus(self, path):
+        with open(path+".tmp", "w", encoding="utf-8") as f:
+            f.write(self.to_prometheus())
+        os.replace(path+".tmp", path)
+
+    # Writes the stats to the JSON log, under a 'stats' key
+    # Doesn't copy the stats at all if the level is switched off
+    def log(self, message="Stats", level=logging.INFO):
+        if logger.isEnabledFor(level):
+            logger.log(level, message, extra={'stats': self.to_dict()})
+
+
+# The totals for everything the process has done
+process_stats = Stats()
+
+# The stats of the property being built in the current thread or task, if any
+current_stats = contextvars.ContextVar("current_stats", default=None)
+
+# The innermost stage running in the current thread or task, if any
+current_stage = contextvars.ContextVar("current_stage", default=None)
+
+# Functions to call when a stage starts and ends, e.g. to attach a profiler
+# Each hook is called as hook(stage, event, seconds), where event is "start" or "end", and seconds is how long the
+# stage took (None on "start")
+stage_hooks = []
+
+
+# Accepts a function and calls it whenever a stage starts or ends
+def add_stage_hook(hook):
+    stage_hooks.append(hook)
+
+
+# Stops calling a stage hook
+def remove_stage_hook(hook):
+    stage_hooks.remove(hook)
+
+
+# Accepts a stats object and records into it, as well as the process totals, for everything run inside the with block
+# Threads started inside the block need to be given a copy of the context (see contextvars.copy_context)
+@contextlib.contextmanager
+def collect(stats):
+    token = current_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        current_stats.reset(token)
+
+
+# Calls every stage hook, and logs any hook that blows up instead of letting it break the property
+def call_stage_hooks(name, event, seconds):
+    for hook in list(stage_hooks):
+        try:
+            hook(name, event, seconds)
+        except Exception as e:
+            logger.error("Stage hook %r failed: %r", hook, e)
+
+
+# Accepts a stage name and how long it took, and records it
+def record_stage(name, seconds, failed=False):
+    process_stats.record_stage(name, seconds, failed)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.record_stage(name, seconds, failed)
+
+
+# Accepts a URL and the details of one HTTP call to it, and records them
+# Failed calls are also counted against the stage they were made in
+def record_request(url, seconds, size, retries=0, from_cache=False, failed=False, coalesced=False, short_circuited=False):
+    host = urlsplit(url).hostname or ""
+    stage = current_stage.get() if failed or short_circuited else None
+    process_stats.record_request(host, seconds, size, retries, from_cache, failed, coalesced, short_circuited)
+    if stage is not None:
+        process_stats.record_stage_failure(stage, short_circuited)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.record_request(host, seconds, size, retries, from_cache, failed, coalesced, short_circuited)
+        if stage is not None:
+            stats.record_stage_failure(stage, short_circuited)
+
+
+# Counts a failure against the stage running now, for a call that came back but without what we asked for, e.g. an
+# Eplans search that lands on the Welcome interview, so the property knows the stage's section is missing something
+# Pass short_circuited=True for a call that was never made, e.g. because the deadline passed while it waited
+def record_failure(short_circuited=False):
+    stage = current_stage.get()
+    if stage is None:
+        return
+    process_stats.record_stage_failure(stage, short_circuited)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.record_stage_failure(stage, short_circuited)
+
+
+# Decorator that records a function as a stage: how long it takes, and whether it raised an error
+# Works on regular functions and coroutines
+def timed(name):
+    def decorate(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def timed_coroutine(*args, **kwargs):
+                call_stage_hooks(name, "start", None)
+                token = current_stage.set(name)
+                started = time.perf_counter()
+                failed = True
+                try:
+                    result = await function(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    seconds = time.perf_counter() - started
+                    current_stage.reset(token)
+                    record_stage(name, seconds, failed)
+                    call_stage_hooks(name, "end", seconds)
+            return timed_coroutine
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            call_stage_hooks(name, "start", None)
+            token = current_stage.set(name)
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = function(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                seconds = time.perf_counter() - started
+                current_stage.reset(token)
+                record_stage(name, seconds, failed)
+                call_stage_hooks(name, "end", seconds)
+        return timed_function
+    return decorate
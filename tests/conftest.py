@@ -0,0 +1,21 @@
+import copy
+import pytest
+from application.core.utils import rate_limit
+from application.core.utils.circuit_breaker import reset_breakers
+from fake_hamilton import FakeHamilton
+
+
+# Starts a fake city for a test, and puts back everything the test may have changed about how requests are sent
+@pytest.fixture
+def hamilton():
+    import ls_hamilton_property_class
+    limits = copy.deepcopy(rate_limit.HOST_LIMITS)
+    eplans_sessions = ls_hamilton_property_class.eplans_sessions
+    ls_hamilton_property_class.eplans_sessions = ls_hamilton_property_class.ls_hamilton_eplans_session_pool()
+    reset_breakers()
+    with FakeHamilton() as fake:
+        yield fake
+    for host in set(rate_limit.HOST_LIMITS) | set(limits):
+        rate_limit.set_host_limits(host, limits.get(host))
+    reset_breakers()
+    ls_hamilton_property_class.eplans_sessions = eplans_sessions
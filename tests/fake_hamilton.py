@@ -0,0 +1,164 @@
+import collections
+import itertools
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+from application.core.utils.http_client import set_upstream, clear_upstreams
+
+
+# A stand-in for the city's servers, for the tests
+# It answers the address search, the map services, the property inquiry application and Eplans for one made-up
+# property at 17 Discovery Drive, which has two roll numbers: one tax exempt and one with a full set of levies.
+# While it's running, every request to the city's hosts goes to it instead (see set_upstream in http_client.py).
+#
+#   with FakeHamilton() as hamilton:
+#       hamilton.delays['detail.asp'] = 2
+#       ...
+#       hamilton.hits['detail.asp']
+
+# The hosts the fake stands in for
+HOSTS = ("spatialsolutions.hamilton.ca", "oldproperty.hamilton.ca", "eplans.hamilton.ca")
+
+# The address the fake knows about
+ADDRESS = {'street_number': '17', 'street_name': 'Discovery', 'street_type_short': 'DR', 'street_type_long': 'DRIVE', 'city': 'Hamilton'}
+
+# The roll numbers at the address
+EXEMPT_ROLL_NUMBER = "02016408140"
+TAXABLE_ROLL_NUMBER = "02016499999"
+
+# The zoning the map services answer with
+ZONING = {"ZONING_CODE": "F-1", "ZONING_DESC": "Waterfront"}
+
+# The property inquiry search results for the address
+LIST_PAGE = """<html><body><p>Property List</p><table>
+<tr><td><a href="detail.asp?qryrollno=02016408140">02016408140</a></td><td>17 DISCOVERY DR</td></tr>
+<tr><td><a href="detail.asp?qryrollno=02016499999">02016499999</a></td><td>17 DISCOVERY DR</td></tr>
+</table></body></html>"""
+
+# The property inquiry detail page for the tax exempt roll number
+EXEMPT_PAGE = """<html><body><table><tr><td>
+<table><tr><td><b>Current Year Assessment</b></td></tr>
+<tr><td>Year</td><td>Class</td><td>Description</td><td>Amount</td></tr>
+<tr><td>2022</td><td>E</td><td>Exempt</td><td>1,653,600</td></tr>
+</table></td></tr><tr><td class="bodycopy">Exempt</td></tr></table></body></html>"""
+
+# The property inquiry detail page for the taxable roll number
+TAXABLE_PAGE = """<html><body><table><tr><td>
+<table><tr><td><b>Current Year Assessment</b></td></tr>
+<tr><td>Year</td><td>Class</td><td>Description</td><td>Amount</td></tr>
+<tr><td>2022</td><td>CT</td><td>Commercial Taxable</td><td>637,400</td></tr>
+<tr><td>Total Assessment</td><td></td><td></td><td>637,400</td></tr></table>
+</td></tr>
+<tr><td><table><tr><td><b>Tax Levy History</b></td></tr>
+<tr><td></td><td>Year</td><td>Amount</td></tr>
+<tr><td></td><td>2022</td><td>19,393.86</td></tr>
+<tr><td></td><td>2021</td><td>18,930.92</td></tr></table></td></tr>
+<tr><td><table><tr><td><b>Breakdown</b></td></tr>
+<tr><td>Type</td><td>Amount</td></tr>
+<tr><td>Municipal Levy</td><td>13,784.74</td></tr>
+<tr><td>Education Levy</td><td>5,609.12</td></tr>
+<tr><td>Total</td><td>19,393.86</td></tr></table></td></tr>
+<tr><td><table><tr><td><b>Instalments</b></td></tr>
+<tr><td></td><td>Due</td><td>Amount</td></tr>
+<tr><td>1</td><td>February\xa028,\xa02022</td><td>4,733.00</td></tr>
+<tr><td>2</td><td>April\xa029,\xa02022</td><td>4,732.46</td></tr>
+<tr><td></td><td>Total</td><td>9,465.46</td></tr></table></td></tr>
+</table></body></html>"""
+
+# The Eplans permit search results for the address
+PERMITS_PAGE = """<html><body><div class="panel-title">Results</div><table><thead><tr><th><span>Application #</span></th></tr></thead>
+<tbody><tr><td><div> 2019 574500 </div></td><td><div>To demolish</div></td><td><div>x</div></td><td><div>Closed</div></td></tr></tbody></table></body></html>"""
+
+
+# Answers a request the way the city's server for it would
+class FakeHamiltonHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer(b"")
+
+    def do_POST(self):
+        self.answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    # Accepts the request body, waits as long as the fake has been told to for the path, and answers
+    def answer(self, body):
+        parts = urlsplit(self.path)
+        params = dict(parse_qsl(parts.query))
+        params.update(parse_qsl(body.decode("utf-8")))
+        name = parts.path.rsplit("/", 1)[-1]
+        self.server.hit(name)
+        time.sleep(self.server.delays.get(name, 0))
+        if name == "findAddressCandidates":
+            return self.reply(json.dumps({"candidates": [{"location": {"x": -79.86, "y": 43.27}, "score": 100}]}), "application/json")
+        if name == "query" and "/MapServer/" in parts.path:
+            if "layerDefs" in params:
+                return self.reply(json.dumps({"layers": [{"id": int(layer["layerId"]), "features": [{"attributes": ZONING}] if layer["layerId"] == 9 else []} for layer in json.loads(params["layerDefs"])]}), "application/json")
+            if params.get("returnIdsOnly") == "true":
+                return self.reply(json.dumps({"objectIds": [2]}), "application/json")
+            return self.reply(json.dumps({"features": [{"attributes": ZONING}]}), "application/json")
+        if name == "list.asp":
+            return self.reply(LIST_PAGE)
+        if name == "detail.asp":
+            return self.reply(EXEMPT_PAGE if params.get("qryrollno") == EXEMPT_ROLL_NUMBER else TAXABLE_PAGE)
+        if name == "sfjsp":
+            if self.command == "GET":
+                return self.reply("<html>Welcome</html>", headers=[("Set-Cookie", "JSESSIONID="+self.server.new_session()+"; Path=/")])
+            if "e_1536239857797" in params:
+                return self.reply(PERMITS_PAGE)
+            return self.reply("<html>Search</html>")
+        self.send_response(404)
+        self.end_headers()
+
+    def reply(self, body, content_type="text/html; charset=utf-8", headers=()):
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+# The fake city, on a port of its own
+class FakeHamilton(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeHamiltonHandler)
+
+        # How many requests each path has had, by the last part of the path, e.g. hits['detail.asp']
+        self.hits = collections.Counter()
+
+        # How many seconds to wait before answering each path, by the last part of the path
+        self.delays = {}
+
+        self.sessions = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def hit(self, name):
+        with self.lock:
+            self.hits[name] = self.hits[name] + 1
+
+    # Returns a new Eplans session id
+    def new_session(self):
+        with self.lock:
+            return "session"+str(next(self.sessions))
+
+    # Clients that gave up on a slow answer have hung up by the time it's sent
+    def handle_error(self, request, client_address):
+        pass
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        for host in HOSTS:
+            set_upstream(host, "http://127.0.0.1:"+str(self.server_port))
+        return self
+
+    def __exit__(self, *args):
+        clear_upstreams()
+        self.shutdown()
+        self.server_close()
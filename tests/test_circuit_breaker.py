@@ -0,0 +1,19 @@
+import ls_hamilton_property_class
+from application.core.utils.circuit_breaker import FAILURE_THRESHOLD, get_breaker
+from application.core.utils.rate_limit import HOST_LIMITS, set_host_limits
+from fake_hamilton import ADDRESS
+
+
+# Requests that give up because they wouldn't get a slot before their deadline say nothing about the host, so they
+# don't open its breaker for the builds after them
+def test_deadline_waiting_for_a_slot_doesnt_open_the_breaker(hamilton):
+    set_host_limits("oldproperty.hamilton.ca", dict(HOST_LIMITS["oldproperty.hamilton.ca"], rate=0.2, burst=1))
+    for attempt in range(FAILURE_THRESHOLD + 1):
+        record = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['taxes'], deadline=0.5).to_dict()
+        assert 'taxes' in record['status']
+    assert get_breaker("oldproperty.hamilton.ca").state == "closed"
+
+    set_host_limits("oldproperty.hamilton.ca", None)
+    record = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['taxes']).to_dict()
+    assert 'status' not in record
+    assert [roll['roll_number'] for roll in record['taxes']] == ["02016408140", "02016499999"]
@@ -0,0 +1,75 @@
+import asyncio
+import threading
+import time
+import pytest
+import ls_hamilton_property_class
+from application.core.utils.rate_limit import set_host_limits
+from fake_hamilton import ADDRESS, HOSTS
+
+
+# Builds the property at the fake's address in a thread, and returns the thread and a dict that gets its record and
+# how long it took
+def build_in_thread(deadline):
+    result = {}
+
+    def build():
+        started = time.monotonic()
+        result['record'] = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['taxes'], deadline=deadline).to_dict()
+        result['seconds'] = time.monotonic() - started
+
+    thread = threading.Thread(target=build)
+    thread.start()
+    return thread, result
+
+
+# Returns True if a record has every roll number's taxes, read off their detail pages
+def has_full_taxes(record):
+    return 'status' not in record and len(record['taxes']) == 2 and all('is_tax_exempt' in roll for roll in record['taxes'])
+
+
+@pytest.fixture
+def slow_detail_pages(hamilton):
+    for host in HOSTS:
+        set_host_limits(host, None)
+    hamilton.delays['detail.asp'] = 1.5
+    return hamilton
+
+
+# A build with a short deadline that joins another build's slow request gives up at its own deadline
+def test_waiting_build_keeps_to_its_own_deadline(slow_detail_pages):
+    patient, patient_result = build_in_thread(None)
+    time.sleep(0.15)
+    hurried, hurried_result = build_in_thread(0.5)
+    hurried.join()
+    patient.join()
+    assert hurried_result['seconds'] < 0.9
+    assert 'taxes' in hurried_result['record']['status']
+    assert has_full_taxes(patient_result['record'])
+
+
+# A build without a deadline that joins a request cut short by another build's deadline sends it again itself
+def test_waiting_build_retries_a_request_cut_short(slow_detail_pages):
+    hurried, hurried_result = build_in_thread(0.4)
+    time.sleep(0.15)
+    patient, patient_result = build_in_thread(None)
+    hurried.join()
+    patient.join()
+    assert 'taxes' in hurried_result['record']['status']
+    assert has_full_taxes(patient_result['record'])
+
+
+# The same goes for builds sharing the async client's requests on one event loop
+def test_waiting_async_build_retries_a_request_cut_short(slow_detail_pages):
+    async def build(deadline, delay):
+        await asyncio.sleep(delay)
+        started = time.monotonic()
+        prop = await ls_hamilton_property_class.ls_hamilton_property.create(address=dict(ADDRESS), fields=['taxes'], deadline=deadline)
+        return prop.to_dict(), time.monotonic() - started
+
+    async def main():
+        return await asyncio.gather(build(0.4, 0), build(None, 0.15), build(0.5, 0.3))
+
+    (hurried, hurried_seconds), (patient, patient_seconds), (late, late_seconds) = asyncio.run(main())
+    assert 'taxes' in hurried['status']
+    assert has_full_taxes(patient)
+    assert late_seconds < 0.9
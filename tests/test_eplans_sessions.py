@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+import ls_hamilton_property_class
+from concurrent.futures import ThreadPoolExecutor
+from application.core.utils.rate_limit import set_host_limits
+from fake_hamilton import ADDRESS, HOSTS
+
+
+# Set how many properties to build at once, far more than there are Eplans sessions
+BUILDS = 100
+
+
+@pytest.fixture
+def busy_eplans(hamilton):
+    for host in HOSTS:
+        set_host_limits(host, None)
+    hamilton.delays['sfjsp'] = 0.05
+    return hamilton
+
+
+# Returns True if a record has the fake's building permits, and isn't missing anything
+def has_permits(record):
+    return 'status' not in record and record['building_permits'] == [{'application_number': '2019574500', 'description': 'To demolish', 'status': 'Closed'}]
+
+
+# Lots of async builds at once share the pool's sessions instead of starting one each, and the next lot starts none
+def test_async_builds_share_the_pools_sessions(busy_eplans):
+    async def build_all():
+        props = await asyncio.gather(*[ls_hamilton_property_class.ls_hamilton_property.create(address=dict(ADDRESS), fields=['building_permits']) for build in range(BUILDS)])
+        return [prop.to_dict() for prop in props]
+
+    pool = ls_hamilton_property_class.eplans_sessions
+    assert all(has_permits(record) for record in asyncio.run(build_all()))
+    started = pool.started
+    assert 0 < started <= ls_hamilton_property_class.EPLANS_POOL_SIZE
+    assert pool.waited > 0
+
+    assert all(has_permits(record) for record in asyncio.run(build_all()))
+    assert pool.started == started
+    assert busy_eplans.hits['sfjsp'] == 2 * started + 2 * BUILDS
+
+
+# The same goes for builds on lots of threads
+def test_threaded_builds_share_the_pools_sessions(busy_eplans):
+    def build(index):
+        return ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['building_permits']).to_dict()
+
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        records = list(executor.map(build, range(BUILDS)))
+    pool = ls_hamilton_property_class.eplans_sessions
+    assert all(has_permits(record) for record in records)
+    assert 0 < pool.started <= ls_hamilton_property_class.EPLANS_POOL_SIZE
+    assert busy_eplans.hits['sfjsp'] == 2 * pool.started + BUILDS
+
+
+# A search that can't get a session before its deadline gives up, and the record's status says permits were skipped
+def test_search_waiting_for_a_session_keeps_to_the_deadline(busy_eplans):
+    pool = ls_hamilton_property_class.eplans_sessions
+    for session in range(pool.size):
+        assert pool.take() is None
+    record = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['building_permits'], deadline=0.3).to_dict()
+    assert record['status'] == {'building_permits': 'skipped'}
+    for session in range(pool.size):
+        pool.discard()
+    record = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['building_permits']).to_dict()
+    assert has_permits(record)
@@ -0,0 +1,29 @@
+import pytest
+import ls_hamilton_extract
+from ls_hamilton_extract_benchmark import PAGE_KINDS, READERS, SAMPLE_PAGES, read_pages
+
+
+# The sample pages, as (kind, file name, HTML)
+PAGES = [(kind, name, html) for kind, pages in read_pages(SAMPLE_PAGES).items() for name, html in pages]
+
+# The parsers the extraction layer can run with here
+PARSERS = ["html.parser"]
+try:
+    import lxml
+    PARSERS.append("lxml")
+except ImportError:
+    pass
+
+
+# There's at least one sample page of every kind
+def test_every_kind_of_page_has_samples():
+    assert {kind for kind, name, html in PAGES} == set(PAGE_KINDS)
+
+
+# The extraction layer gets exactly the same data out of every sample page as the class's original code did
+@pytest.mark.parametrize("parser", PARSERS)
+@pytest.mark.parametrize("kind, name, html", PAGES, ids=[name for kind, name, html in PAGES])
+def test_extraction_matches_the_original(monkeypatch, parser, kind, name, html):
+    monkeypatch.setattr(ls_hamilton_extract, "HTML_PARSER", parser)
+    before, after = READERS[kind]
+    assert after(html) == before(html)
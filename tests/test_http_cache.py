@@ -0,0 +1,38 @@
+import asyncio
+import threading
+import pytest
+import ls_hamilton_property_class
+from application.core.utils import http_cache
+from fake_hamilton import ADDRESS
+
+
+@pytest.fixture
+def cache(tmp_path):
+    yield http_cache.enable_cache(str(tmp_path / "cache.sqlite"))
+    http_cache.disable_cache()
+
+
+# Async builds read and write the response cache off the event loop, and the second build is answered from it
+def test_async_builds_use_the_cache_off_the_event_loop(hamilton, cache, monkeypatch):
+    threads = set()
+
+    # Notes which thread each cache call runs on
+    def on_thread(call):
+        def wrapper(*args):
+            threads.add(threading.get_ident())
+            return call(*args)
+        return wrapper
+
+    monkeypatch.setattr(cache, "lookup", on_thread(cache.lookup))
+    monkeypatch.setattr(cache, "store", on_thread(cache.store))
+
+    async def build():
+        prop = await ls_hamilton_property_class.ls_hamilton_property.create(address=dict(ADDRESS), fields=['taxes'])
+        return prop.to_dict(), threading.get_ident()
+
+    first, loop_thread = asyncio.run(build())
+    detail_pages = hamilton.hits['detail.asp']
+    second, loop_thread = asyncio.run(build())
+    assert second == first
+    assert detail_pages > 0 and hamilton.hits['detail.asp'] == detail_pages
+    assert threads and loop_thread not in threads
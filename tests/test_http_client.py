@@ -0,0 +1,24 @@
+import threading
+from application.core.utils.http_client import CoalescingHTTPAdapter, create_client, create_session
+
+
+# A session created without adapters shares the same coalescing adapters, and so the same connections, as a client
+def test_default_session_shares_the_client_adapters():
+    session = create_session()
+    client = create_client()
+    assert isinstance(session.get_adapter("https://oldproperty.hamilton.ca/"), CoalescingHTTPAdapter)
+    assert session.adapters is client.adapters
+
+
+# So identical requests from the session and a client at the same time share one call
+def test_default_session_coalesces_with_clients(hamilton):
+    hamilton.delays['list.asp'] = 0.5
+    session = create_session()
+    client = create_client()
+    url = "https://oldproperty.hamilton.ca/list.asp?qryrollno=1"
+    threads = [threading.Thread(target=http.get, args=(url,)) for http in (session, client)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert hamilton.hits['list.asp'] == 1
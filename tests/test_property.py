@@ -0,0 +1,30 @@
+import pickle
+import pytest
+import ls_hamilton_property_class
+from fake_hamilton import ADDRESS
+
+
+# A built property can be pickled, and comes back with the same record
+def test_built_property_pickles(hamilton):
+    prop = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['ward', 'zoning', 'taxes'])
+    copy = pickle.loads(pickle.dumps(prop))
+    assert copy.to_dict() == prop.to_dict()
+    assert copy.stats.to_dict() == prop.stats.to_dict()
+
+
+# A lazy property can be pickled before anything is looked up, and looks its fields up once it's unpickled
+def test_lazy_property_pickles(hamilton):
+    prop = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields=['zoning'], lazy=True)
+    copy = pickle.loads(pickle.dumps(prop))
+    assert hamilton.hits['findAddressCandidates'] == 0
+    assert copy.zoning == prop.zoning
+    assert copy.to_dict() == {'address': ADDRESS, 'zoning': prop.zoning}
+
+
+# A single field can be passed on its own instead of in a list
+def test_single_field(hamilton):
+    prop = ls_hamilton_property_class.ls_hamilton_property(address=dict(ADDRESS), fields='zoning')
+    assert list(prop.to_dict()) == ['address', 'zoning']
+    ls_hamilton_property_class.ls_hamilton_property.check_fields('zoning')
+    with pytest.raises(ValueError, match="Unknown property fields: zones"):
+        ls_hamilton_property_class.ls_hamilton_property.check_fields('zones')